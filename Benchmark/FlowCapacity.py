@@ -0,0 +1,319 @@
+#!/usr/bin/python
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import signal
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+
+# Flow-capacity benchmark: runs the RTP, RTSP and DASH generators over
+# loopback, stepping up the number of concurrent flows for each geometry and
+# framerate, and records CPU and RSS per flow (from /proc) with the FPS and
+# loss the clients achieved. One result row per step goes to a JSON or CSV
+# file so runs can be compared across versions and hosts.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+SUITES = ['rtp', 'rtsp', 'dash']
+CLK_TCK = float(os.sysconf('SC_CLK_TCK'))
+
+# Result fields, in CSV column order
+FIELDS = ['suite', 'flows', 'width', 'height', 'framerate', 'window',
+          'server_cpu', 'client_cpu', 'cpu_per_flow', 'server_rss_kb', 'client_rss_kb', 'rss_per_flow_kb',
+          'fps', 'fps_min', 'drops', 'lost', 'received', 'loss', 'failed']
+
+def proc_cpu(pid):
+  # utime + stime in seconds, None once the process has gone
+  try:
+    with open('/proc/%d/stat' % pid) as f:
+      fields = f.read().rsplit(')', 1)[1].split()
+  except IOError:
+    return None
+  return (int(fields[11]) + int(fields[12])) / CLK_TCK
+
+def proc_rss(pid):
+  try:
+    with open('/proc/%d/status' % pid) as f:
+      for line in f:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1])
+  except IOError:
+    return None
+  return 0
+
+def parse_list(spec, kind=int):
+  return [kind(x) for x in spec.split(',') if x.strip() != '']
+
+def parse_geometry(spec):
+  width, height = spec.lower().split('x')
+  return (int(width), int(height))
+
+def host_info():
+  try:
+    revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.STDOUT).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    revision = None
+  return dict(host=socket.gethostname(), platform=platform.platform(), cpus=os.sysconf('SC_NPROCESSORS_ONLN'), revision=revision, started=time.time())
+
+class Process:
+  # One generator process, its output captured to a file in the run directory
+
+  def __init__(self, role, command, log, cwd):
+    self.role = role
+    self.log = log
+    env = dict(os.environ)
+    env['PYTHONUNBUFFERED'] = '1'
+    out = open(log, 'w')
+    self.popen = subprocess.Popen(command, stdout=out, stderr=subprocess.STDOUT, env=env, cwd=cwd)
+    out.close()
+
+  def sample(self):
+    return proc_cpu(self.popen.pid), proc_rss(self.popen.pid)
+
+  def alive(self):
+    return self.popen.poll() == None
+
+  def stop(self, grace=5.0):
+    if self.alive():
+      self.popen.send_signal(signal.SIGTERM)
+    deadline = time.time() + grace
+    while self.alive() and time.time() < deadline:
+      time.sleep(0.1)
+    if self.alive():
+      self.popen.kill()
+      self.popen.wait()
+
+class Step:
+  # One suite at one flow count, geometry and framerate
+
+  def __init__(self, suite, flows, width, height, fr, args, workdir):
+    self.suite = suite
+    self.flows = flows
+    self.width = width
+    self.height = height
+    self.fr = fr
+    self.args = args
+    self.workdir = workdir
+    self.processes = []
+    self.stats_files = []
+    # Every process outlives the measurement window on its own
+    self.lifetime = args.warmup + args.duration + 5
+
+  def script(self, generator, name):
+    return os.path.join(ROOT, generator, name)
+
+  def spawn(self, role, command):
+    name = '%s%d' % (role, len(self.processes))
+    log = os.path.join(self.workdir, name + '.log')
+    # Each process runs in its own directory under the step, so files the
+    # generators write relative to their cwd (the DASH client's video.mov)
+    # neither collide nor land in the caller's directory
+    cwd = os.path.join(self.workdir, name)
+    os.mkdir(cwd)
+    process = Process(role, command, log, cwd)
+    self.processes.append(process)
+    return process
+
+  def start(self):
+    args = self.args
+    geometry = ['-W', str(self.width), '-H', str(self.height), '-f', str(self.fr)]
+    if self.suite == 'rtp':
+      # Receivers bind first so the first frames are not lost
+      for i in range(self.flows):
+        stats = os.path.join(self.workdir, 'client%d.ndjson' % i)
+        self.stats_files.append(stats)
+        command = [args.python, self.script('RTPGenerator', 'RTPClient.py'), '-p', str(args.base_port + i), '-t', str(self.lifetime), '--stats_format', 'ndjson', '-s', stats] + geometry
+        if args.header_only:
+          command.append('-O')
+        self.spawn('client', command)
+      time.sleep(1)
+      for i in range(self.flows):
+        self.spawn('server', [args.python, self.script('RTPGenerator', 'RTPServer.py'), '-c', '127.0.0.1', '-p', str(args.base_port + i), '-t', str(self.lifetime)] + geometry)
+    elif self.suite == 'rtsp':
+      # One server, shared media, a client per flow
+      self.spawn('server', [args.python, self.script('RTSPGenerator', 'RTSPServer.py'), '-p', str(args.base_port)] + geometry)
+      time.sleep(args.server_startup)
+      for i in range(self.flows):
+        stats = os.path.join(self.workdir, 'client%d.ndjson' % i)
+        self.stats_files.append(stats)
+        self.spawn('client', [args.python, self.script('RTSPGenerator', 'RTSPClient.py'), '-s', '127.0.0.1', '-p', str(args.base_port), '-t', str(self.lifetime), '-m', '1', '--stats_format', 'ndjson', '--statsfile', stats])
+    else:
+      # The DASH server encodes its own ladder and publishes to the RTMP
+      # ingest; clients play the MPD the origin serves. Geometry and
+      # framerate come from the ladder, not from the step.
+      self.spawn('server', [args.dash_python, self.script('DASHGenerator', 'DASHServer.py')])
+      time.sleep(args.server_startup)
+      for i in range(self.flows):
+        self.spawn('client', [args.dash_python, self.script('DASHGenerator', 'Client.py')])
+
+  def sample(self):
+    samples = []
+    for process in self.processes:
+      cpu, rss = process.sample()
+      samples.append((process, cpu, rss))
+    return samples
+
+  def stop(self):
+    for process in self.processes:
+      process.stop()
+
+  def client_records(self, start, end):
+    # Per-second samples the clients took inside the measurement window
+    records = []
+    for path in self.stats_files:
+      flow = []
+      if os.path.exists(path):
+        with open(path) as f:
+          for line in f:
+            try:
+              row = json.loads(line)
+            except ValueError:
+              continue
+            # RTSPClient adds a record per RTP stream after the totals
+            if self.suite == 'rtsp' and row.get('flow') != 'all':
+              continue
+            if start <= row['timestamp'] <= end:
+              flow.append(row)
+      records.append(flow)
+    return records
+
+  def run(self):
+    self.start()
+    time.sleep(self.args.warmup)
+    start = time.time()
+    before = self.sample()
+    time.sleep(self.args.duration)
+    end = time.time()
+    after = self.sample()
+    failed = len([p for p in self.processes if not p.alive()])
+    self.stop()
+    return self.result(start, end, before, after, failed)
+
+  def result(self, start, end, before, after, failed):
+    window = end - start
+    cpu = dict(server=0.0, client=0.0)
+    rss = dict(server=0, client=0)
+    for (process, cpu0, rss0), (_, cpu1, rss1) in zip(before, after):
+      if cpu0 != None and cpu1 != None:
+        cpu[process.role] = cpu[process.role] + (cpu1 - cpu0)
+      if rss1 != None:
+        rss[process.role] = rss[process.role] + rss1
+    result = dict(suite=self.suite, flows=self.flows, width=self.width, height=self.height, framerate=self.fr, window=round(window, 3), failed=failed)
+    # CPU as a percentage of one core
+    result['server_cpu'] = round(100.0 * cpu['server'] / window, 2)
+    result['client_cpu'] = round(100.0 * cpu['client'] / window, 2)
+    result['cpu_per_flow'] = round((result['server_cpu'] + result['client_cpu']) / self.flows, 2)
+    result['server_rss_kb'] = rss['server']
+    result['client_rss_kb'] = rss['client']
+    result['rss_per_flow_kb'] = (rss['server'] + rss['client']) // self.flows
+
+    fps = []
+    drops = lost = received = 0
+    have_loss = have_received = False
+    for flow in self.client_records(start, end):
+      samples = [row['fps'] for row in flow if row.get('fps') != None]
+      # A flow that reported nothing achieved nothing
+      if len(samples) > 0:
+        fps.append(sum(samples) / float(len(samples)))
+      else:
+        fps.append(0.0)
+      for row in flow:
+        drops = drops + (row.get('drops') or 0)
+        if row.get('loss') != None:
+          have_loss = True
+          lost = lost + row['loss']
+        if row.get('received') != None:
+          have_received = True
+          received = received + row['received']
+    if len(fps) > 0:
+      result['fps'] = round(sum(fps) / len(fps), 2)
+      result['fps_min'] = round(min(fps), 2)
+      result['drops'] = drops
+    if have_loss:
+      result['lost'] = lost
+    if have_received:
+      result['received'] = received
+      if lost + received > 0:
+        result['loss'] = round(float(lost) / (lost + received), 6)
+    for name in FIELDS:
+      result.setdefault(name, None)
+    return result
+
+def write_results(path, format, info, results):
+  if format == 'json':
+    with open(path, 'w') as f:
+      json.dump(dict(host=info, results=results), f, indent=2, sort_keys=True)
+      f.write('\n')
+    return
+  info_fields = sorted(info.keys())
+  with open(path, 'w') as f:
+    writer = csv.writer(f)
+    writer.writerow(info_fields + FIELDS)
+    for result in results:
+      writer.writerow([info[name] for name in info_fields] + [result[name] for name in FIELDS])
+
+def main():
+  parser = argparse.ArgumentParser(description='Step up concurrent flows of the RTP, RTSP and DASH generators over loopback and record the cost per flow')
+  parser.add_argument('-S', '--suites', default='rtp,rtsp', help='Comma-separated suites to run: %s.' % ', '.join(SUITES))
+  parser.add_argument('-n', '--flows', default='1,2,4,8,16', help='Comma-separated concurrent flow counts to step through.')
+  parser.add_argument('-g', '--geometries', default='1280x720', help='Comma-separated WIDTHxHEIGHT frame sizes.')
+  parser.add_argument('-f', '--framerates', default='30', help='Comma-separated framerates.')
+  parser.add_argument('-d', '--duration', type=float, default=20, help='Seconds measured per step.')
+  parser.add_argument('-w', '--warmup', type=float, default=5, help='Seconds to let flows settle before measuring.')
+  parser.add_argument('--server_startup', type=float, default=2, help='Seconds to let RTSP/DASH servers start before clients connect.')
+  parser.add_argument('--stop_below', type=float, default=0.9, help='Stop stepping up once mean FPS falls below this fraction of the framerate (0 runs every step).')
+  parser.add_argument('-O', '--header_only', default=False, action='store_true', help='Run RTP clients header-only (adds loss, drops decode cost).')
+  parser.add_argument('-p', '--base_port', type=int, default=6000, help='First port used by the flows.')
+  parser.add_argument('--python', default='python', help='Interpreter for the RTP and RTSP generators.')
+  parser.add_argument('--dash_python', default='python3', help='Interpreter for the DASH generator.')
+  parser.add_argument('-o', '--output', default='flow_capacity.json', help='Results file.')
+  parser.add_argument('--format', default=None, choices=['json', 'csv'], help='Results format (default from the output file extension).')
+  parser.add_argument('-k', '--keep', default=False, action='store_true', help='Keep the per-step process logs and client stats.')
+  args = parser.parse_args()
+
+  suites = parse_list(args.suites, str)
+  for suite in suites:
+    if suite not in SUITES:
+      parser.error("Unknown suite %s" % suite)
+  format = args.format
+  if format == None:
+    format = 'csv' if args.output.endswith('.csv') else 'json'
+
+  info = host_info()
+  info['args'] = ' '.join(sys.argv[1:])
+  results = []
+  workdir = tempfile.mkdtemp(prefix='flowcap')
+  print("Logs in %s" % workdir)
+  try:
+    for suite in suites:
+      for geometry in parse_list(args.geometries, parse_geometry):
+        for fr in parse_list(args.framerates):
+          for flows in parse_list(args.flows):
+            stepdir = os.path.join(workdir, '%s_%dx%d_%d_%d' % (suite, geometry[0], geometry[1], fr, flows))
+            os.mkdir(stepdir)
+            step = Step(suite, flows, geometry[0], geometry[1], fr, args, stepdir)
+            try:
+              result = step.run()
+            finally:
+              step.stop()
+            results.append(result)
+            write_results(args.output, format, info, results)
+            print("%s %dx%d@%d Flows:%d CPU/flow:%s%% RSS/flow:%skB FPS:%s Loss:%s" % (suite, geometry[0], geometry[1], fr, flows, result['cpu_per_flow'], result['rss_per_flow_kb'], result['fps'], result['loss']))
+            if result['fps'] != None and args.stop_below > 0 and result['fps'] < fr * args.stop_below:
+              print("%s can not keep up at %d flows, next configuration." % (suite, flows))
+              break
+  except KeyboardInterrupt:
+    print("Interrupted, results so far are in %s" % args.output)
+  finally:
+    if not args.keep:
+      shutil.rmtree(workdir, ignore_errors=True)
+  write_results(args.output, format, info, results)
+
+if __name__ == "__main__":
+  main()
@@ -1,12 +1,22 @@
+import os
+import sys
+import time
 import gi
 gi.require_version('Gst', '1.0')
 gi.require_version('GstVideo', '1.0')
 from gi.repository import Gst, GstVideo, GLib
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RTPGenerator'))
+from PipelineProfiler import PipelineProfiler
+
 Gst.init(None)
 
 class settings:
     stream_location = 'rtmp://127.0.0.1/dash/streamname_'
+    # Print per-element processing times and queue levels every
+    # profile_interval seconds
+    profile = False
+    profile_interval = 5
 
 class Main:
     def __init__(self):
@@ -38,6 +48,11 @@ class Main:
         self.bin.add_pad(ghostpad)
         
         self.pipeline.set_property('video-sink', self.bin)        
+
+        # playbin builds its decoding chain later, the profiler follows it
+        self.profiler = None
+        if settings.profile:
+            self.profiler = PipelineProfiler(self.pipeline)
         
    
     def malm(self, to_add, pipe):
@@ -66,12 +81,18 @@ class Main:
     def run(self):
         self.pipeline.set_state(Gst.State.PLAYING)
         GLib.timeout_add(2*1000, self.read_caps, None)
+        if self.profiler:
+            GLib.timeout_add(settings.profile_interval * 1000, self.do_profile, None)
         self.mainloop.run()
 
 
     def read_caps(self, user_data):
         print(self.pad.get_property("caps"))
         
+    def do_profile(self, user_data):
+        print('{}{}'.format(time.time(), self.profiler.report()[0]))
+        return True
+
     def stop(self): 
         print('Exiting...')
         Gst.debug_bin_to_dot_file(self.pipeline, Gst.DebugGraphDetails.ALL, 'stream')
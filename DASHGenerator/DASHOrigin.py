@@ -0,0 +1,387 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import collections
+from email.utils import formatdate
+from urllib.parse import unquote, urlsplit
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RTPGenerator'))
+from FlowStats import percentiles
+from StatsWriter import StatsWriter, FORMATS
+
+# HTTP origin for DASH content, such as DASHPackager output, so players need
+# nothing but this process. One asyncio loop serves every connection with
+# keep-alive and single Range requests. Small, hot files (manifests, recent
+# segments) are answered from an in-memory LRU bounded in bytes; anything
+# else goes from the file to the socket with sendfile. A miss on a small file
+# is sent with sendfile too while a worker thread reads it into the LRU, so
+# no disk read ever holds up the loop. Request latency,
+# bytes served and cache hits are written every period through StatsWriter
+# and can be fetched as JSON from /stats.
+
+TYPES = {
+    '.mpd': 'application/dash+xml',
+    '.m4s': 'video/iso.segment',
+    '.mp4': 'video/mp4',
+    '.m4v': 'video/mp4',
+    '.m4a': 'audio/mp4',
+    '.ts': 'video/mp2t',
+    '.json': 'application/json',
+}
+
+REASONS = {
+    200: 'OK',
+    206: 'Partial Content',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    416: 'Range Not Satisfiable',
+    500: 'Internal Server Error',
+}
+
+# Largest request head accepted
+MAX_HEAD = 16384
+
+class HotCache:
+    # File contents by path, least recently used dropped first once the
+    # total goes over max_bytes. An entry is only used while the file's
+    # size and mtime are what they were when it was read.
+    def __init__(self, max_bytes, max_item):
+        self.max_bytes = max_bytes
+        self.max_item = max_item
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path, st):
+        entry = self.entries.get(path)
+        if entry is None or entry[0] != (st.st_size, st.st_mtime_ns):
+            self.misses += 1
+            return None
+        self.entries.move_to_end(path)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, path, st, data):
+        if len(data) > self.max_item or len(data) > self.max_bytes:
+            return
+        self.drop(path)
+        self.entries[path] = ((st.st_size, st.st_mtime_ns), data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            old, entry = self.entries.popitem(last=False)
+            self.size -= len(entry[1])
+            self.evictions += 1
+
+    def drop(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+class OriginStats:
+    # Counters since start, and per-period ones reset by interval()
+    def __init__(self):
+        self.started = time.time()
+        self.connections = 0
+        self.total_requests = 0
+        self.total_bytes = 0
+        self.statuses = collections.Counter()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.bytes = 0
+        self.errors = 0
+        self.latencies = []
+
+    def request(self, status, sent, latency):
+        self.requests += 1
+        self.total_requests += 1
+        self.bytes += sent
+        self.total_bytes += sent
+        self.statuses[status] += 1
+        if status >= 400:
+            self.errors += 1
+        self.latencies.append(latency)
+
+    def interval(self):
+        current = (self.requests, self.bytes, self.errors, self.latencies)
+        self.reset()
+        return current
+
+class ByteRangeError(Exception):
+    pass
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def parse_range(header, size):
+    # (start, end inclusive) for a single 'bytes=' range, None for the whole
+    # file. Multiple ranges are answered with the whole file.
+    if header is None:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if first == '':
+            # Suffix range: the last N bytes
+            count = int(last)
+            if count <= 0:
+                raise ByteRangeError(header)
+            return max(0, size - count), size - 1
+        start = int(first)
+        end = size - 1 if last == '' else min(int(last), size - 1)
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise ByteRangeError(header)
+    return start, end
+
+class Origin:
+
+    def __init__(self, root, cache_size=256, cache_item=8, keepalive_timeout=30, period=1.0, stats_file=None, stats_format='text', flush_interval=1.0):
+        self.root = os.path.realpath(root)
+        self.cache = HotCache(int(cache_size * 1024 * 1024), int(cache_item * 1024 * 1024))
+        # Paths being read into the cache
+        self.filling = set()
+        self.keepalive_timeout = keepalive_timeout
+        self.period = period
+        self.stats = OriginStats()
+        self.writer = StatsWriter(stats_file, format=stats_format, flush_interval=flush_interval)
+
+    def resolve(self, target):
+        # File under root for a request target, or None
+        path = unquote(urlsplit(target).path)
+        full = os.path.realpath(os.path.join(self.root, path.lstrip('/')))
+        if full != self.root and not full.startswith(self.root + os.sep):
+            return None
+        if os.path.isdir(full):
+            return None
+        return full
+
+    async def handle(self, reader, writer):
+        self.stats.connections += 1
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keepalive_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                start = time.time()
+                keep_alive, status, sent = await self.respond(head, writer)
+                self.stats.request(status, sent, 1000.0 * (time.time() - start))
+        except ConnectionError:
+            pass
+        finally:
+            self.stats.connections -= 1
+            writer.close()
+
+    async def respond(self, head, writer):
+        # Answers one request; returns (keep the connection, status, body bytes)
+        lines = head.decode('latin-1').split('\r\n')
+        request = lines[0].split()
+        if len(request) != 3 or not request[2].startswith('HTTP/'):
+            await self.send_error(writer, 400, False)
+            return False, 400, 0
+        method, target, version = request
+        headers = dict()
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            if name:
+                headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = connection == 'keep-alive'
+        else:
+            keep_alive = connection != 'close'
+
+        if method not in ('GET', 'HEAD'):
+            await self.send_error(writer, 405, keep_alive)
+            return keep_alive, 405, 0
+
+        if urlsplit(target).path == '/stats':
+            body = json.dumps(self.snapshot(), sort_keys=True).encode()
+            await self.send(writer, 200, keep_alive, {'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}, body, method == 'HEAD')
+            return keep_alive, 200, len(body)
+
+        path = self.resolve(target)
+        try:
+            st = os.stat(path) if path else None
+        except OSError:
+            st = None
+        if st is None:
+            await self.send_error(writer, 404, keep_alive)
+            return keep_alive, 404, 0
+
+        try:
+            byte_range = parse_range(headers.get('range'), st.st_size)
+        except ByteRangeError:
+            await self.send_error(writer, 416, keep_alive, {'Content-Range': 'bytes */{}'.format(st.st_size)})
+            return keep_alive, 416, 0
+
+        status = 200
+        offset, count = 0, st.st_size
+        extra = {
+            'Content-Type': TYPES.get(os.path.splitext(path)[1].lower(), 'application/octet-stream'),
+            'Last-Modified': formatdate(st.st_mtime, usegmt=True),
+            'Accept-Ranges': 'bytes',
+        }
+        if byte_range is not None:
+            status = 206
+            offset, count = byte_range[0], byte_range[1] - byte_range[0] + 1
+            extra['Content-Range'] = 'bytes {}-{}/{}'.format(byte_range[0], byte_range[1], st.st_size)
+
+        if method == 'HEAD':
+            await self.send(writer, status, keep_alive, extra, b'', True, count)
+            return keep_alive, status, 0
+
+        data = self.cache.get(path, st)
+        if data is not None:
+            await self.send(writer, status, keep_alive, extra, memoryview(data)[offset:offset + count])
+            return keep_alive, status, count
+        if st.st_size <= self.cache.max_item:
+            self.fill(path, st)
+
+        # Straight from the page cache to the socket
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            await self.send_error(writer, 404, keep_alive)
+            return keep_alive, 404, 0
+        with f:
+            await self.send(writer, status, keep_alive, extra, b'', True, count)
+            loop = asyncio.get_running_loop()
+            sent = await loop.sendfile(writer.transport, f, offset, count)
+        return keep_alive, status, sent
+
+    def fill(self, path, st):
+        # Reads path into the cache on a worker thread; the put happens back
+        # on the loop, which owns the cache
+        if path in self.filling:
+            return
+        self.filling.add(path)
+        future = asyncio.get_running_loop().run_in_executor(None, read_file, path)
+        future.add_done_callback(lambda done: self.filled(path, st, done))
+
+    def filled(self, path, st, done):
+        self.filling.discard(path)
+        if done.cancelled() or done.exception() is not None:
+            return
+        data = done.result()
+        # Changed while reading; not kept
+        if len(data) == st.st_size:
+            self.cache.put(path, st, data)
+
+    async def send(self, writer, status, keep_alive, headers, body, head_only=False, length=None):
+        if length is None:
+            length = len(body)
+        lines = ['HTTP/1.1 {} {}'.format(status, REASONS[status])]
+        lines.append('Date: {}'.format(formatdate(usegmt=True)))
+        lines.append('Server: VidGen-DASHOrigin')
+        lines.append('Content-Length: {}'.format(length))
+        lines.append('Access-Control-Allow-Origin: *')
+        lines.append('Connection: {}'.format('keep-alive' if keep_alive else 'close'))
+        for name, value in headers.items():
+            lines.append('{}: {}'.format(name, value))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if not head_only:
+            writer.write(body)
+        await writer.drain()
+
+    async def send_error(self, writer, status, keep_alive, headers=None):
+        body = '{} {}\n'.format(status, REASONS[status]).encode()
+        extra = {'Content-Type': 'text/plain'}
+        if headers:
+            extra.update(headers)
+        await self.send(writer, status, keep_alive, extra, body)
+
+    def snapshot(self):
+        return {
+            'uptime': time.time() - self.stats.started,
+            'connections': self.stats.connections,
+            'requests': self.stats.total_requests,
+            'bytes': self.stats.total_bytes,
+            'statuses': dict((str(k), v) for k, v in self.stats.statuses.items()),
+            'cache_bytes': self.cache.size,
+            'cache_entries': len(self.cache.entries),
+            'cache_hits': self.cache.hits,
+            'cache_misses': self.cache.misses,
+            'cache_evictions': self.cache.evictions,
+        }
+
+    async def report(self):
+        last = time.time()
+        while True:
+            await asyncio.sleep(self.period)
+            now = time.time()
+            elapsed = now - last
+            last = now
+            requests, sent, errors, latencies = self.stats.interval()
+            kbps = sent * 8 / elapsed / 1000
+            p50, p95, p99 = percentiles(latencies)
+            mesg = '{} Origin Connections:{} Requests:{} Errors:{} Rate:{:.0f}kbps Cache:{}/{}MB Hits:{} Misses:{}'.format(
+                now, self.stats.connections, requests, errors, kbps,
+                self.cache.size // (1024 * 1024), self.cache.max_bytes // (1024 * 1024), self.cache.hits, self.cache.misses)
+            extra = dict(connections=self.stats.connections, requests=requests, errors=errors, bytes=sent,
+                         cache_bytes=self.cache.size, cache_hits=self.cache.hits, cache_misses=self.cache.misses)
+            if p50 is not None:
+                mesg = mesg + ' Latency:{:.2f}/{:.2f}/{:.2f}ms'.format(p50, p95, p99)
+                extra.update(latency_p50=p50, latency_p95=p95, latency_p99=p99)
+            self.writer.record(mesg, timestamp=now, flow='origin', kbps=kbps, **extra)
+
+    async def serve(self, address, port, backlog=4096):
+        server = await asyncio.start_server(self.handle, address, port, backlog=backlog, limit=MAX_HEAD)
+        print('Serving {} on http://{}:{}/'.format(self.root, address, port))
+        reporter = asyncio.ensure_future(self.report())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            reporter.cancel()
+            self.writer.close()
+
+def raise_nofile():
+    # One descriptor per player; take the hard limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP origin for DASH manifests and segments')
+    parser.add_argument('-r', '--root', default='dash_cache', help='Directory to serve.')
+    parser.add_argument('-a', '--address', default='0.0.0.0', help='Address to listen on.')
+    parser.add_argument('-p', '--port', type=int, default=8000, help='Port to listen on.')
+    parser.add_argument('--cache_size', type=float, default=256, help='MB of file contents kept in memory.')
+    parser.add_argument('--cache_item', type=float, default=8, help='Largest file in MB kept in memory; larger ones are sent with sendfile.')
+    parser.add_argument('--keepalive_timeout', type=float, default=30, help='Seconds an idle connection is kept open.')
+    parser.add_argument('-m', '--period', type=float, default=1.0, help='Seconds between stats lines.')
+    parser.add_argument('--statsfile', default=None, help='File to log stats to.')
+    parser.add_argument('--stats_format', default='text', choices=FORMATS, help='Stats output: text lines, or csv/ndjson with a fixed schema.')
+    parser.add_argument('--flush_interval', default=1.0, type=float, help='Seconds between stats flushes.')
+    args = parser.parse_args()
+
+    print('Open file limit {}'.format(raise_nofile()))
+    origin = Origin(args.root, cache_size=args.cache_size, cache_item=args.cache_item, keepalive_timeout=args.keepalive_timeout,
+                    period=args.period, stats_file=args.statsfile, stats_format=args.stats_format, flush_interval=args.flush_interval)
+    try:
+        asyncio.run(origin.serve(args.address, args.port))
+    except KeyboardInterrupt:
+        print('Exiting...')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GLib
+
+from DASHServer import Main, RATES, settings, ladder_args, ladder_from_args
+import Ladder
+
+Gst.init(None)
+
+# Offline DASH packaging: encode the rendition ladder once into fMP4 segments
+# and an MPD with dashsink, and keep the result in a content cache. The cache
+# directory is named by a hash of everything that affects the output, so a
+# later run with the same source and parameters finds it and costs nothing
+# but file I/O to serve.
+
+MANIFEST = 'manifest.mpd'
+PARAMS = 'params.json'
+
+def source_params(source):
+    # Stands in for the file's content in the cache key
+    if source == 'test':
+        return 'test'
+    st = os.stat(source)
+    return {'path': os.path.abspath(source), 'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+def package_params(source, rates=RATES, duration=60, framerate=30, segment=2, speed_preset=settings.speed_preset):
+    params = {
+        'source': source_params(source),
+        'rates': rates,
+        'framerate': framerate,
+        'segment': segment,
+        'speed_preset': speed_preset,
+    }
+    # A file is packaged whole, only the test source needs a length
+    if source == 'test':
+        params['duration'] = duration
+    return params
+
+def cache_key(params):
+    # Thread counts follow the host's cores, not the content: only name,
+    # geometry and bitrate of each rate go in, so hosts can share a cache
+    keyed = dict(params)
+    keyed['rates'] = [list(rate[:3]) for rate in params['rates']]
+    return hashlib.sha1(json.dumps(keyed, sort_keys=True).encode()).hexdigest()[:16]
+
+def cached(cache_dir, params):
+    # Directory holding the packaged content for params, or None. PARAMS is
+    # written last, so a half-built entry never matches.
+    path = os.path.join(cache_dir, cache_key(params))
+    if os.path.exists(os.path.join(path, PARAMS)):
+        return path
+    return None
+
+class Packager(Main):
+    # Same encoders as the live server, ending in dashsink instead of flvmux
+    # and rtmpsink, and running until the source ends instead of forever.
+    def __init__(self, source, params, out_dir, cpusets=None):
+        self.mainloop = GLib.MainLoop()
+        self.pipeline = Gst.Pipeline()
+        self.failed = False
+        self.profiler = None
+
+        self.bus = self.pipeline.get_bus()
+        self.bus.add_signal_watch()
+        self.bus.connect('message::error', self.on_error)
+        self.bus.connect('message::eos', self.on_eos)
+
+        fr = params['framerate']
+        # Keyframes on segment boundaries in every rendition
+        gop = fr * params['segment']
+
+        if source == 'test':
+            self.malm([
+                ['videotestsrc', None, {'num-buffers': params['duration'] * fr}],
+                ['capsfilter', None, {'caps': 'video/x-raw, width=1920, height=1080, framerate={}/1'.format(fr)}],
+                ['tee', 'vinput', {}]
+            ])
+        else:
+            self.malm([
+                ['uridecodebin', 'decode', {'uri': Gst.filename_to_uri(os.path.abspath(source))}],
+            ])
+            self.malm([
+                ['videoconvert', 'convert', {}],
+                ['deinterlace', None, {}],
+                ['videorate', None, {}],
+                ['capsfilter', None, {'caps': 'video/x-raw, framerate={}/1'.format(fr)}],
+                ['tee', 'vinput', {}]
+            ])
+            self.decode.connect('pad-added', self.on_pad_added)
+
+        self.dash = Gst.ElementFactory.make('dashsink', 'dash')
+        if not self.dash:
+            raise Exception('cannot create element dashsink (gst-plugins-bad)')
+        Gst.util_set_object_arg(self.dash, 'muxer', 'dashmp4')
+        self.dash.set_property('mpd-root-path', out_dir)
+        self.dash.set_property('mpd-filename', MANIFEST)
+        self.dash.set_property('target-duration', params['segment'])
+        self.pipeline.add(self.dash)
+
+        # Offline there is no real time to keep up with, only throughput
+        self.meter = Ladder.EncodeMeter(None)
+        for rate in params['rates']:
+            self.malm([
+                ['queue', 'v{}'.format(rate[0]), {'max-size-buffers': settings.queue_frames, 'max-size-bytes': 0, 'max-size-time': 0}],
+                ['videoscale', None, {}],
+                ['capsfilter', None, {'caps': rate[1]}],
+                ['x264enc', 'e{}'.format(rate[0]), {
+                    'speed-preset': params['speed_preset'],
+                    'bitrate': rate[2],
+                    'threads': rate[3],
+                    'key-int-max': gop,
+                    'option-string': 'scenecut=0'
+                }],
+                ['capsfilter', None, {'caps': 'video/x-h264, profile=baseline'}],
+                ['h264parse', 'p{}'.format(rate[0]), {}],
+            ])
+            self.vinput.link(getattr(self, 'v{}'.format(rate[0])))
+            pad = self.dash.get_request_pad('video_%u')
+            getattr(self, 'p{}'.format(rate[0])).get_static_pad('src').link(pad)
+            self.meter.attach(rate[0], getattr(self, 'e{}'.format(rate[0])))
+            if cpusets:
+                Ladder.pin_thread(getattr(self, 'v{}'.format(rate[0])).get_static_pad('src'), cpusets[rate[0]])
+
+    def on_pad_added(self, element, pad):
+        caps = pad.get_current_caps() or pad.query_caps(None)
+        if caps.get_structure(0).get_name().startswith('video/'):
+            pad.link(self.convert.get_static_pad('sink'))
+
+    def run(self):
+        self.pipeline.set_state(Gst.State.PLAYING)
+        GLib.timeout_add(settings.stats_interval * 1000, self.do_stats, None)
+        self.mainloop.run()
+        self.pipeline.set_state(Gst.State.NULL)
+        return not self.failed
+
+    def on_eos(self, bus, msg):
+        self.mainloop.quit()
+
+    def on_error(self, bus, msg):
+        print('on_error', msg.parse_error())
+        self.failed = True
+        self.mainloop.quit()
+
+def package(source, params, cache_dir, force=False, cpusets=None):
+    # Returns the directory with the MPD and segments, encoding if needed
+    path = cached(cache_dir, params)
+    if path and not force:
+        print('Using cached package {}'.format(path))
+        return path
+    path = os.path.join(cache_dir, cache_key(params))
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    print('Packaging {} into {}'.format(source, path))
+    start = time.time()
+    if not Packager(source, params, tmp, cpusets).run():
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise Exception('packaging {} failed'.format(source))
+    with open(os.path.join(tmp, PARAMS), 'w') as f:
+        json.dump(params, f, indent=2, sort_keys=True)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp, path)
+    print('Packaged in {:.1f}s'.format(time.time() - start))
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description='Encode the DASH ladder once into a segment cache')
+    parser.add_argument('-s', '--source', default='test', help='Video file to package, or "test" for videotestsrc.')
+    parser.add_argument('-d', '--duration', type=int, default=60, help='Seconds of test source to package.')
+    parser.add_argument('-f', '--framerate', type=int, default=30, help='Output framerate.')
+    parser.add_argument('-g', '--segment', type=int, default=2, help='Segment duration in seconds.')
+    parser.add_argument('-c', '--cache_dir', default='dash_cache', help='Content cache directory.')
+    parser.add_argument('--force', action='store_true', default=False, help='Encode again even if cached.')
+    ladder_args(parser)
+    args = parser.parse_args()
+
+    rates, cpusets = ladder_from_args(args)
+    params = package_params(args.source, rates=rates, duration=args.duration, framerate=args.framerate, segment=args.segment, speed_preset=args.speed_preset)
+    path = package(args.source, params, args.cache_dir, force=args.force, cpusets=cpusets)
+    print(os.path.join(path, MANIFEST))
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,46 @@
+import os
+import sys
+import time
+import argparse
 import gi
 gi.require_version('Gst', '1.0')
 gi.require_version('GstVideo', '1.0')
 from gi.repository import Gst, GstVideo, GLib
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RTPGenerator'))
+from PipelineProfiler import PipelineProfiler
+import Ladder
+from SourceRing import SourceRing
+
 Gst.init(None)
 
 class settings:
     stream_location = 'rtmp://127.0.0.1/dash/streamname_'
+    source_location = './jellyfish-25-mbps-hd-hevc.mpg'
+    # Seconds of prepared source frames to loop from memory; 0 reads and
+    # converts the file continuously
+    ring_seconds = 0
     speed_preset = 3
     amplification = 4
+    # Print per-element processing times and queue levels every
+    # profile_interval seconds
+    profile = False
+    profile_interval = 5
+    # Raw frames queued ahead of each encoder
+    queue_frames = 8
+    # Print each rendition's encode FPS every stats_interval seconds
+    stats_interval = 5
+
+# Rendition ladder: name, caps, x264 bitrate (kbps), x264 threads (0 to
+# share the cores out, see Ladder.allocate_threads)
+RATES = [
+    ['low', 'video/x-raw, width=640, height=360', 500, 0],
+    ['med', 'video/x-raw, width=1280, height=720', 1500, 0],
+    ['high', 'video/x-raw, width=1920, height=1080', 5000, 0]
+]
 
 class Main:
-    def __init__(self):
+    def __init__(self, rates=RATES, cpusets=None):
         self.mainloop = GLib.MainLoop()
 
         self.pipeline = Gst.Pipeline()
@@ -22,33 +51,41 @@ class Main:
         self.bus.add_signal_watch()
         self.bus.connect('message::error', self.on_error)
 
-        rates = [
-            ['low', 'video/x-raw, width=640, height=360', 500, 3],
-            ['med', 'video/x-raw, width=1280, height=720', 1500, 3],
-            ['high', 'video/x-raw, width=1920, height=1080', 5000, 4]
-        ]
-
         # Video input
         # filesrc location=result.mp4 ! decodebin2 ! ffmpegcolorspace ! video/x-raw-rgb ! avimux !
-        self.malm([
-            ['multifilesrc', None, {'location': './jellyfish-25-mbps-hd-hevc.mpg', 'loop':'true'}],
-            ['videoparse', None, {'width':1920,'height':1080, 'framerate':Gst.Fraction(30, 1)}],
-            #['videotestsrc', None, {}],
-            ['capsfilter', None, {'caps': 'video/x-raw, width=1920, height=1080'}],
-            ['videoconvert', None, {}],
-            ['deinterlace', None, {}],
-            ['videorate', None, {}],
-            ['capsfilter', None, {'caps': 'video/x-raw, framerate=30000/1001' }],
-            ['tee', 'vinput', {}]
-        ])
+        if settings.ring_seconds > 0:
+            # The same chain run once, then frames looped from memory
+            self.ring = SourceRing(
+                'filesrc location="{}" ! videoparse width=1920 height=1080 framerate=30/1 ! '
+                'video/x-raw, width=1920, height=1080 ! videoconvert ! deinterlace ! videorate'.format(settings.source_location),
+                'video/x-raw, framerate=30000/1001', settings.ring_seconds)
+            self.ring.prepare()
+            self.malm([
+                ['appsrc', 'ringsrc', {}],
+                ['tee', 'vinput', {}]
+            ])
+            self.ring.attach(self.ringsrc)
+        else:
+            self.malm([
+                ['multifilesrc', None, {'location': settings.source_location, 'loop':'true'}],
+                ['videoparse', None, {'width':1920,'height':1080, 'framerate':Gst.Fraction(30, 1)}],
+                #['videotestsrc', None, {}],
+                ['capsfilter', None, {'caps': 'video/x-raw, width=1920, height=1080'}],
+                ['videoconvert', None, {}],
+                ['deinterlace', None, {}],
+                ['videorate', None, {}],
+                ['capsfilter', None, {'caps': 'video/x-raw, framerate=30000/1001' }],
+                ['tee', 'vinput', {}]
+            ])
 
         # Create each encoder, muxer, and rtmpsink.
+        self.meter = Ladder.EncodeMeter(30000 / 1001.0)
         for rate in rates:
             self.malm([
-                ['queue', 'v{}'.format(rate[0]), {'max-size-bytes': 104857600}],
+                ['queue', 'v{}'.format(rate[0]), {'max-size-buffers': settings.queue_frames, 'max-size-bytes': 0, 'max-size-time': 0}],
                 ['videoscale', None, {}],
                 ['capsfilter', None, {'caps': rate[1]}],
-                ['x264enc', None, {
+                ['x264enc', 'e{}'.format(rate[0]), {
                     'speed-preset': settings.speed_preset,
                     'tune': 'zerolatency',
                     'bitrate': rate[2],
@@ -62,10 +99,20 @@ class Main:
             ])
 
             self.vinput.link(getattr(self, 'v{}'.format(rate[0])))
+            self.meter.attach(rate[0], getattr(self, 'e{}'.format(rate[0])))
+            if cpusets:
+                Ladder.pin_thread(getattr(self, 'v{}'.format(rate[0])).get_static_pad('src'), cpusets[rate[0]])
+
+        self.profiler = None
+        if settings.profile:
+            self.profiler = PipelineProfiler(self.pipeline)
 
     def run(self):
         self.pipeline.set_state(Gst.State.PLAYING)
         GLib.timeout_add(2 * 1000, self.do_keyframe, None)
+        GLib.timeout_add(settings.stats_interval * 1000, self.do_stats, None)
+        if self.profiler:
+            GLib.timeout_add(settings.profile_interval * 1000, self.do_profile, None)
         self.mainloop.run()
 
     def stop(self): 
@@ -81,6 +128,14 @@ class Main:
 
         return True
 
+    def do_stats(self, user_data):
+        print('{}{}'.format(time.time(), self.meter.report()))
+        return True
+
+    def do_profile(self, user_data):
+        print('{}{}'.format(time.time(), self.profiler.report()[0]))
+        return True
+
     def on_error(self, bus, msg):
         print('on_error', msg.parse_error())
 
@@ -107,8 +162,44 @@ class Main:
 
             prev = element
 
-main = Main()
-try:
-    main.run()
-except KeyboardInterrupt:
-    main.stop()
+def ladder_args(parser):
+    # Ladder options shared with DASHPackager
+    parser.add_argument('-L', '--ladder', action='append', default=[], help='Rendition name:WIDTHxHEIGHT:bitrate[:threads] (repeatable). Replaces the default ladder.')
+    parser.add_argument('--ladder_file', default=None, help='File with one rendition per line, as for -L.')
+    parser.add_argument('--speed_preset', type=int, default=settings.speed_preset, help='x264 speed preset (1 ultrafast to 10 placebo).')
+    parser.add_argument('--threads', default='proportional', choices=Ladder.THREAD_MODES, help='fixed: as the ladder says; proportional: share the cores by pixel count; pinned: also pin each encoder to its own CPUs.')
+    parser.add_argument('--cores', type=int, default=None, help='Cores to share between the encoders (default: all this process may use).')
+
+def ladder_from_args(args):
+    # (rates, cpusets) for the parsed ladder options
+    rates = [Ladder.parse_rendition(spec) for spec in args.ladder]
+    if args.ladder_file:
+        rates.extend(Ladder.read_ladder(args.ladder_file))
+    if len(rates) == 0:
+        rates = RATES
+    rates, cpusets = Ladder.allocate_threads(rates, cores=args.cores, mode=args.threads)
+    for line in Ladder.describe(rates, cpusets):
+        print(line)
+    return rates, cpusets
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Live DASH ladder encoded from one source and pushed over RTMP')
+    ladder_args(parser)
+    parser.add_argument('-s', '--source', default=settings.source_location, help='Raw 1080p30 source file.')
+    parser.add_argument('-R', '--ring', type=float, default=settings.ring_seconds, help='Prepare this many seconds of source once and loop them from memory (0 to read the file continuously).')
+    parser.add_argument('--queue_frames', type=int, default=settings.queue_frames, help='Raw frames queued ahead of each encoder.')
+    parser.add_argument('--stats_interval', type=int, default=settings.stats_interval, help='Seconds between encode FPS reports.')
+    parser.add_argument('--profile', action='store_true', default=settings.profile, help='Also report per-element processing times and queue levels.')
+    args = parser.parse_args()
+    settings.speed_preset = args.speed_preset
+    settings.source_location = args.source
+    settings.ring_seconds = args.ring
+    settings.queue_frames = args.queue_frames
+    settings.stats_interval = args.stats_interval
+    settings.profile = args.profile
+
+    main = Main(*ladder_from_args(args))
+    try:
+        main.run()
+    except KeyboardInterrupt:
+        main.stop()
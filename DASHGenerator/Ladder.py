@@ -0,0 +1,155 @@
+import os
+import re
+import time
+import threading
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+# Rendition ladders for the DASH encoders: parsing them from the command
+# line or a file, sharing the machine's cores out between the x264
+# encoders, and measuring how fast each rendition is actually encoded.
+#
+# A ladder is a list of [name, caps, x264 bitrate (kbps), x264 threads] as
+# in DASHServer.RATES, threads 0 meaning "allocate for me".
+
+THREAD_MODES = ['fixed', 'proportional', 'pinned']
+
+def parse_rendition(spec):
+    # name:WIDTHxHEIGHT:bitrate[:threads]
+    fields = spec.strip().split(':')
+    if len(fields) < 3 or len(fields) > 4 or fields[0] == '':
+        raise ValueError("Bad rendition '{}', expected name:WIDTHxHEIGHT:bitrate[:threads]".format(spec))
+    width, height = [int(v) for v in fields[1].lower().split('x')]
+    threads = int(fields[3]) if len(fields) > 3 and fields[3] != '' else 0
+    return [fields[0], 'video/x-raw, width={}, height={}'.format(width, height), int(fields[2]), threads]
+
+def read_ladder(path):
+    rates = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line != '':
+                rates.append(parse_rendition(line))
+    return rates
+
+def geometry(rate):
+    width = re.search(r'width=(\d+)', rate[1])
+    height = re.search(r'height=(\d+)', rate[1])
+    if not width or not height:
+        raise ValueError('No width and height in {}'.format(rate[1]))
+    return int(width.group(1)), int(height.group(1))
+
+def available_cores():
+    # CPUs this process may run on, which is less than the machine's under
+    # taskset or a container CPU set
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+def allocate_threads(rates, cores=None, mode='proportional'):
+    # (rates with threads filled in, {name: [cpu]} or None). Renditions
+    # that name their threads keep them; the remaining cores are shared
+    # between the rest in proportion to pixels per frame (the framerate is
+    # the same for all), at least one each. 'fixed' keeps the ladder as it
+    # is; 'pinned' also gives every rendition its own run of CPUs.
+    if cores is None:
+        cores = available_cores()
+    elif isinstance(cores, int):
+        cores = available_cores()[:cores]
+    rates = [list(rate) for rate in rates]
+    if mode == 'fixed':
+        return rates, None
+    if mode not in THREAD_MODES:
+        raise ValueError('Unknown thread mode {}'.format(mode))
+
+    auto = [rate for rate in rates if rate[3] <= 0]
+    left = max(len(cores) - sum(rate[3] for rate in rates if rate[3] > 0), len(auto))
+    pixels = dict((rate[0], geometry(rate)[0] * geometry(rate)[1]) for rate in auto)
+    total = sum(pixels.values())
+    shares = dict()
+    for rate in auto:
+        share = left * pixels[rate[0]] / float(total)
+        shares[rate[0]] = share
+        rate[3] = max(1, int(share))
+    # Whole cores left over go to the largest remainders
+    spare = left - sum(rate[3] for rate in auto)
+    for rate in sorted(auto, key=lambda r: shares[r[0]] - int(shares[r[0]]), reverse=True):
+        if spare <= 0:
+            break
+        rate[3] += 1
+        spare -= 1
+
+    if mode != 'pinned':
+        return rates, None
+    # Consecutive CPUs per rendition, wrapping round if the ladder wants
+    # more threads than there are cores
+    cpusets = dict()
+    next_cpu = 0
+    for rate in rates:
+        cpusets[rate[0]] = sorted(set(cores[(next_cpu + i) % len(cores)] for i in range(rate[3])))
+        next_cpu += rate[3]
+    return rates, cpusets
+
+def describe(rates, cpusets=None):
+    lines = []
+    for rate in rates:
+        width, height = geometry(rate)
+        line = '{} {}x{} {}kbps threads:{}'.format(rate[0], width, height, rate[2], rate[3])
+        if cpusets:
+            line = line + ' cpus:{}'.format(','.join(str(cpu) for cpu in cpusets[rate[0]]))
+        lines.append(line)
+    return lines
+
+def pin_thread(pad, cpus):
+    # Pins the streaming thread behind pad to cpus, from inside that thread
+    # and before the first caps reach the encoder, so the worker threads x264
+    # starts when it opens inherit the same CPUs.
+    def pin(pad, info):
+        os.sched_setaffinity(0, cpus)
+        return Gst.PadProbeReturn.REMOVE
+    pad.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM | Gst.PadProbeType.BUFFER, pin)
+
+class EncodeMeter:
+    # Frames out of each encoder per second, against the framerate the
+    # ladder has to keep up with
+    def __init__(self, target_fps):
+        self.target_fps = target_fps
+        self.lock = threading.Lock()
+        self.frames = dict()
+        self.names = []
+        self.last = time.time()
+
+    def attach(self, name, encoder):
+        self.names.append(name)
+        self.frames[name] = 0
+        encoder.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, self.frame_out, name)
+
+    def frame_out(self, pad, info, name):
+        with self.lock:
+            self.frames[name] += 1
+        return Gst.PadProbeReturn.OK
+
+    def sample(self):
+        # [(name, fps)] since the last call
+        now = time.time()
+        elapsed = now - self.last
+        self.last = now
+        with self.lock:
+            counts = [(name, self.frames[name]) for name in self.names]
+            for name in self.names:
+                self.frames[name] = 0
+        if elapsed <= 0:
+            return [(name, 0.0) for name, count in counts]
+        return [(name, count / elapsed) for name, count in counts]
+
+    def report(self):
+        # Text for a stats line, flagging renditions below real time
+        parts = []
+        for name, fps in self.sample():
+            part = '{}={:.1f}'.format(name, fps)
+            if self.target_fps and fps < 0.95 * self.target_fps:
+                part = part + '(behind)'
+            parts.append(part)
+        return ' EncodeFPS:' + ','.join(parts)
@@ -0,0 +1,568 @@
+import os
+import re
+import sys
+import math
+import time
+import asyncio
+import argparse
+import importlib
+import xml.etree.ElementTree as ET
+from urllib.parse import urljoin, urlsplit
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RTPGenerator'))
+from FlowStats import percentiles
+from StatsWriter import StatsWriter, FORMATS
+
+# Headless DASH players: many virtual viewers in one process on one asyncio
+# loop. Each fetches the MPD, then segments at the rendition its ABR picks,
+# and plays them out against the wall clock without decoding anything, so
+# the buffer, startup delay, stalls and bitrate switches are what a real
+# player on the same network would have seen.
+
+# Player states
+STATES = ['pending', 'startup', 'playing', 'stalled', 'done', 'failed']
+
+# Largest response head accepted
+MAX_HEAD = 16384
+
+class Representation:
+
+    def __init__(self, id, bandwidth, width=None, height=None):
+        self.id = id
+        self.bandwidth = bandwidth
+        self.width = width
+        self.height = height
+        self.init = None
+        # [(url, seconds)]
+        self.segments = []
+
+    def describe(self):
+        if self.width:
+            return '{}x{}@{}kbps'.format(self.width, self.height, self.bandwidth // 1000)
+        return '{}@{}kbps'.format(self.id, self.bandwidth // 1000)
+
+def local(tag):
+    return tag.split('}')[-1]
+
+def children(element, name):
+    return [e for e in element if local(e.tag) == name]
+
+def child(element, name):
+    found = children(element, name)
+    return found[0] if found else None
+
+def parse_duration(text):
+    # ISO 8601 duration as used in MPDs (PT1H2M3.5S), in seconds
+    if not text:
+        return None
+    match = re.match(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?)?$', text.strip())
+    if not match:
+        return None
+    days, hours, minutes, seconds = match.groups()
+    return int(days or 0) * 86400 + int(hours or 0) * 3600 + int(minutes or 0) * 60 + float(seconds or 0)
+
+def expand(template, rep, number=None, start=None):
+    def field(match):
+        name, fmt = match.group(1), match.group(2) or '%d'
+        if name == '':
+            return '$'
+        if name == 'RepresentationID':
+            return rep.id
+        if name == 'Bandwidth':
+            return fmt % rep.bandwidth
+        if name == 'Number':
+            return fmt % number
+        if name == 'Time':
+            return fmt % start
+        return match.group(0)
+    return re.sub(r'\$(\w*)(%0\d+d)?\$', field, template)
+
+def base_url(url, *elements):
+    # Applies the BaseURL of each element in turn
+    for element in elements:
+        base = child(element, 'BaseURL') if element is not None else None
+        if base is not None and base.text:
+            url = urljoin(url, base.text.strip())
+    return url
+
+def segment_attributes(name, *elements):
+    # SegmentTemplate/SegmentList attributes, inner elements overriding outer
+    attributes = dict()
+    found = None
+    for element in elements:
+        segment = child(element, name)
+        if segment is not None:
+            attributes.update(segment.attrib)
+            found = segment
+    return attributes, found
+
+def parse_mpd(text, url):
+    # (duration in seconds, [Representation] by bandwidth) for the first
+    # period's video, or all of it if nothing is marked as video
+    mpd = ET.fromstring(text)
+    total = parse_duration(mpd.get('mediaPresentationDuration'))
+    period = child(mpd, 'Period')
+    if period is None:
+        raise ValueError('MPD has no Period')
+    if total is None:
+        total = parse_duration(period.get('duration'))
+    sets = children(period, 'AdaptationSet')
+    video = [s for s in sets if 'video' in (s.get('mimeType', '') + s.get('contentType', '')) or s.get('maxWidth') or any(r.get('width') for r in children(s, 'Representation'))]
+    reps = []
+    for adaptation in video or sets:
+        for element in children(adaptation, 'Representation'):
+            rep = Representation(element.get('id'), int(element.get('bandwidth', 0)),
+                                 element.get('width') or adaptation.get('width'), element.get('height') or adaptation.get('height'))
+            rep_url = base_url(url, mpd, period, adaptation, element)
+            template, found = segment_attributes('SegmentTemplate', period, adaptation, element)
+            if found is not None:
+                template_segments(rep, rep_url, template, found, total)
+            else:
+                listed, found = segment_attributes('SegmentList', period, adaptation, element)
+                if found is None:
+                    # A single file for the whole representation
+                    rep.segments = [(rep_url, total or 0)]
+                else:
+                    list_segments(rep, rep_url, listed, found)
+            reps.append(rep)
+    if not reps:
+        raise ValueError('MPD has no Representations')
+    reps.sort(key=lambda r: r.bandwidth)
+    return total, reps
+
+def template_segments(rep, url, attributes, element, total):
+    timescale = float(attributes.get('timescale', 1))
+    number = int(attributes.get('startNumber', 1))
+    if 'initialization' in attributes:
+        rep.init = urljoin(url, expand(attributes['initialization'], rep))
+    media = attributes['media']
+    timeline = child(element, 'SegmentTimeline')
+    if timeline is not None:
+        start = 0
+        for s in children(timeline, 'S'):
+            start = int(s.get('t', start))
+            duration = int(s.get('d'))
+            for i in range(int(s.get('r', 0)) + 1):
+                rep.segments.append((urljoin(url, expand(media, rep, number, start)), duration / timescale))
+                start += duration
+                number += 1
+        return
+    duration = int(attributes['duration']) / timescale
+    for i in range(int(math.ceil((total or 0) / duration))):
+        rep.segments.append((urljoin(url, expand(media, rep, number + i, int(i * duration * timescale))), duration))
+
+def list_segments(rep, url, attributes, element):
+    timescale = float(attributes.get('timescale', 1))
+    duration = int(attributes.get('duration', 0)) / timescale
+    init = child(element, 'Initialization')
+    if init is not None and init.get('sourceURL'):
+        rep.init = urljoin(url, init.get('sourceURL'))
+    for segment in children(element, 'SegmentURL'):
+        rep.segments.append((urljoin(url, segment.get('media')), duration))
+
+class HTTPError(Exception):
+    pass
+
+class Connection:
+    # One keep-alive HTTP/1.1 connection, reopened when the server closes it
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def get(self, url, keep=True):
+        # (body or None, bytes); the body is only kept if asked for
+        for attempt in range(2):
+            fresh = self.writer is None
+            if fresh:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=MAX_HEAD)
+            try:
+                return await self.request(url, keep)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                # A reused connection may have timed out on the server
+                if fresh:
+                    raise
+
+    async def request(self, url, keep):
+        parts = urlsplit(url)
+        target = parts.path + ('?' + parts.query if parts.query else '')
+        self.writer.write('GET {} HTTP/1.1\r\nHost: {}\r\nConnection: keep-alive\r\n\r\n'.format(target or '/', parts.netloc).encode('latin-1'))
+        await self.writer.drain()
+        head = (await self.reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+        status = int(head[0].split()[1])
+        headers = dict()
+        for line in head[1:]:
+            name, _, value = line.partition(':')
+            if name:
+                headers[name.strip().lower()] = value.strip()
+        body = []
+        size = 0
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                length = int((await self.reader.readline()).split(b';')[0], 16)
+                if length == 0:
+                    await self.reader.readline()
+                    break
+                size += await self.read(length, body if keep else None)
+                await self.reader.readline()
+        elif 'content-length' in headers:
+            size = await self.read(int(headers['content-length']), body if keep else None)
+        else:
+            size = await self.read(None, body if keep else None)
+            self.close()
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        if status >= 400:
+            raise HTTPError('{} for {}'.format(status, url))
+        return (b''.join(body) if keep else None), size
+
+    async def read(self, length, body):
+        # Reads length bytes (None to end of stream) in chunks
+        size = 0
+        while length is None or size < length:
+            chunk = await self.reader.read(65536 if length is None else min(65536, length - size))
+            if not chunk:
+                if length is None:
+                    break
+                raise asyncio.IncompleteReadError(b'', length - size)
+            size += len(chunk)
+            if body is not None:
+                body.append(chunk)
+        return size
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+class ThroughputABR:
+    # Highest rendition below a safety fraction of the harmonic mean of the
+    # last few segment download rates
+    def __init__(self, safety=0.8, window=5):
+        self.safety = safety
+        self.window = window
+
+    def choose(self, player):
+        if not player.throughputs:
+            return 0
+        recent = player.throughputs[-self.window:]
+        estimate = len(recent) / sum(1.0 / t for t in recent)
+        chosen = 0
+        for i, rep in enumerate(player.reps):
+            if rep.bandwidth <= self.safety * estimate:
+                chosen = i
+        return chosen
+
+class BufferABR:
+    # Buffer-based: lowest rendition while the buffer is under the
+    # reservoir, highest above reservoir + cushion, linear in between
+    def __init__(self, reservoir=5.0, cushion=10.0):
+        self.reservoir = reservoir
+        self.cushion = cushion
+
+    def choose(self, player):
+        if player.buffer <= self.reservoir:
+            return 0
+        if player.buffer >= self.reservoir + self.cushion:
+            return len(player.reps) - 1
+        low = player.reps[0].bandwidth
+        high = player.reps[-1].bandwidth
+        target = low + (high - low) * (player.buffer - self.reservoir) / self.cushion
+        chosen = 0
+        for i, rep in enumerate(player.reps):
+            if rep.bandwidth <= target:
+                chosen = i
+        return chosen
+
+class FixedABR:
+    # Always the same rendition (0 is the lowest, -1 the highest)
+    def __init__(self, index=-1):
+        self.index = index
+
+    def choose(self, player):
+        return self.index % len(player.reps)
+
+ABRS = dict(throughput=ThroughputABR, buffer=BufferABR, lowest=lambda: FixedABR(0), highest=lambda: FixedABR(-1))
+
+def make_abr(name):
+    # One of ABRS, or module.Class for an ABR of your own with choose(player)
+    if name in ABRS:
+        return ABRS[name]()
+    module, _, cls = name.rpartition('.')
+    if not module:
+        raise ValueError('Unknown ABR {}, expected one of {} or module.Class'.format(name, ', '.join(sorted(ABRS))))
+    return getattr(importlib.import_module(module), cls)()
+
+class Player:
+
+    def __init__(self, index, url, abr, max_buffer=30.0, resume=2.0, loop=False):
+        self.index = index
+        self.url = url
+        self.abr = abr
+        self.max_buffer = max_buffer
+        self.resume = resume
+        self.loop = loop
+        self.state = 'pending'
+        self.error = None
+        self.connections = dict()
+        self.reps = []
+        self.current = None
+        # Seconds of media downloaded but not yet played
+        self.buffer = 0.0
+        self.clock = None
+        self.started = None
+        self.stalled_at = None
+        # Set once the last segment is in, so running dry is the end
+        self.ended = False
+        self.startup_delay = None
+        self.throughputs = []
+        self.rebuffers = 0
+        self.rebuffer_time = 0.0
+        self.switches = 0
+        self.bytes = 0
+        self.segments = 0
+        self.media_time = 0.0
+        self.weighted_bitrate = 0.0
+        self.last = dict(bytes=0, segments=0, rebuffers=0, switches=0, rebuffer_time=0.0)
+
+    def connection(self, url):
+        parts = urlsplit(url)
+        key = (parts.hostname, parts.port or 80)
+        if key not in self.connections:
+            self.connections[key] = Connection(*key)
+        return self.connections[key]
+
+    async def fetch(self, url, keep=True):
+        body, size = await self.connection(url).get(url, keep)
+        self.bytes += size
+        return body, size
+
+    def advance(self, now):
+        # Plays out the buffer up to now, stalling if it runs dry
+        elapsed = now - self.clock
+        self.clock = now
+        if self.state != 'playing':
+            return
+        if elapsed >= self.buffer and self.ended:
+            self.buffer = 0.0
+            self.state = 'done'
+        elif elapsed >= self.buffer:
+            self.stalled_at = now - (elapsed - self.buffer)
+            self.buffer = 0.0
+            self.state = 'stalled'
+            self.rebuffers += 1
+        else:
+            self.buffer -= elapsed
+
+    def buffered(self, now, seconds):
+        self.advance(now)
+        self.buffer += seconds
+        if self.state == 'startup' and self.buffer >= self.resume:
+            self.startup_delay = now - self.started
+            self.state = 'playing'
+        elif self.state == 'stalled' and self.buffer >= self.resume:
+            self.rebuffer_time += now - self.stalled_at
+            self.state = 'playing'
+
+    def stalled_for(self, now):
+        # Rebuffering time including a stall still in progress
+        if self.state == 'stalled':
+            return self.rebuffer_time + now - self.stalled_at
+        return self.rebuffer_time
+
+    async def run(self):
+        self.started = self.clock = time.time()
+        self.state = 'startup'
+        try:
+            body, size = await self.fetch(self.url)
+            duration, self.reps = parse_mpd(body, self.url)
+            while True:
+                await self.play()
+                if not self.loop:
+                    break
+            # Play out what is left
+            await asyncio.sleep(self.buffer)
+            self.advance(time.time())
+            self.state = 'done'
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.state = 'failed'
+            self.error = '{}: {}'.format(type(e).__name__, e)
+        finally:
+            for connection in self.connections.values():
+                connection.close()
+
+    async def play(self):
+        inits = dict()
+        for number in range(len(self.reps[0].segments)):
+            # Hold off while the buffer is full
+            self.advance(time.time())
+            if self.buffer > self.max_buffer:
+                await asyncio.sleep(self.buffer - self.max_buffer)
+                self.advance(time.time())
+
+            chosen = self.abr.choose(self)
+            if self.current is not None and chosen != self.current:
+                self.switches += 1
+            self.current = chosen
+            rep = self.reps[chosen]
+            if rep.init and rep.id not in inits:
+                await self.fetch(rep.init)
+                inits[rep.id] = True
+
+            url, seconds = rep.segments[min(number, len(rep.segments) - 1)]
+            start = time.time()
+            body, size = await self.fetch(url, keep=False)
+            now = time.time()
+            self.throughputs.append(size * 8 / max(now - start, 1e-6))
+            del self.throughputs[:-20]
+            self.segments += 1
+            self.media_time += seconds
+            self.weighted_bitrate += rep.bandwidth * seconds
+            self.buffered(now, seconds)
+        if not self.loop:
+            self.ended = True
+            # With nothing more to fetch, whatever is buffered plays out
+            if self.state == 'stalled':
+                now = time.time()
+                self.rebuffer_time += now - self.stalled_at
+                self.clock = now
+                self.state = 'playing'
+
+    def interval(self, now):
+        # Counter deltas since the previous call
+        current = dict(bytes=self.bytes, segments=self.segments, rebuffers=self.rebuffers, switches=self.switches, rebuffer_time=self.stalled_for(now))
+        delta = dict([(name, current[name] - self.last[name]) for name in current])
+        self.last = current
+        return delta
+
+    def bitrate(self):
+        # Mean bitrate of the media fetched so far, kbps
+        if self.media_time == 0:
+            return 0.0
+        return self.weighted_bitrate / self.media_time / 1000
+
+class PlayerSim:
+
+    def __init__(self, url, players=10, ramp=1.0, timeout=60, period=1.0, abr='throughput', max_buffer=30.0, resume=2.0, loop=False, per_player=True, stats_file=None, stats_format='text', flush_interval=1.0):
+        self.ramp = ramp
+        self.timeout = timeout
+        self.period = period
+        self.per_player = per_player
+        self.writer = StatsWriter(stats_file, format=stats_format, flush_interval=flush_interval)
+        self.players = [Player(i, url, make_abr(abr), max_buffer=max_buffer, resume=resume, loop=loop) for i in range(players)]
+
+    async def start_players(self):
+        tasks = []
+        for player in self.players:
+            tasks.append(asyncio.ensure_future(player.run()))
+            if self.ramp > 0:
+                await asyncio.sleep(1.0 / self.ramp)
+        await asyncio.gather(*tasks)
+
+    def update_stats(self, elapsed):
+        now = time.time()
+        ts = str(now)
+        states = dict()
+        total = dict(bytes=0, segments=0, rebuffers=0, switches=0, rebuffer_time=0.0)
+        for player in self.players:
+            states[player.state] = states.get(player.state, 0) + 1
+            if player.state == 'pending':
+                continue
+            if player.clock is not None:
+                player.advance(now)
+            delta = player.interval(now)
+            for name in total:
+                total[name] = total[name] + delta[name]
+            if self.per_player:
+                kbps = delta['bytes'] * 8 / elapsed / 1000
+                rendition = player.reps[player.current].describe() if player.current is not None else '-'
+                mesg = '{} Player:{} State:{} Rendition:{} Buffer:{:.1f}s Rate:{:.0f}kbps Rebuffers:{} Switches:{}'.format(ts, player.index, player.state, rendition, player.buffer, kbps, delta['rebuffers'], delta['switches'])
+                self.writer.record(mesg, timestamp=now, flow=player.index, kbps=kbps, state=player.state, buffer_s=player.buffer,
+                                   bitrate=player.bitrate(), rebuffers=delta['rebuffers'], rebuffer_s=delta['rebuffer_time'], switches=delta['switches'])
+
+        # Aggregate, with QoE over all players so far
+        active = [p for p in self.players if p.state in ('playing', 'stalled')]
+        kbps = total['bytes'] * 8 / elapsed / 1000
+        mean_buffer = sum(p.buffer for p in active) / len(active) if active else 0.0
+        started = [p for p in self.players if p.state != 'pending']
+        mean_bitrate = sum(p.bitrate() for p in started) / len(started) if started else 0.0
+        p50, p95 = percentiles([p.startup_delay * 1000 for p in self.players if p.startup_delay is not None], (50, 95))
+        extra = dict(players=len(self.players), mean_buffer_s=mean_buffer, mean_bitrate=mean_bitrate, rebuffers=total['rebuffers'],
+                     rebuffer_s=total['rebuffer_time'], switches=total['switches'], segments=total['segments'])
+        for state in STATES:
+            extra[state] = states.get(state, 0)
+        mesg = '{} All Playing:{}/{} Stalled:{} Failed:{} Rate:{:.0f}kbps MeanBitrate:{:.0f}kbps MeanBuffer:{:.1f}s Rebuffers:{} Switches:{}'.format(
+            ts, states.get('playing', 0), len(self.players), states.get('stalled', 0), states.get('failed', 0), kbps, mean_bitrate, mean_buffer, total['rebuffers'], total['switches'])
+        if p50 is not None:
+            extra['startup_p50_ms'] = p50
+            extra['startup_p95_ms'] = p95
+            mesg = mesg + ' Startup:{:.0f}/{:.0f}ms'.format(p50, p95)
+        self.writer.record(mesg, timestamp=now, flow='all', kbps=kbps, **extra)
+
+    async def report(self):
+        last = time.time()
+        while True:
+            await asyncio.sleep(self.period)
+            now = time.time()
+            self.update_stats(now - last)
+            last = now
+
+    def summary(self):
+        # Per-player QoE at the end of the run
+        now = time.time()
+        for player in self.players:
+            if player.state == 'pending':
+                continue
+            if player.state == 'failed':
+                self.writer.message('Player:{} failed: {}'.format(player.index, player.error))
+                continue
+            startup = player.startup_delay * 1000 if player.startup_delay is not None else None
+            mesg = '{} Player:{} Summary Startup:{} Rebuffers:{} Rebuffering:{:.1f}s Switches:{} MeanBitrate:{:.0f}kbps Segments:{}'.format(
+                now, player.index, '-' if startup is None else '{:.0f}ms'.format(startup), player.rebuffers, player.stalled_for(now), player.switches, player.bitrate(), player.segments)
+            self.writer.record(mesg, timestamp=now, flow=player.index, state='summary', startup_ms=startup, rebuffers=player.rebuffers,
+                               rebuffer_s=player.stalled_for(now), switches=player.switches, bitrate=player.bitrate(), segments=player.segments)
+
+    async def run(self):
+        print('Starting {} players on {}'.format(len(self.players), self.players[0].url))
+        reporter = asyncio.ensure_future(self.report())
+        try:
+            await asyncio.wait_for(self.start_players(), self.timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            reporter.cancel()
+            self.summary()
+            self.writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Many headless DASH players in one process')
+    parser.add_argument('-u', '--url', default='http://127.0.0.1:8000/manifest.mpd', help='MPD to play.')
+    parser.add_argument('-n', '--players', type=int, default=10, help='Concurrent players.')
+    parser.add_argument('-r', '--ramp', type=float, default=1.0, help='Players started per second (0 starts them all at once).')
+    parser.add_argument('-t', '--timeout', type=float, default=60, help='Time to live in seconds.')
+    parser.add_argument('-m', '--period', type=float, default=1.0, help='Seconds between stats samples; rates are per second.')
+    parser.add_argument('-a', '--abr', default='throughput', help='ABR: {}, or module.Class with a choose(player) method.'.format(', '.join(sorted(ABRS))))
+    parser.add_argument('-b', '--max_buffer', type=float, default=30.0, help='Seconds of media buffered before fetching pauses.')
+    parser.add_argument('--resume', type=float, default=2.0, help='Seconds of media needed to start or resume playing.')
+    parser.add_argument('-l', '--loop', default=False, action='store_true', help='Start the content again when it ends.')
+    parser.add_argument('-A', '--aggregate_only', default=False, action='store_true', help='Only write the all-players line each period (summaries are still per player).')
+    parser.add_argument('--statsfile', default=None, help='File to log stats to.')
+    parser.add_argument('--stats_format', default='text', choices=FORMATS, help='Stats output: text lines, or csv/ndjson with a fixed schema.')
+    parser.add_argument('--flush_interval', default=1.0, type=float, help='Seconds between stats flushes.')
+    args = parser.parse_args()
+
+    sim = PlayerSim(args.url, players=args.players, ramp=args.ramp, timeout=args.timeout, period=args.period, abr=args.abr,
+                    max_buffer=args.max_buffer, resume=args.resume, loop=args.loop, per_player=not args.aggregate_only,
+                    stats_file=args.statsfile, stats_format=args.stats_format, flush_interval=args.flush_interval)
+    try:
+        asyncio.run(sim.run())
+    except KeyboardInterrupt:
+        print('Exiting...')
+
+if __name__ == '__main__':
+    main()
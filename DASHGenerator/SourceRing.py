@@ -0,0 +1,80 @@
+import time
+import threading
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+# Raw source frames prepared once and played round in a loop.
+#
+# prepare() runs the usual input chain (parse, convert, deinterlace, rate)
+# over the first N seconds of the source into an appsink and keeps the
+# buffers it produces. attach() then feeds an appsrc from them: every frame
+# pushed is a shallow copy of a kept buffer, sharing its memory, with
+# timestamps continuing from the previous lap. After preparation the source
+# costs neither disk reads nor per-frame conversion work.
+
+class SourceRing:
+
+    def __init__(self, chain, caps, seconds=10):
+        # chain: launch description from the source up to, not including,
+        # the appsink; caps: raw caps every prepared frame is forced to
+        self.chain = chain
+        self.caps = caps
+        self.seconds = seconds
+        self.frames = []
+        self.frame_caps = None
+        self.duration = 0
+        self.next_frame = 0
+        self.lock = threading.Lock()
+
+    def prepare(self):
+        pipeline = Gst.parse_launch('{} ! {} ! appsink name=ring sync=false max-buffers=4'.format(self.chain, self.caps))
+        sink = pipeline.get_by_name('ring')
+        start = time.time()
+        pipeline.set_state(Gst.State.PLAYING)
+        bus = pipeline.get_bus()
+        error = None
+        wanted = None
+        while wanted is None or len(self.frames) < wanted:
+            # Timed, as a failed source need not send EOS
+            sample = sink.emit('try-pull-sample', Gst.SECOND)
+            if sample is None:
+                # Take any error now: the NULL transition flushes the bus
+                error = bus.pop_filtered(Gst.MessageType.ERROR)
+                if error is not None or sink.get_property('eos'):
+                    # A source shorter than the ring is looped whole
+                    break
+                continue
+            if self.frame_caps is None:
+                self.frame_caps = sample.get_caps()
+                ok, num, denom = self.frame_caps.get_structure(0).get_fraction('framerate')
+                self.duration = Gst.util_uint64_scale(Gst.SECOND, denom, num)
+                wanted = int(self.seconds * num / denom)
+            # Copied once, so upstream buffer pools get theirs back
+            self.frames.append(sample.get_buffer().copy_deep())
+        pipeline.set_state(Gst.State.NULL)
+
+        if len(self.frames) == 0:
+            raise Exception('no frames from source: {}'.format(error.parse_error()[0] if error else 'empty'))
+        print('Source ring: {} frames ({:.1f}s, {}MB) prepared in {:.1f}s'.format(
+            len(self.frames), len(self.frames) * self.duration / float(Gst.SECOND),
+            sum(b.get_size() for b in self.frames) // (1024 * 1024), time.time() - start))
+
+    def attach(self, appsrc):
+        appsrc.set_property('caps', self.frame_caps)
+        appsrc.set_property('format', Gst.Format.TIME)
+        # A few frames ahead of the tee is plenty; they are only references
+        appsrc.set_property('max-bytes', 4 * self.frames[0].get_size())
+        appsrc.set_property('block', True)
+        appsrc.connect('need-data', self.need_data)
+
+    def need_data(self, appsrc, length):
+        with self.lock:
+            number = self.next_frame
+            self.next_frame += 1
+        buffer = self.frames[number % len(self.frames)].copy()
+        buffer.pts = number * self.duration
+        buffer.dts = buffer.pts
+        buffer.duration = self.duration
+        buffer.offset = number
+        appsrc.emit('push-buffer', buffer)
@@ -0,0 +1,434 @@
+#!/usr/bin/python
+import os
+import sys
+import json
+import math
+import time
+import signal
+import tempfile
+import argparse
+import subprocess
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RTPGenerator'))
+from StatsWriter import StatsWriter, FORMATS
+
+# Runs a scenario of RTP, RTSP and DASH flows from one entry point.
+#
+# The scenario's flows are split into shards, each run by one worker: a
+# generator script that already handles many flows in one process
+# (RTPServer.py -F, RTPClient.py -P, RTSPLoad.py, PlayerSim.py). By default
+# there are about as many shards as cores, each worker pinned to its own
+# core. Workers write ndjson stats to their own file; the orchestrator reads
+# them as they grow and writes one aggregated series, per kind of worker and
+# overall, every period. A worker that exits before its stop time is
+# reported with the end of its log, and restarted if --restarts allows.
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+TYPES = ['rtp', 'rtsp', 'dash']
+
+# Scenario defaults per flow type; start and stop are seconds from the start
+# of the run, stop defaulting to the scenario's duration
+DEFAULTS = dict(
+  rtp=dict(role='both', client='127.0.0.1', port=5000, width=1280, height=720, framerate=30, engine='gst'),
+  rtsp=dict(server='127.0.0.1', port=5000, mount='/video', no_decode=False, ramp=10.0),
+  dash=dict(url='http://127.0.0.1:8000/manifest.mpd', abr='throughput', ramp=10.0),
+)
+
+# Seconds receivers start ahead of the RTP servers feeding them
+CLIENT_LEAD = 1.0
+
+def read_scenario(path, duration=None):
+  # ({'duration': seconds, 'flows': [entry]}) with defaults filled in. An
+  # entry is a type, a count and that type's parameters.
+  with open(path) as f:
+    scenario = json.load(f)
+  if duration != None:
+    scenario['duration'] = duration
+  if scenario.get('duration', 0) <= 0:
+    raise ValueError("%s: a scenario needs a duration in seconds" % path)
+  entries = []
+  for n, entry in enumerate(scenario.get('flows', [])):
+    kind = entry.get('type', '').lower()
+    if kind not in TYPES:
+      raise ValueError("%s: flow %d has type '%s', expected one of %s" % (path, n, entry.get('type'), ', '.join(TYPES)))
+    full = dict(DEFAULTS[kind])
+    full.update(entry)
+    full['type'] = kind
+    full['count'] = int(full.get('count', 1))
+    full['start'] = float(full.get('start', 0))
+    full['stop'] = float(full.get('stop', scenario['duration']))
+    if full['stop'] <= full['start']:
+      raise ValueError("%s: flow %d stops before it starts" % (path, n))
+    if kind == 'rtp' and full['role'] not in ('both', 'server', 'client'):
+      raise ValueError("%s: flow %d has role '%s', expected both, server or client" % (path, n, full['role']))
+    entries.append(full)
+  if len(entries) == 0:
+    raise ValueError("%s: no flows" % path)
+  scenario['flows'] = entries
+  return scenario
+
+def parse_cores(spec):
+  # '0-3,8' -> [0, 1, 2, 3, 8]
+  cores = []
+  for part in spec.split(','):
+    part = part.strip()
+    if '-' in part:
+      first, last = part.split('-')
+      cores.extend(range(int(first), int(last) + 1))
+    elif part != '':
+      cores.append(int(part))
+  return cores
+
+def available_cores():
+  if hasattr(os, 'sched_getaffinity'):
+    return sorted(os.sched_getaffinity(0))
+  return list(range(os.sysconf('SC_NPROCESSORS_ONLN')))
+
+def shard_counts(entries, slots, flows_per_worker=0):
+  # Shards per entry: flows_per_worker each if given, else the entry's share
+  # of slots by flow count, at least one and at most one per flow
+  if flows_per_worker > 0:
+    return [int(math.ceil(float(e['count']) / flows_per_worker)) for e in entries]
+  total = sum(e['count'] for e in entries)
+  return [max(1, min(e['count'], int(round(float(slots) * e['count'] / total)))) for e in entries]
+
+def split(count, shards):
+  # count flows as evenly as possible over shards: [(first, n)]
+  parts = []
+  first = 0
+  for i in range(shards):
+    n = count // shards + (1 if i < count % shards else 0)
+    if n > 0:
+      parts.append((first, n))
+    first = first + n
+  return parts
+
+def pin_command(command, cores):
+  # Prefixes taskset where the interpreter cannot set affinity itself
+  if cores == None or hasattr(os, 'sched_setaffinity'):
+    return command
+  return ['taskset', '-c', ','.join(str(c) for c in cores)] + command
+
+class Worker:
+  # One generator process running a shard of an entry
+
+  def __init__(self, name, kind, entry, first, flows, start, stop, build, workdir, period=1.0):
+    self.name = name
+    self.kind = kind
+    self.entry = entry
+    self.first = first
+    self.flows = flows
+    self.start = start
+    self.stop_time = stop
+    self.build = build
+    self.period = period
+    self.workdir = workdir
+    self.log = os.path.join(workdir, name + '.log')
+    self.stats = None
+    self.cores = None
+    self.state = 'pending'
+    self.popen = None
+    self.launched = None
+    self.returncode = None
+    self.restarts = 0
+    self.stats_file = None
+    self.partial = ''
+    self.unread = []
+    self.latest = dict()
+
+  def describe(self):
+    pinned = ''
+    if self.cores != None:
+      pinned = ' core %s' % ','.join(str(c) for c in self.cores)
+    return "%s (%s, %d flows%s)" % (self.name, self.kind, self.flows, pinned)
+
+  def launch(self, now, run_start, python, dash_python):
+    # Each launch writes its own stats file, so a restart does not truncate
+    # the file being read; what the last launch left is read first
+    if self.stats_file != None:
+      unread = self.read_stats()
+      self.unread = unread
+      self.stats_file.close()
+      self.stats_file = None
+      self.partial = ''
+    self.stats = os.path.join(self.workdir, '%s.%d.ndjson' % (self.name, self.restarts))
+    duration = max(1.0, run_start + self.stop_time - now)
+    command = pin_command(self.build(self, duration, python, dash_python), self.cores)
+    env = dict(os.environ)
+    env['PYTHONUNBUFFERED'] = '1'
+    cores = self.cores
+    def pin():
+      if cores != None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    out = open(self.log, 'a')
+    out.write("# %s\n" % ' '.join(command))
+    out.flush()
+    self.popen = subprocess.Popen(command, stdout=out, stderr=subprocess.STDOUT, env=env, preexec_fn=pin, cwd=ROOT)
+    out.close()
+    self.launched = now
+    self.state = 'running'
+
+  def poll(self):
+    if self.popen == None:
+      return None
+    return self.popen.poll()
+
+  def terminate(self, grace=5.0):
+    if self.popen == None or self.popen.poll() != None:
+      return
+    self.popen.send_signal(signal.SIGTERM)
+    deadline = time.time() + grace
+    while self.popen.poll() == None and time.time() < deadline:
+      time.sleep(0.1)
+    if self.popen.poll() == None:
+      self.popen.kill()
+      self.popen.wait()
+
+  def read_stats(self):
+    # New complete ndjson records since the last call
+    records = self.unread
+    self.unread = []
+    if self.stats_file == None:
+      if self.stats == None or not os.path.exists(self.stats):
+        return records
+      self.stats_file = open(self.stats, 'r')
+    data = self.partial + self.stats_file.read()
+    lines = data.split('\n')
+    self.partial = lines.pop()
+    for line in lines:
+      if line.startswith('{'):
+        try:
+          records.append(json.loads(line))
+        except ValueError:
+          pass
+    return records
+
+  def tail_log(self, lines=5):
+    try:
+      with open(self.log) as f:
+        return [l.rstrip() for l in f.readlines()[-lines:]]
+    except IOError:
+      return []
+
+def ndjson(period):
+  return ['--stats_format', 'ndjson', '--flush_interval', str(period)]
+
+def rtp_server(worker, duration, python, dash_python):
+  e = worker.entry
+  command = [python, os.path.join(ROOT, 'RTPGenerator', 'RTPServer.py'), '-e', e['engine'], '-t', '%.1f' % duration, '-s', worker.stats, '--report_interval', str(worker.period)] + ndjson(worker.period)
+  for i in range(worker.first, worker.first + worker.flows):
+    command.extend(['-F', '%s:%d:%dx%d:%d' % (e['client'], e['port'] + i, e['width'], e['height'], e['framerate'])])
+  return command
+
+def rtp_client(worker, duration, python, dash_python):
+  e = worker.entry
+  first = e['port'] + worker.first
+  return [python, os.path.join(ROOT, 'RTPGenerator', 'RTPClient.py'), '-P', '%d-%d' % (first, first + worker.flows - 1), '-t', '%.1f' % duration, '-m', str(worker.period), '-s', worker.stats,
+          '-W', str(e['width']), '-H', str(e['height']), '-f', str(e['framerate'])] + ndjson(worker.period)
+
+def rtsp_load(worker, duration, python, dash_python):
+  e = worker.entry
+  command = [python, os.path.join(ROOT, 'RTSPGenerator', 'RTSPLoad.py'), '-s', e['server'], '-p', str(e['port']), '-u', e['mount'], '-n', str(worker.flows), '-r', str(e['ramp']),
+             '-t', '%.1f' % duration, '-m', str(worker.period), '-A', '--statsfile', worker.stats] + ndjson(worker.period)
+  if e['no_decode']:
+    command.append('-N')
+  return command
+
+def dash_players(worker, duration, python, dash_python):
+  e = worker.entry
+  return [dash_python, os.path.join(ROOT, 'DASHGenerator', 'PlayerSim.py'), '-u', e['url'], '-n', str(worker.flows), '-r', str(e['ramp']), '-a', e['abr'],
+          '-t', '%.1f' % duration, '-m', str(worker.period), '-A', '--statsfile', worker.stats] + ndjson(worker.period)
+
+def plan(scenario, workdir, slots, flows_per_worker=0, period=1.0):
+  # Workers for every shard of every entry, in start order
+  entries = scenario['flows']
+  shards = shard_counts(entries, slots, flows_per_worker)
+  workers = []
+  for n, entry in enumerate(entries):
+    # A both-ways RTP shard is two workers, a server and its client
+    if entry['type'] == 'rtp' and entry['role'] == 'both':
+      shards[n] = max(1, shards[n] // 2)
+    for first, flows in split(entry['count'], shards[n]):
+      roles = []
+      if entry['type'] == 'rtp':
+        if entry['role'] in ('both', 'client'):
+          roles.append(('rtp-client', rtp_client, 0.0))
+        if entry['role'] in ('both', 'server'):
+          lead = CLIENT_LEAD if entry['role'] == 'both' else 0.0
+          roles.append(('rtp-server', rtp_server, lead))
+      elif entry['type'] == 'rtsp':
+        roles.append(('rtsp', rtsp_load, 0.0))
+      else:
+        roles.append(('dash', dash_players, 0.0))
+      for kind, build, lead in roles:
+        name = '%s%d_%d' % (kind, n, first)
+        workers.append(Worker(name, kind, entry, first, flows, entry['start'] + lead, entry['stop'], build, workdir, period))
+  workers.sort(key=lambda w: w.start)
+  return workers
+
+class Orchestrator:
+
+  def __init__(self, workers, cores=None, restarts=0, period=1.0, python='python', dash_python='python3', stats_file=None, stats_format='text', flush_interval=1.0):
+    self.workers = workers
+    self.restarts = restarts
+    self.period = period
+    self.python = python
+    self.dash_python = dash_python
+    self.exit = False
+    self.crashes = 0
+    self.writer = StatsWriter(stats_file, format=stats_format, flush_interval=flush_interval)
+    if cores != None:
+      for i, worker in enumerate(workers):
+        worker.cores = [cores[i % len(cores)]]
+      if len(workers) > len(cores):
+        self.writer.message("%d workers on %d cores, some cores run more than one" % (len(workers), len(cores)))
+
+  def sighandler(self, signum, frame):
+    print("Caught signal %d" % signum)
+    self.exit = True
+
+  def run(self):
+    self.started = time.time()
+    end = self.started + max(w.stop_time for w in self.workers)
+    next_report = self.started + self.period
+    while not self.exit:
+      now = time.time()
+      for worker in self.workers:
+        if worker.state == 'pending' and now >= self.started + worker.start:
+          worker.launch(now, self.started, self.python, self.dash_python)
+          self.writer.message("%s Started %s" % (now, worker.describe()))
+      self.supervise(now)
+      if now >= next_report:
+        self.report(now)
+        next_report = next_report + self.period
+      if now > end and all(w.state not in ('pending', 'running') for w in self.workers):
+        break
+      # Every worker has been told to stop by now; give them a little longer
+      if now > end + 10:
+        break
+      time.sleep(min(0.2, max(0.0, next_report - time.time())))
+    self.stop()
+
+  def supervise(self, now):
+    for worker in self.workers:
+      if worker.state != 'running':
+        continue
+      rc = worker.poll()
+      if rc == None:
+        continue
+      worker.returncode = rc
+      # Ending within a couple of seconds of the stop time is a normal exit
+      if now >= self.started + worker.stop_time - 2 and rc == 0:
+        worker.state = 'done'
+        continue
+      self.crashes = self.crashes + 1
+      self.writer.message("%s Worker %s exited with %d after %.1fs, %.1fs before its stop time. End of %s:" % (now, worker.describe(), rc, now - worker.launched, self.started + worker.stop_time - now, worker.log))
+      for line in worker.tail_log():
+        self.writer.message("  " + line)
+      if worker.restarts < self.restarts and now < self.started + worker.stop_time - 2:
+        worker.restarts = worker.restarts + 1
+        self.writer.message("%s Restarting %s (%d of %d)" % (now, worker.name, worker.restarts, self.restarts))
+        worker.launch(now, self.started, self.python, self.dash_python)
+      else:
+        worker.state = 'crashed'
+
+  def report(self, now):
+    # One record per kind of worker and one over everything, from the latest
+    # record of each flow of each running worker. Workers flush on their own
+    # clocks, so a record stands until the next one replaces it.
+    ts = str(now)
+    kinds = dict()
+    for worker in self.workers:
+      for record in worker.read_stats():
+        if record.get('kbps') == None and record.get('fps') == None:
+          # Connect times, summaries and the like
+          continue
+        worker.latest[record.get('flow')] = record
+      if worker.state != 'running':
+        worker.latest = dict()
+      group = kinds.setdefault(worker.kind, dict(workers=0, running=0, crashed=0, flows=0, kbps=0.0, loss=0, fps=[]))
+      group['workers'] = group['workers'] + 1
+      if worker.state == 'running':
+        group['running'] = group['running'] + 1
+      if worker.state == 'crashed':
+        group['crashed'] = group['crashed'] + 1
+      # Load generators' own all-sessions line stands for their sessions
+      records = list(worker.latest.values())
+      if 'all' in worker.latest:
+        records = [worker.latest['all']]
+      for record in records:
+        group['flows'] = group['flows'] + record.get('playing', 1)
+        group['kbps'] = group['kbps'] + (record.get('kbps') or 0)
+        group['loss'] = group['loss'] + (record.get('loss') or 0)
+        if record.get('fps') != None:
+          group['fps'].append(record.get('mean_fps', record['fps']))
+
+    total = dict(workers=0, running=0, crashed=0, flows=0, kbps=0.0, loss=0)
+    for kind in sorted(kinds):
+      group = kinds[kind]
+      fps = None
+      if len(group['fps']) > 0:
+        fps = sum(group['fps']) / len(group['fps'])
+      for name in total:
+        total[name] = total[name] + group[name]
+      mesg = "%s Kind:%s Running:%d/%d Crashed:%d Flows:%d Kbps:%d Loss:%d" % (ts, kind, group['running'], group['workers'], group['crashed'], group['flows'], group['kbps'], group['loss'])
+      if fps != None:
+        mesg = mesg + " FPS:%.1f" % fps
+      self.writer.record(mesg, timestamp=now, flow=kind, fps=fps, loss=group['loss'], kbps=group['kbps'], workers=group['workers'], running=group['running'], crashed=group['crashed'], flows=group['flows'])
+    mesg = "%s Kind:all Running:%d/%d Crashed:%d Flows:%d Kbps:%d Loss:%d" % (ts, total['running'], total['workers'], total['crashed'], total['flows'], total['kbps'], total['loss'])
+    self.writer.record(mesg, timestamp=now, flow='all', loss=total['loss'], kbps=total['kbps'], workers=total['workers'], running=total['running'], crashed=total['crashed'], flows=total['flows'])
+
+  def stop(self):
+    for worker in self.workers:
+      if worker.state == 'running':
+        worker.terminate()
+        worker.returncode = worker.poll()
+        worker.state = 'stopped'
+    self.report(time.time())
+    for worker in self.workers:
+      self.writer.message("%s %s exit:%s restarts:%d" % (worker.describe(), worker.state, worker.returncode, worker.restarts))
+    self.writer.close()
+
+def main():
+  parser = argparse.ArgumentParser(description='Run a scenario of RTP, RTSP and DASH flows on a pool of pinned worker processes')
+  parser.add_argument('scenario', help='Scenario file (JSON), see Orchestrator/README.txt.')
+  parser.add_argument('-d', '--duration', type=float, default=None, help='Override the scenario duration in seconds.')
+  parser.add_argument('-w', '--workers', type=int, default=0, help='Shards to aim for over all flows (0 for one per core).')
+  parser.add_argument('--flows_per_worker', type=int, default=0, help='Flows per shard instead of sizing shards to the cores.')
+  parser.add_argument('-c', '--cores', default=None, help='Cores to pin workers to, e.g. 0-7,16 (default: all this process may use).')
+  parser.add_argument('--no_pin', default=False, action='store_true', help='Leave worker placement to the scheduler.')
+  parser.add_argument('-r', '--restarts', type=int, default=0, help='Times a crashed worker is restarted.')
+  parser.add_argument('-m', '--period', type=float, default=1.0, help='Seconds between aggregated stats records.')
+  parser.add_argument('-l', '--log_dir', default=None, help='Directory for worker logs and stats (default: a new temporary one).')
+  parser.add_argument('--python', default='python', help='Interpreter for the RTP and RTSP generators.')
+  parser.add_argument('--dash_python', default='python3', help='Interpreter for the DASH generator.')
+  parser.add_argument('-s', '--statsfile', default=None, help='File for the aggregated stats.')
+  parser.add_argument('--stats_format', default='text', choices=FORMATS, help='Aggregated stats: text lines, or csv/ndjson with a fixed schema.')
+  parser.add_argument('--flush_interval', default=1.0, type=float, help='Seconds between stats flushes.')
+  args = parser.parse_args()
+
+  scenario = read_scenario(args.scenario, args.duration)
+  cores = available_cores()
+  if args.cores != None:
+    cores = parse_cores(args.cores)
+  slots = args.workers
+  if slots <= 0:
+    slots = len(cores)
+  workdir = args.log_dir
+  if workdir == None:
+    workdir = tempfile.mkdtemp(prefix='orchestrator')
+  elif not os.path.isdir(workdir):
+    os.makedirs(workdir)
+
+  workers = plan(scenario, workdir, slots, flows_per_worker=args.flows_per_worker, period=args.period)
+  orchestrator = Orchestrator(workers, cores=None if args.no_pin else cores, restarts=args.restarts, period=args.period, python=args.python, dash_python=args.dash_python, stats_file=args.statsfile, stats_format=args.stats_format, flush_interval=args.flush_interval)
+  for i in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]:
+    signal.signal(i, orchestrator.sighandler)
+  print("%d flows in %d workers over %.0fs, logs in %s" % (sum(e['count'] for e in scenario['flows']), len(workers), max(w.stop_time for w in workers), workdir))
+  orchestrator.run()
+  if orchestrator.crashes > 0:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
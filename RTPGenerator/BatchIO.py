@@ -0,0 +1,216 @@
+#!/usr/bin/python
+import ctypes
+import ctypes.util
+import errno
+import socket
+import struct
+
+# Batched UDP I/O with Linux sendmmsg(2)/recvmmsg(2), called through ctypes
+# since the socket module has no wrapper for them. One send syscall carries
+# every packet the scheduler has due at once, across flows and destinations;
+# one receive syscall drains a burst of queued datagrams.
+
+class iovec(ctypes.Structure):
+  _fields_ = [('iov_base', ctypes.c_void_p),
+              ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+  _fields_ = [('msg_name', ctypes.c_void_p),
+              ('msg_namelen', ctypes.c_uint32),
+              ('msg_iov', ctypes.POINTER(iovec)),
+              ('msg_iovlen', ctypes.c_size_t),
+              ('msg_control', ctypes.c_void_p),
+              ('msg_controllen', ctypes.c_size_t),
+              ('msg_flags', ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+  _fields_ = [('msg_hdr', msghdr),
+              ('msg_len', ctypes.c_uint)]
+
+try:
+  libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+  sendmmsg = libc.sendmmsg
+  sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+  sendmmsg.restype = ctypes.c_int
+except (OSError, AttributeError, TypeError):
+  sendmmsg = None
+
+try:
+  recvmmsg = libc.recvmmsg
+  recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+  recvmmsg.restype = ctypes.c_int
+except (NameError, AttributeError, TypeError):
+  recvmmsg = None
+
+MSG_DONTWAIT = 0x40
+
+def have_sendmmsg():
+  return sendmmsg != None
+
+def have_recvmmsg():
+  return recvmmsg != None
+
+class DirectSender:
+  # One sendto() per packet, the way udpsink sends
+
+  def __init__(self, sock):
+    self.sock = sock
+    self.syscalls = 0
+
+  def send(self, packet, dest, owner=None):
+    self.syscalls = self.syscalls + 1
+    try:
+      self.sock.sendto(packet, dest)
+    except socket.error:
+      if owner != None:
+        owner.errors = owner.errors + 1
+
+  def flush(self):
+    return
+
+def sockaddr_in(dest):
+  # struct sockaddr_in: family in host order, port and address in network order
+  return struct.pack('=H', socket.AF_INET) + struct.pack('!H', dest[1]) + socket.inet_aton(dest[0]) + b'\0' * 8
+
+SOCKADDR_IN_SIZE = 16
+
+class BatchSender:
+  # Queues packets and sends them max_batch at a time with sendmmsg(). The
+  # owner passed with each packet gets its errors count bumped if that
+  # packet could not be sent.
+  #
+  # The mmsghdr array is built once: message i always names address slot i
+  # and iovec i. At flush the destinations' sockaddrs are copied into the
+  # address slots with one slice assignment, the packets are joined into one
+  # buffer and the iovecs pointed into it with one struct call, so the
+  # per-packet work stays in C; per packet Python only appends to lists.
+
+  def __init__(self, sock, max_batch=64):
+    if sendmmsg == None:
+      raise Exception("sendmmsg is not available on this system")
+    self.sock = sock
+    self.fd = sock.fileno()
+    self.max_batch = max_batch
+    self.msg_size = ctypes.sizeof(mmsghdr)
+    self.msgs = (mmsghdr * max_batch)()
+    self.iov_mem = bytearray(ctypes.sizeof(iovec) * max_batch)
+    self.iovs = (iovec * max_batch).from_buffer(self.iov_mem)
+    self.name_mem = bytearray(SOCKADDR_IN_SIZE * max_batch)
+    self.names_buf = (ctypes.c_char * len(self.name_mem)).from_buffer(self.name_mem)
+    names = ctypes.addressof(self.names_buf)
+    for i in range(max_batch):
+      hdr = self.msgs[i].msg_hdr
+      hdr.msg_name = names + i * SOCKADDR_IN_SIZE
+      hdr.msg_namelen = SOCKADDR_IN_SIZE
+      hdr.msg_iov = ctypes.pointer(self.iovs[i])
+      hdr.msg_iovlen = 1
+    self.msgs_addr = ctypes.addressof(self.msgs)
+    # iovec is (base, length), both pointer-sized
+    self.iov_structs = [struct.Struct('PP' * count) for count in range(max_batch + 1)]
+    self.addrs = dict()
+    self.last_dest = None
+    self.last_addr = None
+    self.pending = []
+    self.dests = []
+    self.owners = []
+    self.syscalls = 0
+
+  def send(self, packet, dest, owner=None):
+    # Flows send to the same dest tuple every time, so an identity check
+    # usually saves the lookup
+    if dest is not self.last_dest:
+      self.last_addr = self.addrs.get(dest)
+      if self.last_addr == None:
+        self.last_addr = sockaddr_in(dest)
+        self.addrs[dest] = self.last_addr
+      self.last_dest = dest
+    self.pending.append(packet)
+    self.dests.append(self.last_addr)
+    self.owners.append(owner)
+    if len(self.pending) == self.max_batch:
+      self.flush()
+
+  def flush(self):
+    count = len(self.pending)
+    if count == 0:
+      return
+    self.name_mem[0:count * SOCKADDR_IN_SIZE] = b''.join(self.dests)
+    data = bytearray().join(self.pending)
+    buf = (ctypes.c_char * len(data)).from_buffer(data)
+    lengths = list(map(len, self.pending))
+    iov_values = [0] * (2 * count)
+    offset = ctypes.addressof(buf)
+    for i in range(count):
+      iov_values[2 * i] = offset
+      offset = offset + lengths[i]
+    iov_values[1::2] = lengths
+    self.iov_structs[count].pack_into(self.iov_mem, 0, *iov_values)
+
+    done = 0
+    while done < count:
+      self.syscalls = self.syscalls + 1
+      ret = sendmmsg(self.fd, self.msgs_addr + done * self.msg_size, count - done, 0)
+      if ret > 0:
+        done = done + ret
+        continue
+      err = ctypes.get_errno()
+      if ret < 0 and err == errno.EINTR:
+        continue
+      # The message at done failed, count it and carry on with the rest
+      owner = self.owners[done]
+      if owner != None:
+        owner.errors = owner.errors + 1
+      done = done + 1
+    del buf
+    self.pending = []
+    self.dests = []
+    self.owners = []
+
+class BatchReceiver:
+  # Reads up to max_batch queued datagrams per recvmmsg() call into fixed
+  # buffers. receive() returns memoryviews into those buffers, which are
+  # only valid until the next call.
+
+  def __init__(self, sock, max_batch=64, max_size=2048):
+    if recvmmsg == None:
+      raise Exception("recvmmsg is not available on this system")
+    self.sock = sock
+    self.fd = sock.fileno()
+    self.max_batch = max_batch
+    self.max_size = max_size
+    self.msg_size = ctypes.sizeof(mmsghdr)
+    self.len_offset = mmsghdr.msg_len.offset
+    self.data = bytearray(max_batch * max_size)
+    self.view = memoryview(self.data)
+    self.msg_mem = bytearray(self.msg_size * max_batch)
+    self.msgs = (mmsghdr * max_batch).from_buffer(self.msg_mem)
+    self.iovs = (iovec * max_batch)()
+    self.buf = (ctypes.c_char * len(self.data)).from_buffer(self.data)
+    base = ctypes.addressof(self.buf)
+    for i in range(max_batch):
+      self.iovs[i].iov_base = base + i * max_size
+      self.iovs[i].iov_len = max_size
+      self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovs[i])
+      self.msgs[i].msg_hdr.msg_iovlen = 1
+    self.msgs_addr = ctypes.addressof(self.msgs)
+    self.syscalls = 0
+
+  def receive(self):
+    # Empty list once nothing is queued
+    while True:
+      self.syscalls = self.syscalls + 1
+      ret = recvmmsg(self.fd, self.msgs_addr, self.max_batch, MSG_DONTWAIT, None)
+      if ret >= 0:
+        break
+      err = ctypes.get_errno()
+      if err == errno.EINTR:
+        continue
+      if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return []
+      raise socket.error(err, "recvmmsg failed")
+    packets = []
+    for i in range(ret):
+      length = struct.unpack_from('I', self.msg_mem, i * self.msg_size + self.len_offset)[0]
+      start = i * self.max_size
+      packets.append(self.view[start:start + length])
+    return packets
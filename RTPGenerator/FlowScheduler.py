@@ -0,0 +1,143 @@
+#!/usr/bin/python
+import heapq
+import random
+import socket
+import time
+
+import BatchIO
+from StatsWriter import StatsWriter
+
+class FlowScheduler:
+  # Drives many packet flows from one thread. Each flow says when it next
+  # needs to send and the scheduler sleeps until the earliest deadline, so
+  # idle flows cost a heap entry rather than a thread, timer or process.
+  #
+  # A flow needs a send(now) method that sends everything due at or before
+  # now and returns the time of its next packet (or None when it is done).
+
+  def __init__(self, report=None, report_interval=1.0, flush=None):
+    self.heap = []
+    self.flush = flush
+    self.count = 0
+    self.exit = False
+    self.report = report
+    self.report_interval = report_interval
+
+  def add(self, flow, when):
+    heapq.heappush(self.heap, (when, self.count, flow))
+    self.count = self.count + 1
+
+  def stop(self):
+    self.exit = True
+
+  def run(self, timeout=0):
+    start = time.time()
+    if timeout > 0:
+      deadline = start + timeout
+    else:
+      deadline = None
+    next_report = start + self.report_interval
+    while not self.exit and len(self.heap) > 0:
+      wake = self.heap[0][0]
+      if self.report != None:
+        wake = min(wake, next_report)
+      if deadline != None:
+        wake = min(wake, deadline)
+      now = time.time()
+      if wake > now:
+        time.sleep(wake - now)
+        now = time.time()
+      if deadline != None and now >= deadline:
+        break
+      if self.report != None and now >= next_report:
+        self.report(now)
+        next_report = next_report + self.report_interval
+      while len(self.heap) > 0 and self.heap[0][0] <= now:
+        when, n, flow = heapq.heappop(self.heap)
+        when = flow.send(now)
+        if when != None:
+          heapq.heappush(self.heap, (when, n, flow))
+      if self.flush != None:
+        self.flush()
+    if self.report != None:
+      self.report(time.time())
+
+class PacketFlow:
+  # Counters shared by the socket engines' flows. Drift is how late each
+  # packet left compared to its schedule, kept per report interval.
+
+  def __init__(self, name, sender, dest):
+    self.name = name
+    self.sender = sender
+    self.dest = dest
+    self.ssrc = random.getrandbits(32)
+    self.packets = 0
+    self.bytes = 0
+    self.errors = 0
+    self.reset_drift()
+
+  def reset_drift(self):
+    self.drift_sum = 0.0
+    self.drift_max = 0.0
+    self.drift_count = 0
+
+  def sendto(self, packet, scheduled, now):
+    self.sender.send(packet, self.dest, self)
+    self.packets = self.packets + 1
+    self.bytes = self.bytes + len(packet)
+    drift = now - scheduled
+    self.drift_sum = self.drift_sum + drift
+    self.drift_count = self.drift_count + 1
+    if drift > self.drift_max:
+      self.drift_max = drift
+
+class FlowRunner:
+  # Many PacketFlows sharing one UDP socket and one scheduler thread, with a
+  # status line per flow every report_interval seconds. With batch > 0 the
+  # packets due at each wakeup go out through sendmmsg, batch at a time.
+
+  def __init__(self, stats_file=None, stats_format='text', flush_interval=1.0, report_interval=1.0, batch=0):
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if batch > 0 and BatchIO.have_sendmmsg():
+      self.sender = BatchIO.BatchSender(self.sock, max_batch=batch)
+    else:
+      self.sender = BatchIO.DirectSender(self.sock)
+    self.scheduler = FlowScheduler(report=self.report, report_interval=report_interval, flush=self.sender.flush)
+    self.flows = []
+    self.last_report = None
+    self.sent = dict()
+
+    self.writer = StatsWriter(stats_file, format=stats_format, flush_interval=flush_interval)
+
+  def add_flow(self, flow, when):
+    self.flows.append(flow)
+    self.sent[flow.name] = 0
+    self.scheduler.add(flow, when)
+
+  def run(self, timeout=0):
+    try:
+      self.scheduler.run(timeout)
+    except KeyboardInterrupt:
+      print("Killed by ^C")
+    self.stop()
+
+  def stop(self):
+    self.scheduler.stop()
+    self.writer.close()
+
+  def report(self, now):
+    ts = str(now)
+    for flow in self.flows:
+      if self.last_report != None and now > self.last_report:
+        kbps = (flow.bytes - self.sent[flow.name]) * 8 / (now - self.last_report) / 1000
+      else:
+        kbps = 0
+      if flow.drift_count > 0:
+        drift_avg = flow.drift_sum / flow.drift_count
+      else:
+        drift_avg = 0.0
+      self.sent[flow.name] = flow.bytes
+      mesg = "%s Flow:%s Dest:%s:%d SSRC:%08x Packets:%d Bytes:%d Kbps:%d Errors:%d DriftAvg:%.3fms DriftMax:%.3fms" % (ts, flow.name, flow.dest[0], flow.dest[1], flow.ssrc, flow.packets, flow.bytes, kbps, flow.errors, drift_avg * 1000, flow.drift_max * 1000)
+      self.writer.record(mesg, timestamp=now, flow=flow.name, kbps=kbps, dest='%s:%d' % flow.dest, ssrc='%08x' % flow.ssrc, packets=flow.packets, bytes=flow.bytes, errors=flow.errors, drift_avg_ms=drift_avg * 1000, drift_max_ms=flow.drift_max * 1000)
+      flow.reset_drift()
+    self.last_report = now
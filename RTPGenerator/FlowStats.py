@@ -0,0 +1,147 @@
+#!/usr/bin/python
+import array
+import math
+
+import RTPPacket
+
+# RTP receive accounting from headers alone: loss and interarrival jitter as
+# in RFC 3550 (appendix A.3 and A.8), reordering, duplicates, bitrate and
+# frame completeness from marker bits. Nothing is depayloaded or decoded.
+# Frames carrying a capture time (RTPPacket.capture_time) also give one-way
+# latency: capture to arrival of the frame's last packet.
+
+# Sequence numbers remembered for duplicate detection
+DUP_WINDOW = 1024
+
+def percentiles(values, points=(50, 95, 99)):
+  # Nearest-rank percentiles of values, None for an empty list
+  if len(values) == 0:
+    return [None for p in points]
+  ordered = sorted(values)
+  result = []
+  for p in points:
+    rank = int(math.ceil(p / 100.0 * len(ordered)))
+    result.append(ordered[max(rank, 1) - 1])
+  return result
+
+class FlowStats:
+
+  def __init__(self, clock_rate=RTPPacket.CLOCK_RATE):
+    self.clock_rate = clock_rate
+    self.ssrc = None
+    self.base_seq = None
+    self.max_seq = None
+    self.received = 0
+    self.bytes = 0
+    self.reordered = 0
+    self.duplicates = 0
+    self.frames_complete = 0
+    self.frames_incomplete = 0
+    self.jitter = 0.0
+    self.transit = None
+    self.seen = array.array('l', [-1]) * DUP_WINDOW
+    self.frame_ts = None
+    self.frame_ok = False
+    self.frame_ended = True
+    self.frame_capture = None
+    self.latencies = []
+    self.last = dict(received=0, expected=0, bytes=0, reordered=0, duplicates=0, frames_complete=0, frames_incomplete=0)
+
+  def extend(self, seq):
+    # Extended sequence number closest to the highest seen so far
+    if self.max_seq == None:
+      return seq
+    ext = (self.max_seq & ~0xffff) | seq
+    if ext - self.max_seq > 0x8000:
+      ext = ext - 0x10000
+    elif self.max_seq - ext > 0x8000:
+      ext = ext + 0x10000
+    return ext
+
+  def expected(self):
+    if self.max_seq == None:
+      return 0
+    return self.max_seq - self.base_seq + 1
+
+  def lost(self):
+    return self.expected() - self.received
+
+  def update(self, data, arrival):
+    # data is a whole RTP packet, arrival its receive time in seconds
+    header = RTPPacket.parse_header(data)
+    if header == None:
+      return False
+    marker, pt, seq, ts, ssrc = header
+    if self.ssrc != ssrc:
+      # New or restarted sender, start counting over
+      if self.ssrc != None:
+        self.__init__(self.clock_rate)
+      self.ssrc = ssrc
+
+    ext = self.extend(seq)
+    slot = ext % DUP_WINDOW
+    if self.seen[slot] == ext:
+      self.duplicates = self.duplicates + 1
+      return True
+    self.seen[slot] = ext
+    self.received = self.received + 1
+    self.bytes = self.bytes + len(data)
+
+    # RFC 3550 A.8 interarrival jitter, in timestamp units
+    transit = int(arrival * self.clock_rate) - ts
+    if self.transit != None:
+      d = abs(transit - self.transit)
+      if d > 0x80000000:
+        d = 0x100000000 - d
+      self.jitter = self.jitter + (d - self.jitter) / 16.0
+    self.transit = transit
+
+    if self.max_seq == None:
+      self.base_seq = ext
+      self.max_seq = ext
+      gap = False
+    elif ext > self.max_seq:
+      gap = ext != self.max_seq + 1
+      self.max_seq = ext
+    else:
+      # Late packet, the frame it belonged to was already counted
+      self.reordered = self.reordered + 1
+      return True
+
+    if ts != self.frame_ts:
+      if not self.frame_ended:
+        self.frames_incomplete = self.frames_incomplete + 1
+      self.frame_ts = ts
+      self.frame_ok = not gap
+      self.frame_ended = False
+      self.frame_capture = None
+    elif gap:
+      self.frame_ok = False
+    if self.frame_capture == None:
+      self.frame_capture = RTPPacket.capture_time(data)
+    if marker and not self.frame_ended:
+      if self.frame_ok:
+        self.frames_complete = self.frames_complete + 1
+        if self.frame_capture != None:
+          self.latencies.append(arrival - self.frame_capture)
+      else:
+        self.frames_incomplete = self.frames_incomplete + 1
+      self.frame_ended = True
+    return True
+
+  def jitter_ms(self):
+    return self.jitter * 1000.0 / self.clock_rate
+
+  def latency(self):
+    # One-way latencies (seconds) of the frames completed since the last call
+    latencies = self.latencies
+    self.latencies = []
+    return latencies
+
+  def interval(self):
+    # Counter deltas since the previous call
+    now = dict(received=self.received, expected=self.expected(), bytes=self.bytes, reordered=self.reordered, duplicates=self.duplicates, frames_complete=self.frames_complete, frames_incomplete=self.frames_incomplete)
+    delta = dict([(name, now[name] - self.last[name]) for name in now])
+    delta['lost'] = max(0, delta['expected'] - delta['received'])
+    self.last = now
+    return delta
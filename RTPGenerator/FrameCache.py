@@ -0,0 +1,169 @@
+#!/usr/bin/python
+import os
+import mmap
+import struct
+import threading
+
+# Render-once raw frame cache. A frame file holds a short I420 clip at one
+# resolution/framerate, rendered by videotestsrc (or decoded from a file)
+# once, so flows can loop it into their encoders instead of each running
+# videotestsrc. By default the file lives in /dev/shm.
+#
+# In a process the frames are wrapped as GstBuffers over the file's pages
+# (GstAllocators fd memory), and every flow pushes references to the same
+# buffers. Other processes mapping the same file share the same pages.
+#
+# Layout: FILE_HEADER, padding to FRAME_OFFSET, then frame_count frames of
+# frame_size bytes each.
+MAGIC = b'RTPF'
+VERSION = 1
+FILE_HEADER = struct.Struct('!4sBHHHII')  # magic, version, width, height, framerate, frame_count, frame_size
+# Frames start on a page boundary
+FRAME_OFFSET = 4096
+FORMAT = 'I420'
+
+def frame_cache_name(width, height, fr, seconds, source=None):
+  directory = '.'
+  if os.path.isdir('/dev/shm'):
+    directory = '/dev/shm'
+  name = 'rtpframes_%dx%d_%dfps_%ds' % (width, height, fr, seconds)
+  if source != None:
+    name = name + '_' + os.path.splitext(os.path.basename(source))[0]
+  return os.path.join(directory, name + '.rtpf')
+
+def frame_caps(width, height, fr):
+  return 'video/x-raw,format=%s,framerate=(fraction)%d/1,width=(int)%d,height=(int)%d' % (FORMAT, fr, width, height)
+
+def build_frames(path, width=1280, height=720, fr=30, seconds=2, source=None):
+  import gi
+  gi.require_version('Gst', '1.0')
+  from gi.repository import Gst
+  Gst.init(None)
+
+  frames = max(1, int(seconds * fr))
+  if source == None:
+    launch = 'videotestsrc num-buffers=%d' % frames
+  else:
+    launch = 'filesrc location="%s" ! decodebin ! videoconvert ! videoscale ! videorate' % source
+  launch = launch + ' ! %s ! appsink name=sink sync=false' % frame_caps(width, height, fr)
+  print("Rendering frame cache %s (%d frames)" % (path, frames))
+  pipeline = Gst.parse_launch(launch)
+  sink = pipeline.get_by_name('sink')
+  pipeline.set_state(Gst.State.PLAYING)
+
+  tmp = path + '.tmp'
+  count = 0
+  frame_size = 0
+  with open(tmp, 'wb') as f:
+    f.write(b'\0' * FRAME_OFFSET)
+    while count < frames:
+      sample = sink.emit('pull-sample')
+      if sample == None:
+        break
+      buf = sample.get_buffer()
+      frame_size = buf.get_size()
+      f.write(buf.extract_dup(0, frame_size))
+      count = count + 1
+    f.seek(0)
+    f.write(FILE_HEADER.pack(MAGIC, VERSION, width, height, fr, count, frame_size))
+  pipeline.set_state(Gst.State.NULL)
+  if count == 0:
+    os.unlink(tmp)
+    raise Exception("No frames rendered for %s" % path)
+  os.rename(tmp, path)
+  print("Cached %d frames, %d MB" % (count, count * frame_size // (1024 * 1024)))
+
+def open_frames(path, width, height, fr, seconds=2, source=None):
+  # The FrameCache for a geometry, rendering it first if need be
+  if path == None:
+    path = frame_cache_name(width, height, fr, seconds, source)
+  if not os.path.exists(path):
+    build_frames(path, width=width, height=height, fr=fr, seconds=seconds, source=source)
+  cache = FrameCache(path)
+  if (cache.width, cache.height, cache.framerate) != (width, height, fr):
+    raise Exception("%s holds %dx%d@%d frames, not %dx%d@%d" % (path, cache.width, cache.height, cache.framerate, width, height, fr))
+  return cache
+
+class FrameCache:
+  # Memory-maps a frame file; buffers() wraps its frames for GStreamer.
+
+  def __init__(self, path):
+    self.path = path
+    self.file = open(path, 'rb')
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, self.width, self.height, self.framerate, self.count, self.frame_size = FILE_HEADER.unpack_from(self.map, 0)
+    if magic != MAGIC or version != VERSION:
+      raise Exception("%s is not a version %d frame cache" % (path, VERSION))
+    self.caps = frame_caps(self.width, self.height, self.framerate)
+    self.wrapped = None
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return self.count
+
+  def frame(self, index):
+    start = FRAME_OFFSET + index * self.frame_size
+    return memoryview(self.map)[start:start + self.frame_size]
+
+  def buffers(self):
+    # One GstBuffer per frame, made once and shared by every
+    # flow in the process
+    with self.lock:
+      if self.wrapped == None:
+        self.wrapped = self.wrap()
+      return self.wrapped
+
+  def wrap(self):
+    from gi.repository import Gst
+    try:
+      import gi
+      gi.require_version('GstAllocators', '1.0')
+      from gi.repository import GstAllocators
+    except (ImportError, ValueError):
+      # Without fd memory each process holds one copy of the frames
+      print("GstAllocators not available, copying %s into memory" % self.path)
+      return [Gst.Buffer.new_wrapped(self.frame(i).tobytes()) for i in range(self.count)]
+    # The whole file as one fd memory, each frame a shared slice of it, so
+    # the frames are the file's pages and are mapped once. The file is open
+    # read-only; a private mapping allows that and nothing writes to it.
+    allocator = GstAllocators.FdAllocator.new()
+    flags = GstAllocators.FdMemoryFlags.DONT_CLOSE | GstAllocators.FdMemoryFlags.MAP_PRIVATE
+    whole = GstAllocators.FdAllocator.alloc(allocator, self.file.fileno(), FRAME_OFFSET + self.count * self.frame_size, flags)
+    buffers = []
+    for i in range(self.count):
+      buf = Gst.Buffer.new()
+      buf.append_memory(whole.share(FRAME_OFFSET + i * self.frame_size, self.frame_size))
+      buffers.append(buf)
+    return buffers
+
+  def close(self):
+    self.map.close()
+    self.file.close()
+
+class FrameFeed:
+  # Loops a FrameCache into one live appsrc. Each push is a reference to a
+  # shared frame with this flow's timestamps.
+
+  def __init__(self, cache):
+    self.cache = cache
+    self.buffers = cache.buffers()
+    self.number = 0
+
+  def attach(self, appsrc):
+    from gi.repository import Gst
+    self.duration = Gst.util_uint64_scale(Gst.SECOND, 1, self.cache.framerate)
+    appsrc.set_property('caps', Gst.Caps.from_string(self.cache.caps))
+    appsrc.set_property('format', Gst.Format.TIME)
+    appsrc.set_property('is-live', True)
+    appsrc.set_property('min-latency', self.duration)
+    # One frame queued: the sink's clock sync paces the loop
+    appsrc.set_property('max-bytes', self.cache.frame_size)
+    appsrc.connect('need-data', self.need_data)
+
+  def need_data(self, appsrc, length):
+    buf = self.buffers[self.number % len(self.buffers)].copy()
+    buf.pts = self.number * self.duration
+    buf.dts = buf.pts
+    buf.duration = self.duration
+    self.number = self.number + 1
+    appsrc.emit('push-buffer', buf)
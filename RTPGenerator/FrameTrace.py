@@ -0,0 +1,202 @@
+#!/usr/bin/python
+import mmap
+import argparse
+
+# Frame sizes from a video trace instead of a model. A trace is a text file
+# with one frame per line. It is memory-mapped once and shared: each flow
+# reads it through its own TraceCursor, so thousands of flows cost one file
+# descriptor, and traces hours long sit in the page cache once rather than
+# in every flow. TraceCursor.next_frame() returns (pts in seconds, size in
+# bytes, keyframe) like RTPSynth.FrameModel, so the synth engine sends the
+# trace's frames at the trace's times.
+#
+# Columns are whitespace or comma separated; which column is which is given
+# by a columns spec such as the default 'time,size,type' ('skip' ignores a
+# column). Without a time column frames are 1/fr apart. Type I, IDR or K
+# (or 1/key/true) is a keyframe, anything else is not. Lines starting with
+# '#' and lines whose fields do not parse (column headings) are skipped.
+#
+# Run as a script it extracts such a trace from an H.264/H.265 file (the DASH
+# source, for instance):
+#
+#   python FrameTrace.py -i video.mp4 -o video.trace
+
+COLUMNS = ['time', 'size', 'type', 'skip']
+TIME_UNITS = dict(s=1.0, ms=0.001, us=0.000001, frame=None)
+KEYFRAME_TYPES = ['i', 'idr', 'k', 'key', '1', 'true']
+
+def parse_columns(spec):
+  columns = [c.strip().lower() for c in spec.split(',')]
+  for c in columns:
+    if c not in COLUMNS:
+      raise ValueError("Unknown trace column '%s', expected %s" % (c, ', '.join(COLUMNS)))
+  if 'size' not in columns:
+    raise ValueError("Trace columns '%s' have no size" % spec)
+  return columns
+
+class FrameTrace:
+  # The mapped trace file; cursor() gives a flow its own position in it
+
+  def __init__(self, path, columns='time,size,type', time_unit='s'):
+    if time_unit not in TIME_UNITS:
+      raise ValueError("Unknown trace time unit '%s'" % time_unit)
+    self.path = path
+    self.columns = parse_columns(columns)
+    self.time_unit = TIME_UNITS[time_unit]
+    with open(path, 'rb') as f:
+      try:
+        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      except ValueError:
+        # mmap refuses empty files
+        raise ValueError("Trace %s is empty" % path)
+    # A trace with no frames would leave flows with nothing to send
+    position = 0
+    while position < len(self.map):
+      line, position = self.line_at(position)
+      if self.parse(line) != None:
+        break
+    else:
+      raise ValueError("Trace %s has no frames matching columns %s" % (path, ','.join(self.columns)))
+
+  def line_at(self, position):
+    # (line, position of the next line)
+    end = self.map.find(b'\n', position)
+    if end < 0:
+      end = len(self.map)
+    return self.map[position:end].decode('ascii', 'replace'), end + 1
+
+  def parse(self, line):
+    # (trace time in time units or None, size, keyframe), or None for a line
+    # to skip
+    line = line.strip()
+    if line == '' or line.startswith('#'):
+      return None
+    fields = line.replace(',', ' ').split()
+    if len(fields) < len(self.columns):
+      return None
+    when = None
+    size = None
+    keyframe = False
+    try:
+      for name, value in zip(self.columns, fields):
+        if name == 'time':
+          when = float(value)
+        elif name == 'size':
+          size = int(float(value))
+        elif name == 'type':
+          keyframe = value.lower() in KEYFRAME_TYPES
+    except ValueError:
+      return None
+    if size == None or size <= 0:
+      return None
+    return when, size, keyframe
+
+  def cursor(self, fr=30, loop=True):
+    return TraceCursor(self, fr, loop)
+
+  def close(self):
+    self.map.close()
+
+class TraceCursor:
+  # One flow's way through a FrameTrace
+
+  def __init__(self, trace, fr=30, loop=True):
+    self.trace = trace
+    self.fr = fr
+    self.loop = loop
+    self.position = 0
+    self.frame = 0
+    self.first = None
+    # Added to trace times on each lap, so time keeps going forward
+    self.lap_offset = 0.0
+    self.last_pts = 0.0
+    self.laps = 0
+
+  def read(self):
+    # The next parsed line, going round again at the end if looping
+    trace = self.trace
+    while True:
+      if self.position >= len(trace.map):
+        if not self.loop or self.frame == 0:
+          return None
+        self.position = 0
+        # The next lap starts one frame after this one ended
+        self.lap_offset = self.last_pts + 1.0 / self.fr
+        self.first = None
+        self.laps = self.laps + 1
+        continue
+      line, self.position = trace.line_at(self.position)
+      parsed = trace.parse(line)
+      if parsed != None:
+        return parsed
+
+  def next_frame(self):
+    parsed = self.read()
+    if parsed == None:
+      return None
+    when, size, keyframe = parsed
+    if when == None:
+      pts = float(self.frame) / self.fr
+    else:
+      if self.trace.time_unit == None:
+        when = when / self.fr
+      else:
+        when = when * self.trace.time_unit
+      if self.first == None:
+        self.first = when
+      pts = self.lap_offset + when - self.first
+    self.last_pts = pts
+    self.frame = self.frame + 1
+    return (pts, size, keyframe)
+
+def extract_trace(source, output):
+  # Writes time/size/type lines for the video frames of an encoded file,
+  # in decode order (the order an RTP sender sends them)
+  import gi
+  gi.require_version('Gst', '1.0')
+  from gi.repository import Gst
+  Gst.init(None)
+
+  pipeline = Gst.parse_launch('filesrc location="%s" ! parsebin name=parse' % source)
+  sink = Gst.ElementFactory.make('appsink', 'sink')
+  sink.set_property('sync', False)
+  pipeline.add(sink)
+  parse = pipeline.get_by_name('parse')
+
+  def pad_added(element, pad):
+    caps = pad.get_current_caps() or pad.query_caps(None)
+    name = caps.get_structure(0).get_name()
+    if name.startswith('video/') and not sink.get_static_pad('sink').is_linked():
+      pad.link(sink.get_static_pad('sink'))
+  parse.connect('pad-added', pad_added)
+
+  pipeline.set_state(Gst.State.PLAYING)
+  frames = 0
+  first = None
+  with open(output, 'w') as f:
+    f.write('# time size type, from %s\n' % source)
+    while True:
+      sample = sink.emit('pull-sample')
+      if sample == None:
+        break
+      buf = sample.get_buffer()
+      when = buf.dts
+      if when == Gst.CLOCK_TIME_NONE:
+        when = buf.pts
+      if first == None:
+        first = when
+      keyframe = not buf.has_flags(Gst.BufferFlags.DELTA_UNIT)
+      f.write('%.6f %d %s\n' % (float(when - first) / Gst.SECOND, buf.get_size(), keyframe and 'I' or 'P'))
+      frames = frames + 1
+  pipeline.set_state(Gst.State.NULL)
+  print("Wrote %d frames to %s" % (frames, output))
+
+def main():
+  parser = argparse.ArgumentParser(description='Extract a frame size trace from an encoded video file')
+  parser.add_argument('-i', '--input', required=True, help='H.264/H.265 video file (mp4, mkv, ts, ...).')
+  parser.add_argument('-o', '--output', required=True, help='Trace file to write.')
+  args = parser.parse_args()
+  extract_trace(args.input, args.output)
+
+if __name__ == "__main__":
+  main()
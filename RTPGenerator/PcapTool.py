@@ -0,0 +1,332 @@
+#!/usr/bin/python
+import sys
+import mmap
+import time
+import array
+import random
+import socket
+import struct
+import argparse
+
+import RTPPacket
+from FlowScheduler import PacketFlow, FlowRunner
+from StatsWriter import FORMATS
+
+# Record a generated flow to pcap, and replay a pcap as many flows.
+#
+# record listens on a UDP port (point RTPServer's -c/-p at it) and writes
+# every datagram to a pcap file with IPv4/UDP headers made up from the
+# sender and local addresses, so Wireshark and tcpdump read it too.
+#
+# replay memory-maps a pcap (this tool's, or a tcpdump capture on Ethernet,
+# Linux cooked, loopback or raw IP links), indexes the UDP payloads once and
+# sends them on the capture's timing (or scaled by --speed, or as fast as
+# the sender goes) to each replica. Every replica gets its own destination,
+# SSRC, sequence number base and timestamp base, so one capture becomes many
+# independent flows. Replicas share one socket and scheduler thread and can
+# send with sendmmsg (--batch).
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+GLOBAL_HEADER = struct.Struct('IHHiIII')  # magic, major, minor, thiszone, sigfigs, snaplen, linktype
+RECORD_HEADER = struct.Struct('IIII')  # seconds, fraction, captured length, original length
+IPV4_HEADER = struct.Struct('!BBHHHBBH4s4s')
+UDP_HEADER = struct.Struct('!HHHH')
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+# Link header length by pcap link type (12 and 14 are raw IP on some systems)
+LINK_HEADERS = {LINKTYPE_NULL: 4, LINKTYPE_ETHERNET: 14, LINKTYPE_RAW: 0, 12: 0, 14: 0, LINKTYPE_LINUX_SLL: 16, LINKTYPE_IPV4: 0}
+
+SNAPLEN = 65535
+
+def ip_checksum(header):
+  total = sum(struct.unpack('!10H', header))
+  total = (total >> 16) + (total & 0xffff)
+  total = total + (total >> 16)
+  return ~total & 0xffff
+
+def udp_frame(payload, src, dst):
+  # IPv4 + UDP headers around payload (UDP checksum left out, as allowed)
+  length = IPV4_HEADER.size + UDP_HEADER.size + len(payload)
+  header = IPV4_HEADER.pack(0x45, 0, length, 0, 0x4000, 64, socket.IPPROTO_UDP, 0, socket.inet_aton(src[0]), socket.inet_aton(dst[0]))
+  header = header[:10] + struct.pack('!H', ip_checksum(header)) + header[12:]
+  return header + UDP_HEADER.pack(src[1], dst[1], UDP_HEADER.size + len(payload), 0) + payload
+
+def record(port, path, address='0.0.0.0', timeout=0, count=0):
+  # Writes datagrams arriving on port to path until timeout seconds or
+  # count packets (0 for no limit) or ^C
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+  sock.bind((address, port))
+  local = (address, port)
+  if address == '0.0.0.0':
+    local = ('127.0.0.1', port)
+  sock.settimeout(0.5)
+  packets = 0
+  start = time.time()
+  with open(path, 'wb') as f:
+    f.write(GLOBAL_HEADER.pack(PCAP_MAGIC, 2, 4, 0, 0, SNAPLEN, LINKTYPE_RAW))
+    print("Recording UDP port %d to %s" % (port, path))
+    try:
+      while (timeout <= 0 or time.time() < start + timeout) and (count <= 0 or packets < count):
+        try:
+          data, src = sock.recvfrom(SNAPLEN)
+        except socket.timeout:
+          continue
+        now = time.time()
+        frame = udp_frame(data, src, local)
+        f.write(RECORD_HEADER.pack(int(now), int((now - int(now)) * 1000000), len(frame), len(frame)))
+        f.write(frame)
+        packets = packets + 1
+    except KeyboardInterrupt:
+      print("Killed by ^C")
+  sock.close()
+  print("Recorded %d packets" % packets)
+
+class Capture:
+  # Memory-mapped pcap with the UDP payloads indexed: offsets[i] seconds
+  # from the first packet, payload i at spans[2i]:spans[2i+1] in the map.
+  # Indexes are arrays, not lists of tuples, so large captures stay small.
+
+  def __init__(self, path, port=None):
+    self.path = path
+    self.file = open(path, 'rb')
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic = struct.unpack_from('<I', self.map, 0)[0]
+    if magic in (PCAP_MAGIC, PCAP_MAGIC_NS):
+      order = '<'
+    else:
+      order = '>'
+      magic = struct.unpack_from('>I', self.map, 0)[0]
+    if magic not in (PCAP_MAGIC, PCAP_MAGIC_NS):
+      raise Exception("%s is not a pcap file" % path)
+    scale = 1e-6
+    if magic == PCAP_MAGIC_NS:
+      scale = 1e-9
+    global_header = struct.Struct(order + GLOBAL_HEADER.format)
+    record_header = struct.Struct(order + RECORD_HEADER.format)
+    linktype = global_header.unpack_from(self.map, 0)[6] & 0xffff
+    if linktype not in LINK_HEADERS:
+      raise Exception("%s: unsupported link type %d" % (path, linktype))
+    link = LINK_HEADERS[linktype]
+
+    self.offsets = array.array('d')
+    self.spans = array.array('L')
+    # First sequence number and timestamp of each SSRC, and how far they
+    # run, so replicas can continue numbering from lap to lap
+    self.first_seq = dict()
+    self.first_ts = dict()
+    last_seq = dict()
+    last_ts = dict()
+    first = None
+    pos = global_header.size
+    end = len(self.map)
+    while pos + record_header.size <= end:
+      seconds, fraction, caplen, origlen = record_header.unpack_from(self.map, pos)
+      pos = pos + record_header.size
+      payload = self.udp_payload(pos, caplen, link, linktype, port)
+      pos = pos + caplen
+      if payload == None:
+        continue
+      when = seconds + fraction * scale
+      if first == None:
+        first = when
+      self.offsets.append(when - first)
+      self.spans.append(payload[0])
+      self.spans.append(payload[1])
+      header = RTPPacket.parse_header(self.map[payload[0]:payload[0] + RTPPacket.HEADER_SIZE])
+      if header != None:
+        marker, pt, seq, ts, ssrc = header
+        if ssrc not in self.first_seq:
+          self.first_seq[ssrc] = seq
+          self.first_ts[ssrc] = ts
+        last_seq[ssrc] = seq
+        last_ts[ssrc] = ts
+    if len(self.offsets) == 0:
+      raise Exception("No UDP packets in %s" % path)
+    self.duration = self.offsets[-1]
+    self.ssrcs = sorted(self.first_seq)
+    # The next lap's timestamps start one frame interval (guessed at 30 fps)
+    # after the last ones
+    self.seq_span = dict()
+    self.ts_span = dict()
+    for ssrc in self.ssrcs:
+      self.seq_span[ssrc] = ((last_seq[ssrc] - self.first_seq[ssrc]) & 0xffff) + 1
+      self.ts_span[ssrc] = ((last_ts[ssrc] - self.first_ts[ssrc]) & 0xffffffff) + RTPPacket.CLOCK_RATE // 30
+
+  def udp_payload(self, pos, caplen, link, linktype, port):
+    # (start, end) of the UDP payload in a record, or None to skip it
+    if linktype == LINKTYPE_ETHERNET:
+      ethertype = struct.unpack_from('!H', self.map, pos + 12)[0]
+      if ethertype == 0x8100:
+        # 802.1Q tag
+        link = 18
+        ethertype = struct.unpack_from('!H', self.map, pos + 16)[0]
+      if ethertype != 0x0800:
+        return None
+    elif linktype == LINKTYPE_LINUX_SLL:
+      if struct.unpack_from('!H', self.map, pos + 14)[0] != 0x0800:
+        return None
+    ip = pos + link
+    if caplen < link + IPV4_HEADER.size + UDP_HEADER.size:
+      return None
+    first = struct.unpack_from('!B', self.map, ip)[0]
+    if first >> 4 != 4:
+      return None
+    ihl = (first & 0x0f) * 4
+    total, fragment, protocol = struct.unpack_from('!2xH2xHxB', self.map, ip)
+    # Only whole UDP datagrams
+    if protocol != socket.IPPROTO_UDP or fragment & 0x3fff != 0:
+      return None
+    udp = ip + ihl
+    dst_port, length = struct.unpack_from('!2xHH', self.map, udp)
+    if port != None and dst_port != port:
+      return None
+    start = udp + UDP_HEADER.size
+    stop = min(udp + length, pos + caplen)
+    if stop <= start:
+      return None
+    return start, stop
+
+  def __len__(self):
+    return len(self.offsets)
+
+  def packet(self, index):
+    return self.map[self.spans[2 * index]:self.spans[2 * index + 1]]
+
+  def close(self):
+    self.map.close()
+    self.file.close()
+
+class ReplayFlow(PacketFlow):
+  # One replica of a Capture: its own destination, SSRCs, sequence and
+  # timestamp bases, replayed speed times as fast (0 for no pacing)
+
+  def __init__(self, name, capture, sender, dest, start, speed=1.0, loops=1):
+    PacketFlow.__init__(self, name, sender, dest)
+    self.capture = capture
+    self.start = start
+    self.speed = speed
+    self.loops = loops
+    self.index = 0
+    self.loop = 0
+    # Each captured SSRC maps to a new one; the first is the flow's own
+    self.ssrc_map = dict()
+    self.seq_base = dict()
+    self.ts_base = dict()
+    for n, ssrc in enumerate(capture.ssrcs):
+      new = self.ssrc
+      if n > 0:
+        new = random.getrandbits(32)
+      self.ssrc_map[ssrc] = new
+      self.seq_base[ssrc] = random.getrandbits(16)
+      self.ts_base[ssrc] = random.getrandbits(32)
+    self.lap_time = 0.0
+    if speed > 0:
+      self.lap_time = (capture.duration + 1.0 / 30) / speed
+
+  def next_time(self):
+    if self.speed <= 0:
+      return self.start
+    return self.start + self.loop * self.lap_time + self.capture.offsets[self.index] / self.speed
+
+  def rewrite(self, packet):
+    header = RTPPacket.parse_header(packet)
+    if header == None:
+      return packet
+    marker, pt, seq, ts, ssrc = header
+    cap = self.capture
+    seq = self.seq_base[ssrc] + ((seq - cap.first_seq[ssrc]) & 0xffff) + self.loop * cap.seq_span[ssrc]
+    ts = self.ts_base[ssrc] + ((ts - cap.first_ts[ssrc]) & 0xffffffff) + self.loop * cap.ts_span[ssrc]
+    return RTPPacket.rewrite_header(packet, seq, ts, self.ssrc_map[ssrc])
+
+  def send(self, now):
+    cap = self.capture
+    sent = 0
+    while True:
+      when = self.next_time()
+      if self.speed <= 0:
+        when = now
+      elif when > now:
+        return when
+      self.sendto(self.rewrite(cap.packet(self.index)), when, now)
+      self.index = self.index + 1
+      if self.index == len(cap):
+        self.index = 0
+        self.loop = self.loop + 1
+        if self.loops > 0 and self.loop >= self.loops:
+          return None
+      sent = sent + 1
+      # Unpaced replicas take turns a burst at a time
+      if self.speed <= 0 and sent >= 64:
+        return time.time()
+
+class PcapReplay(FlowRunner):
+
+  def __init__(self, capture, destinations, speed=1.0, loops=1, stagger=0.0, stats_file=None, stats_format='text', flush_interval=1.0, report_interval=1.0, batch=0):
+    FlowRunner.__init__(self, stats_file=stats_file, stats_format=stats_format, flush_interval=flush_interval, report_interval=report_interval, batch=batch)
+    self.capture = capture
+    start = time.time()
+    for i, dest in enumerate(destinations):
+      replica = ReplayFlow('replica%d' % i, capture, self.sender, (socket.gethostbyname(dest[0]), dest[1]), start + i * stagger, speed=speed, loops=loops)
+      self.add_flow(replica, replica.next_time())
+    print("Replaying %d packets (%.1fs, %d SSRCs) from %s to %d replicas" % (len(capture), capture.duration, len(capture.ssrcs), capture.path, len(self.flows)))
+
+def replica_destinations(spec, replicas, port_step=1):
+  # host:port[,host:port...]; with more replicas than destinations the list
+  # is repeated with ports moved on by port_step each time round
+  bases = []
+  for d in spec.split(','):
+    host, port = d.strip().rsplit(':', 1)
+    bases.append((host, int(port)))
+  if replicas <= 0:
+    replicas = len(bases)
+  destinations = []
+  for i in range(replicas):
+    host, port = bases[i % len(bases)]
+    destinations.append((host, port + (i // len(bases)) * port_step))
+  return destinations
+
+def main():
+  parser = argparse.ArgumentParser(description='Record RTP flows to pcap and replay pcaps as many flows')
+  sub = parser.add_subparsers(dest='mode')
+  rec = sub.add_parser('record', help='Write datagrams arriving on a UDP port to a pcap file.')
+  rec.add_argument('-p', '--port', type=int, default=5000, help='UDP port to listen on.')
+  rec.add_argument('-a', '--address', default='0.0.0.0', help='Address to listen on.')
+  rec.add_argument('-o', '--output', required=True, help='pcap file to write.')
+  rec.add_argument('-t', '--timeout', type=float, default=0, help='Seconds to record (0 until ^C).')
+  rec.add_argument('-n', '--count', type=int, default=0, help='Packets to record (0 for no limit).')
+  rep = sub.add_parser('replay', help='Send the UDP payloads of a pcap to one or more replicas.')
+  rep.add_argument('-i', '--input', required=True, help='pcap file to replay.')
+  rep.add_argument('-c', '--client', default='localhost:5000', help='Comma-separated host:port destinations.')
+  rep.add_argument('-n', '--replicas', type=int, default=0, help='Replicas to run (default one per destination); extra ones cycle through the destinations with ports moved on by --port_step.')
+  rep.add_argument('--port_step', type=int, default=1, help='Port increment for each time round the destination list.')
+  rep.add_argument('-P', '--filter_port', type=int, default=None, help='Only replay packets captured to this UDP port.')
+  rep.add_argument('--speed', type=float, default=1.0, help='Replay speed relative to the capture (0 sends as fast as possible).')
+  rep.add_argument('-l', '--loops', type=int, default=1, help='Times through the capture (0 for no end).')
+  rep.add_argument('--stagger', type=float, default=0.0, help='Seconds between replica start times.')
+  rep.add_argument('-t', '--timeout', type=float, default=0, help='Seconds to run (0 until done).')
+  rep.add_argument('--batch', type=int, default=64, help='Packets per sendmmsg() call (0 sends one packet per syscall).')
+  rep.add_argument('-s', '--statfile', default=None, help='Name of file to log stats in.')
+  rep.add_argument('--stats_format', default='text', choices=FORMATS, help='Stats output: the usual text lines, or csv/ndjson with a fixed schema.')
+  rep.add_argument('--flush_interval', default=1.0, type=float, help='Seconds between stats flushes.')
+  rep.add_argument('--report_interval', type=float, default=1.0, help='Seconds between per-replica status lines.')
+  args = parser.parse_args()
+
+  if args.mode == 'record':
+    record(args.port, args.output, address=args.address, timeout=args.timeout, count=args.count)
+  elif args.mode == 'replay':
+    capture = Capture(args.input, port=args.filter_port)
+    replay = PcapReplay(capture, replica_destinations(args.client, args.replicas, args.port_step), speed=args.speed, loops=args.loops, stagger=args.stagger, stats_file=args.statfile, stats_format=args.stats_format, flush_interval=args.flush_interval, report_interval=args.report_interval, batch=args.batch)
+    replay.run(args.timeout)
+    capture.close()
+  else:
+    parser.print_help()
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
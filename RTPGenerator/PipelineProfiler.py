@@ -0,0 +1,174 @@
+#!/usr/bin/python
+import time
+import struct
+import threading
+import collections
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+# Per-element processing time and queue levels for a running pipeline.
+#
+# Every element with a 'sink' and a 'src' pad gets a buffer probe on each:
+# the sink probe notes when a PTS went in, the src probe when it came out,
+# so encoders, scalers, payloaders and decoders all get measured the same
+# way (time spent inside the element, including any frames it holds back).
+# Queue fill is read at report time. The probes only touch a dict, so this
+# costs a few microseconds per buffer and can stay on during real runs.
+#
+# PTS matching needs the PTS to survive the element. rtpjitterbuffer gives
+# packets new timestamps, so its packets are matched by RTP sequence number
+# instead; elements that also drop and duplicate buffers while retiming them
+# cannot be matched either way and are left out. Both are announced when the
+# element is attached.
+
+# Elements not worth measuring
+SKIP = ['capsfilter', 'identity', 'fakesink', 'tee']
+
+# Elements that retime buffers and drop or duplicate them as well
+RETIMED = ['videorate']
+
+# Elements that retime RTP packets but pass each one through once
+MATCH_SEQ = ['rtpjitterbuffer']
+
+# Queue-like elements and the property giving their fill
+LEVELS = dict(queue='current-level-buffers', queue2='current-level-buffers', rtpjitterbuffer='percent')
+
+# Buffers in flight remembered per element; a jitter buffer holds its whole
+# latency's worth of packets
+MAX_PENDING = 64
+MAX_PENDING_SEQ = 4096
+
+def pts_key(buf):
+  return buf.pts
+
+def seq_key(buf):
+  # RTP sequence number, which survives re-timestamping
+  if buf.get_size() < 4:
+    return None
+  return struct.unpack('!H', buf.extract_dup(2, 2))[0]
+
+class ElementTimes:
+
+  def __init__(self, name, key=pts_key, max_pending=MAX_PENDING):
+    self.name = name
+    self.key = key
+    self.max_pending = max_pending
+    self.pending = collections.OrderedDict()
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+class PipelineProfiler:
+
+  def __init__(self, pipeline=None, elements=None, prefix=None):
+    # Profile the given elements, or everything in pipeline including
+    # elements added later (rtspsrc and decodebin children, for instance).
+    # prefix is stripped from element names in the output.
+    self.prefix = prefix
+    self.lock = threading.Lock()
+    self.times = []
+    self.queues = []
+    if elements == None:
+      elements = []
+      if pipeline != None:
+        elements = list(pipeline.iterate_recurse())
+        pipeline.connect('deep-element-added', self.element_added)
+    for element in elements:
+      self.attach(element)
+
+  def label(self, element):
+    name = element.get_name()
+    if self.prefix != None and name.startswith(self.prefix + '_'):
+      return name[len(self.prefix) + 1:]
+    return name
+
+  def element_added(self, bin, sub_bin, element):
+    self.attach(element)
+
+  def attach(self, element):
+    if isinstance(element, Gst.Bin):
+      return
+    factory = element.get_factory()
+    if factory == None or factory.get_name() in SKIP:
+      return
+    if factory.get_name() in LEVELS:
+      with self.lock:
+        self.queues.append((self.label(element), element, LEVELS[factory.get_name()]))
+    sink = element.get_static_pad('sink')
+    src = element.get_static_pad('src')
+    if sink == None or src == None:
+      return
+    key = pts_key
+    max_pending = MAX_PENDING
+    if factory.get_name() in RETIMED:
+      print("Profiler: not timing %s, it drops, duplicates and retimes buffers" % self.label(element))
+      return
+    if factory.get_name() in MATCH_SEQ:
+      print("Profiler: timing %s by RTP sequence number, it retimes buffers" % self.label(element))
+      key = seq_key
+      max_pending = MAX_PENDING_SEQ
+    times = ElementTimes(self.label(element), key, max_pending)
+    with self.lock:
+      self.times.append(times)
+    sink.add_probe(Gst.PadProbeType.BUFFER, self.buffer_in, times)
+    src.add_probe(Gst.PadProbeType.BUFFER, self.buffer_out, times)
+
+  def buffer_in(self, pad, info, times):
+    key = times.key(info.get_buffer())
+    if key == None:
+      return Gst.PadProbeReturn.OK
+    now = time.time()
+    with self.lock:
+      # A frame split over several buffers counts from the first
+      if key not in times.pending:
+        times.pending[key] = now
+        # Buffers the element dropped never come out
+        while len(times.pending) > times.max_pending:
+          times.pending.popitem(last=False)
+    return Gst.PadProbeReturn.OK
+
+  def buffer_out(self, pad, info, times):
+    now = time.time()
+    key = times.key(info.get_buffer())
+    with self.lock:
+      entered = times.pending.pop(key, None)
+      if entered != None:
+        spent = now - entered
+        times.count = times.count + 1
+        times.total = times.total + spent
+        if spent > times.max:
+          times.max = spent
+    return Gst.PadProbeReturn.OK
+
+  def sample(self):
+    # [(name, avg ms, max ms, buffers)] since the last call, and
+    # [(name, level)] for queues right now
+    elements = []
+    with self.lock:
+      for times in self.times:
+        if times.count > 0:
+          elements.append((times.name, 1000.0 * times.total / times.count, 1000.0 * times.max, times.count))
+        times.count = 0
+        times.total = 0.0
+        times.max = 0.0
+      queues = list(self.queues)
+    levels = [(name, element.get_property(prop)) for name, element, prop in queues]
+    return elements, levels
+
+  def report(self):
+    # Text to append to a stats line and the matching record fields
+    elements, levels = self.sample()
+    text = ''
+    extra = dict()
+    if len(elements) > 0:
+      text = text + ' Proc:' + ','.join(['%s=%.2f/%.2fms' % (name, avg, peak) for name, avg, peak, count in elements])
+    if len(levels) > 0:
+      text = text + ' Queues:' + ','.join(['%s=%d' % (name, level) for name, level in levels])
+    for name, avg, peak, count in elements:
+      extra['proc_%s_avg' % name] = avg
+      extra['proc_%s_max' % name] = peak
+    for name, level in levels:
+      extra['queue_%s' % name] = level
+    return text, extra
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+import os
+import mmap
+import random
+import socket
+import struct
+import time
+
+import RTPPacket
+from FlowScheduler import PacketFlow, FlowRunner
+
+# Encode-once packet cache. A cache file holds the rtph264pay output for a
+# few seconds of videotestsrc at one resolution/framerate/GOP, so many flows
+# can replay it instead of each running its own x264enc.
+#
+# Layout: FILE_HEADER, then packet_count records of RECORD followed by the
+# RTP packet itself. Offsets are microseconds from the start of the loop.
+MAGIC = b'RTPC'
+VERSION = 1
+FILE_HEADER = struct.Struct('!4sBHHHHII')  # magic, version, width, height, framerate, gop, packet_count, loop_us
+RECORD = struct.Struct('!IH')  # send offset (us), packet length
+
+def cache_name(width, height, fr, gop, seconds):
+  return 'rtpcache_%dx%d_%dfps_gop%d_%ds.rtpc' % (width, height, fr, gop, seconds)
+
+def build_cache(path, width=1280, height=720, fr=30, gop=50, seconds=10):
+  # Only building needs GStreamer, replay is plain sockets
+  import gi
+  gi.require_version('Gst', '1.0')
+  from gi.repository import Gst
+  Gst.init(None)
+
+  # Whole GOPs only, so the loop restarts on a keyframe
+  frames = max(1, int(seconds * fr))
+  frames = ((frames + gop - 1) // gop) * gop
+  # config-interval=-1 repeats SPS/PPS before every IDR so receivers can join mid-loop
+  launch = ('videotestsrc num-buffers=%d ! video/x-raw,framerate=(fraction)%d/1,width=(int)%d,height=(int)%d ! '
+            'x264enc key-int-max=%d tune=zerolatency speed-preset=superfast ! '
+            'rtph264pay pt=%d config-interval=-1 ! appsink name=sink sync=false' % (frames, fr, width, height, gop, RTPPacket.PAYLOAD_TYPE))
+  print("Building packet cache %s (%d frames)" % (path, frames))
+  pipeline = Gst.parse_launch(launch)
+  sink = pipeline.get_by_name('sink')
+  pipeline.set_state(Gst.State.PLAYING)
+
+  records = []
+  first_pts = None
+  while True:
+    sample = sink.emit('pull-sample')
+    if sample == None:
+      break
+    buf = sample.get_buffer()
+    if first_pts == None:
+      first_pts = buf.pts
+    records.append(((buf.pts - first_pts) // 1000, buf.extract_dup(0, buf.get_size())))
+  pipeline.set_state(Gst.State.NULL)
+  if len(records) == 0:
+    raise Exception("Encoder produced no packets for %s" % path)
+
+  loop_us = frames * 1000000 // fr
+  tmp = path + '.tmp'
+  with open(tmp, 'wb') as f:
+    f.write(FILE_HEADER.pack(MAGIC, VERSION, width, height, fr, gop, len(records), loop_us))
+    for offset, packet in records:
+      f.write(RECORD.pack(offset, len(packet)))
+      f.write(packet)
+  os.rename(tmp, path)
+  print("Cached %d packets covering %.1f seconds" % (len(records), loop_us / 1000000.0))
+
+class PacketCache:
+  # Memory-maps a cache file and indexes its packets. Flows read packet
+  # bytes straight out of the shared map.
+
+  def __init__(self, path):
+    self.path = path
+    self.file = open(path, 'rb')
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, self.width, self.height, self.framerate, self.gop, count, loop_us = FILE_HEADER.unpack_from(self.map, 0)
+    if magic != MAGIC or version != VERSION:
+      raise Exception("%s is not a version %d packet cache" % (path, VERSION))
+    self.loop_time = loop_us / 1000000.0
+    self.loop_ts = loop_us * RTPPacket.CLOCK_RATE // 1000000
+
+    self.offsets = []
+    self.ts_deltas = []
+    self.spans = []
+    pos = FILE_HEADER.size
+    first_ts = None
+    for i in range(count):
+      offset, length = RECORD.unpack_from(self.map, pos)
+      pos = pos + RECORD.size
+      header = RTPPacket.parse_header(self.map[pos:pos + RTPPacket.HEADER_SIZE])
+      if first_ts == None:
+        first_ts = header[3]
+      self.offsets.append(offset / 1000000.0)
+      self.ts_deltas.append((header[3] - first_ts) & 0xffffffff)
+      self.spans.append((pos, pos + length))
+      pos = pos + length
+
+  def __len__(self):
+    return len(self.spans)
+
+  def packet(self, index):
+    start, end = self.spans[index]
+    return self.map[start:end]
+
+  def close(self):
+    self.map.close()
+    self.file.close()
+
+class CacheFlow(PacketFlow):
+  # Replays a PacketCache to one destination with its own SSRC, sequence
+  # numbers and timestamps, looping the cache for as long as it runs.
+
+  def __init__(self, name, cache, sender, dest, start):
+    PacketFlow.__init__(self, name, sender, dest)
+    self.cache = cache
+    self.start = start
+    self.seq = random.getrandbits(16)
+    self.ts_base = random.getrandbits(32)
+    self.index = 0
+    self.loop = 0
+
+  def next_time(self):
+    return self.start + self.loop * self.cache.loop_time + self.cache.offsets[self.index]
+
+  def send(self, now):
+    cache = self.cache
+    while True:
+      when = self.next_time()
+      if when > now:
+        return when
+      ts = self.ts_base + self.loop * cache.loop_ts + cache.ts_deltas[self.index]
+      self.sendto(RTPPacket.rewrite_header(cache.packet(self.index), self.seq, ts, self.ssrc), when, now)
+      self.seq = (self.seq + 1) & 0xffff
+      self.index = self.index + 1
+      if self.index == len(cache):
+        self.index = 0
+        self.loop = self.loop + 1
+
+class CacheReplay(FlowRunner):
+  # Many CacheFlows sharing one socket and one scheduler thread. caches maps
+  # each flow geometry (width, height, framerate) to its PacketCache.
+
+  def __init__(self, caches, flows, stats_file=None, stats_format='text', flush_interval=1.0, report_interval=1.0, batch=0):
+    FlowRunner.__init__(self, stats_file=stats_file, stats_format=stats_format, flush_interval=flush_interval, report_interval=report_interval, batch=batch)
+    self.caches = caches
+
+    # Spread flow start times over one frame so flows do not burst in lockstep
+    start = time.time()
+    for i, flow in enumerate(flows):
+      cache = caches[(flow['width'], flow['height'], flow['framerate'])]
+      dest = (socket.gethostbyname(flow['client']), flow['port'])
+      offset = (float(i) / len(flows)) / cache.framerate
+      replay = CacheFlow('flow%d' % i, cache, self.sender, dest, start + offset)
+      self.add_flow(replay, replay.next_time())
+    print("Replaying %s to %d flows" % (', '.join(sorted(c.path for c in caches.values())), len(self.flows)))
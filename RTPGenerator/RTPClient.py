@@ -7,6 +7,16 @@ import sys
 import argparse
 import time
 import logging
+import socket
+import errno
+import collections
+import threading
+
+import BatchIO
+import RTPPacket
+from FlowStats import FlowStats, percentiles
+from StatsWriter import StatsWriter, FORMATS
+from PipelineProfiler import PipelineProfiler
 
 LOGGER = logging.getLogger(__name__)
 
@@ -20,28 +30,35 @@ except:
   raise
 from gi.repository import Gst, GObject
 
+def rate(count, elapsed):
+  # Per-second rate over the time that actually passed since the last sample
+  if elapsed <= 0:
+    return 0.0
+  return count / float(elapsed)
+
+def latency_summary(latencies):
+  # Text and record fields for one interval's one-way latencies, in ms
+  if len(latencies) == 0:
+    return '', dict()
+  p50, p95, p99 = [1000.0 * x for x in percentiles(latencies)]
+  return (" Latency:%.1f/%.1f/%.1fms" % (p50, p95, p99), dict(latency_p50=p50, latency_p95=p95, latency_p99=p99, latency_frames=len(latencies)))
+
 class RTPClient:
   # gst-launch-1.0 -v  udpsrc port=5000 ! "application/x-rtp, clock-rate=90000, encoding-name=(string)H264, payload=96,framerate=30/1" ! rtph264depay! avdec_h264 ! fpsdisplaysink sync=true text-overlay=false  fps-update-interval=600  video-sink=fakesink
-  def __init__(self, port=5000, timeout=60, width=320, height=240, fr=30, stats_file=None, lazy_printing=False):
+  def __init__(self, port=5000, timeout=60, width=320, height=240, fr=30, stats_file=None, lazy_printing=False, exit_on_stop=True, stats_format='text', flush_interval=1.0, period=1.0, latency=False, profile=False):
     self.use_buffer = True
-    self.metric_period = 1.0
+    self.exit_on_stop = exit_on_stop
+    self.stopped = False
+    self.metric_period = period
     self._logger = logging.getLogger(__name__)
     self.timeout = timeout
     self.fr = fr
     self.exit = False
     self.port = port
-    self.lazy_printing = lazy_printing
-    self.last_report = None
     
-    if stats_file == None:
-      self.stats_file = None
-    else:
-      try:
-        self.stats_file = open(stats_file, 'w')
-      except Exception as e:
-        print(e)
-        self.stats_file = None
-        pass
+    if lazy_printing:
+      flush_interval = None
+    self.writer = StatsWriter(stats_file, format=stats_format, flush_interval=flush_interval)
       
     # We want to exit gracefully
     for i in [x for x in dir(signal) if x.startswith("SIG")]:
@@ -102,6 +119,28 @@ class RTPClient:
     self.depay.link(self.audio)
     self.audio.link(self.fsink)                                                                                        
 
+    # One-way latency from the capture time the server stamps on each frame
+    # (RTPServer -L): remember it by PTS as packets leave the jitter buffer
+    # and match it up when the decoded frame reaches the sink, so jitter
+    # buffer and decode time are included.
+    self.latency = latency
+    if self.latency:
+      # The probes run in different streaming threads
+      self.capture_lock = threading.Lock()
+      self.captures = collections.OrderedDict()
+      self.latencies = []
+      if self.use_buffer:
+        capture_pad = self.buffer.get_static_pad('src')
+      else:
+        capture_pad = self.filter.get_static_pad('src')
+      capture_pad.add_probe(Gst.PadProbeType.BUFFER, self.capture_probe)
+      self.fsink.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, self.render_probe)
+
+    # Per-element processing times and jitter buffer fill in the stats
+    self.profiler = None
+    if profile:
+      self.profiler = PipelineProfiler(self.pipeline)
+
     # Gstreamer bus messages
     self.bus = self.pipeline.get_bus()
     self.bus.add_signal_watch()
@@ -109,33 +148,72 @@ class RTPClient:
 
     # Main loop
     self.mainloop = GObject.MainLoop()
-    GObject.timeout_add(1000, self.update_stats)
+    GObject.timeout_add(int(self.metric_period * 1000), self.update_stats)
   
   def sighandler(self, signum, frame):
     print("Caught signal %d" % signum)
     self.exit = True
   
+  def capture_probe(self, pad, info):
+    buf = info.get_buffer()
+    capture = RTPPacket.capture_time(buf.extract_dup(0, min(buf.get_size(), 64)))
+    if capture != None:
+      with self.capture_lock:
+        if buf.pts not in self.captures:
+          self.captures[buf.pts] = capture
+          # Frames the decoder dropped never come back for theirs
+          while len(self.captures) > 256:
+            self.captures.popitem(last=False)
+    return Gst.PadProbeReturn.OK
+  
+  def render_probe(self, pad, info):
+    now = time.time()
+    with self.capture_lock:
+      capture = self.captures.pop(info.get_buffer().pts, None)
+      if capture != None:
+        self.latencies.append(now - capture)
+    return Gst.PadProbeReturn.OK
+  
   def update_stats(self):
-    ts = str(time.time())
+    if self.stopped:
+      return False
+    now = time.time()
+    ts = str(now)
+    elapsed = now - self.last_report
+    self.last_report = now
     drop = self.fsink.get_property('frames-dropped')
     rend = self.fsink.get_property('frames-rendered')
     maxfps = self.fsink.get_property('max-fps')
     minfps = self.fsink.get_property('min-fps')
+    fps = rate(rend - self.rend, elapsed)
+    drops = rate(drop - self.drop, elapsed)
+    # Latency and profile fields tacked on to the line
+    suffix, extra = '', dict()
+    if self.latency:
+      with self.capture_lock:
+        latencies = self.latencies
+        self.latencies = []
+      suffix, extra = latency_summary(latencies)
+    if self.profiler != None:
+      profile, profile_extra = self.profiler.report()
+      suffix = suffix + profile
+      extra.update(profile_extra)
     if self.use_buffer:
       s = self.buffer.get_property('stats')
       rtx = s.get_value('rtx-count')
       buffer_fill = self.buffer.get_property('percent')
-      mesg = ("%s MIN:%d MAX:%d FPS:%d DropPS:%d RTX-count:%s Buffer:%s" %(ts, minfps, maxfps, (rend-self.rend) ,drop-self.drop, rtx-self.rtx, str(buffer_fill)))
+      mesg = ("%s MIN:%d MAX:%d FPS:%d DropPS:%d RTX-count:%s Buffer:%s%s" %(ts, minfps, maxfps, round(fps), round(drops), rtx-self.rtx, str(buffer_fill), suffix))
+      self.writer.record(mesg, timestamp=now, flow=self.port, fps=fps, drops=drops, rtx=rtx-self.rtx, buffer=buffer_fill, min_fps=minfps, max_fps=maxfps, **extra)
       self.rtx = rtx
     else:
       buffer_fill = 0
-      mesg = ("%s FPS:%d DropPS:%d RTX-count:%s Buffer:%s" %(ts, (rend-self.rend),drop-self.drop, "-1", "-1"))
-    self.output(mesg)
+      mesg = ("%s FPS:%d DropPS:%d RTX-count:%s Buffer:%s%s" %(ts, round(fps), round(drops), "-1", "-1", suffix))
+      self.writer.record(mesg, timestamp=now, flow=self.port, fps=fps, drops=drops, **extra)
     self.drop = drop
     self.rend = rend
-    self.timeout = self.timeout - 1;
-    if self.timeout < 0 or self.exit:
+    if now >= self.started + self.timeout or self.exit:
       self.stop()
+      return False
     return True
   
   def bus_message_tag(self, bus, message):
@@ -149,6 +227,8 @@ class RTPClient:
     if ret == Gst.StateChangeReturn.FAILURE:
       print("Unalbe to set the pipeline to playing.")
       exit(-1)
+    self.started = time.time()
+    self.last_report = self.started
     try:
       self.mainloop.run()
     except KeyboardInterrupt:
@@ -165,40 +245,282 @@ class RTPClient:
     except Exception as e:
       print("Failed to stop Gstreamer pipline.")
     self.exit = True
-    if self.stats_file != None:
+    self.writer.close()
+    sys.stdout.flush()
+    # Clients hosted with others in one process just leave the loop
+    if self.exit_on_stop:
+      exit(1)
+    self.stopped = True
+    self.mainloop.quit()
+  
+
+class RTPHeaderClient:
+  # Measurement-only client: reads RTP headers straight off a UDP socket and
+  # never depayloads or decodes, so it costs a fraction of RTPClient's CPU.
+  # FPS and DropPS count complete and incomplete frames (by marker bit).
+  def __init__(self, port=5000, timeout=60, stats_file=None, lazy_printing=False, exit_on_stop=True, stats_format='text', flush_interval=1.0, period=1.0):
+    self.exit_on_stop = exit_on_stop
+    self.stopped = False
+    self.metric_period = period
+    self.timeout = timeout
+    self.exit = False
+    self.port = port
+    self.stats = FlowStats()
+    
+    if lazy_printing:
+      flush_interval = None
+    self.writer = StatsWriter(stats_file, format=stats_format, flush_interval=flush_interval)
+      
+    # We want to exit gracefully
+    for i in [x for x in dir(signal) if x.startswith("SIG")]:
+      try:
+        signum = getattr(signal,i)
+        signal.signal(signum,self.sighandler)
+      except (RuntimeError,ValueError),m:
+        print "Not handling signal %s"%i
+        pass
+    
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    self.sock.bind(('', self.port))
+    self.sock.setblocking(False)
+    
+    # Main loop
+    self.mainloop = GObject.MainLoop()
+    self.watch = GObject.io_add_watch(self.sock.fileno(), GObject.IO_IN, self.receive)
+    GObject.timeout_add(int(self.metric_period * 1000), self.update_stats)
+  
+  def sighandler(self, signum, frame):
+    print("Caught signal %d" % signum)
+    self.exit = True
+  
+  def receive(self, fd, condition):
+    # Drain everything queued so one wakeup handles a whole burst
+    while True:
+      try:
+        data = self.sock.recv(65536)
+      except socket.error as e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return True
+        raise
+      self.stats.update(data, time.time())
+  
+  def update_stats(self):
+    if self.stopped:
+      return False
+    now = time.time()
+    ts = str(now)
+    delta = self.stats.interval()
+    elapsed = now - self.last_report
+    self.last_report = now
+    fps = rate(delta['frames_complete'], elapsed)
+    drops = rate(delta['frames_incomplete'], elapsed)
+    kbps = rate(delta['bytes'] * 8, elapsed) / 1000
+    latency, extra = latency_summary(self.stats.latency())
+    mesg = ("%s FPS:%d DropPS:%d RTX-count:%s Buffer:%s Lost:%d Reordered:%d Duplicates:%d Jitter:%.2fms Kbps:%d%s" % (ts, round(fps), round(drops), "-1", "-1", delta['lost'], delta['reordered'], delta['duplicates'], self.stats.jitter_ms(), kbps, latency))
+    self.writer.record(mesg, timestamp=now, flow=self.port, fps=fps, drops=drops, loss=delta['lost'], jitter=self.stats.jitter_ms(), kbps=kbps, received=delta['received'], reordered=delta['reordered'], duplicates=delta['duplicates'], **extra)
+    if now >= self.started + self.timeout or self.exit:
+      self.stop()
+      return False
+    return True
+  
+  def run(self):
+    print("Listening for RTP on port %d." % self.port)
+    self.started = time.time()
+    self.last_report = self.started
+    try:
+      self.mainloop.run()
+    except KeyboardInterrupt:
+      print("Killed by ^C")
+      self.stop()
+    except Exception as e:
+      print("Exception: %s" % e)
+      self.stop()
+
+  def stop(self):
+    print("Exiting")
+    GObject.source_remove(self.watch)
+    self.sock.close()
+    self.exit = True
+    self.writer.close()
+    sys.stdout.flush()
+    if self.exit_on_stop:
+      exit(1)
+    self.stopped = True
+    self.mainloop.quit()
+  
+
+class RTPMultiClient:
+  # Header-only accounting for many flows in one process: a socket per port,
+  # all watched by one main loop, a FlowStats per (port, SSRC) and one
+  # shared output. A flow that goes quiet for idle seconds is reported as
+  # ended and forgotten; the process keeps going until its own timeout.
+  def __init__(self, ports, timeout=60, stats_file=None, lazy_printing=False, idle=5.0, reuseport=False, batch=64, stats_format='text', flush_interval=1.0, period=1.0):
+    self.metric_period = period
+    self.timeout = timeout
+    self.exit = False
+    self.idle = idle
+    self.flows = dict()
+    self.sockets = []
+    
+    if lazy_printing:
+      flush_interval = None
+    self.writer = StatsWriter(stats_file, format=stats_format, flush_interval=flush_interval)
+      
+    # We want to exit gracefully
+    for i in [x for x in dir(signal) if x.startswith("SIG")]:
       try:
-        self.stats_file.close()
-      except Exception as e:
-        print("Failed to close stats file: %s" % e)
+        signum = getattr(signal,i)
+        signal.signal(signum,self.sighandler)
+      except (RuntimeError,ValueError),m:
+        print "Not handling signal %s"%i
+        pass
+    
+    for port in ports:
+      sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+      if reuseport:
+        # Lets several receiver processes share the load of one port
+        sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
+      sock.bind(('', port))
+      sock.setblocking(False)
+      if batch > 0 and BatchIO.have_recvmmsg():
+        receiver = BatchIO.BatchReceiver(sock, max_batch=batch)
+      else:
+        receiver = None
+      self.sockets.append(sock)
+      GObject.io_add_watch(sock.fileno(), GObject.IO_IN, self.receive, port, sock, receiver)
+    
+    # Main loop
+    self.mainloop = GObject.MainLoop()
+    GObject.timeout_add(int(self.metric_period * 1000), self.update_stats)
+  
+  def sighandler(self, signum, frame):
+    print("Caught signal %d" % signum)
+    self.exit = True
+  
+  def receive(self, fd, condition, port, sock, receiver):
+    now = time.time()
+    while True:
+      if receiver != None:
+        packets = receiver.receive()
+      else:
+        packets = []
+        try:
+          packets.append(sock.recv(65536))
+        except socket.error as e:
+          if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+      if len(packets) == 0:
+        return True
+      for data in packets:
+        self.account(port, data, now)
+  
+  def account(self, port, data, now):
+    if len(data) < RTPPacket.HEADER_SIZE:
+      return
+    key = (port, RTPPacket.HEADER.unpack_from(data)[4])
+    flow = self.flows.get(key)
+    if flow == None:
+      flow = FlowStats()
+      flow.first_seen = now
+      self.flows[key] = flow
+      self.writer.message("%s Port:%d SSRC:%08x Started" % (str(now), key[0], key[1]))
+    flow.update(data, now)
+    flow.last_seen = now
+  
+  def update_stats(self):
+    now = time.time()
+    ts = str(now)
+    elapsed = now - self.last_report
+    self.last_report = now
+    for key in sorted(self.flows.keys()):
+      flow = self.flows[key]
+      delta = flow.interval()
+      fps = rate(delta['frames_complete'], elapsed)
+      drops = rate(delta['frames_incomplete'], elapsed)
+      kbps = rate(delta['bytes'] * 8, elapsed) / 1000
+      latency, extra = latency_summary(flow.latency())
+      mesg = "%s Port:%d SSRC:%08x FPS:%d DropPS:%d Lost:%d Reordered:%d Duplicates:%d Jitter:%.2fms Kbps:%d%s" % (ts, key[0], key[1], round(fps), round(drops), delta['lost'], delta['reordered'], delta['duplicates'], flow.jitter_ms(), kbps, latency)
+      self.writer.record(mesg, timestamp=now, flow='%d/%08x' % key, fps=fps, drops=drops, loss=delta['lost'], jitter=flow.jitter_ms(), kbps=kbps, received=delta['received'], reordered=delta['reordered'], duplicates=delta['duplicates'], **extra)
+      if now - flow.last_seen > self.idle:
+        self.writer.message("%s Port:%d SSRC:%08x Ended Duration:%.1fs Received:%d Lost:%d Frames:%d" % (ts, key[0], key[1], flow.last_seen - flow.first_seen, flow.received, flow.lost(), flow.frames_complete))
+        del self.flows[key]
+    if now >= self.started + self.timeout or self.exit:
+      self.stop()
+      return False
+    return True
+  
+  def run(self):
+    print("Listening for RTP on %d ports." % len(self.sockets))
+    self.started = time.time()
+    self.last_report = self.started
+    try:
+      self.mainloop.run()
+    except KeyboardInterrupt:
+      print("Killed by ^C")
+      self.stop()
+
+  def stop(self):
+    print("Exiting")
+    self.exit = True
+    for sock in self.sockets:
+      sock.close()
+    self.writer.close()
     sys.stdout.flush()
-    exit(1)
+    self.mainloop.quit()
   
-  def output(self, mesg):
-    if self.stats_file == None:
-      print(mesg)
-      if not self.lazy_printing:
-        sys.stdout.flush()
+
+def parse_ports(spec):
+  # "5000-5099,6000" -> [5000, ..., 5099, 6000]
+  ports = []
+  for part in spec.split(','):
+    part = part.strip()
+    if part == '':
+      continue
+    if '-' in part:
+      first, last = part.split('-')
+      ports.extend(range(int(first), int(last) + 1))
     else:
-      self.stats_file.write(mesg + '\n')
-      if not self.lazy_printing:
-        self.stats_file.flush()
+      ports.append(int(part))
+  return ports
 
 def main():
   GObject.threads_init()
   Gst.init(None)
   parser = argparse.ArgumentParser(description='RTP Client')
   parser.add_argument('-p', '--port', type=int, default=5000, help='RTP server port number')
-  parser.add_argument('-t', '--timeout', type=int, default=60, help='Time to live.')
+  parser.add_argument('-t', '--timeout', type=float, default=60, help='Time to live in seconds.')
+  parser.add_argument('-m', '--period', type=float, default=1.0, help='Seconds between stats samples (e.g. 0.1); rates are per second.')
   parser.add_argument('-s', '--statsfile', default=None, help='File to log stats to.')
   parser.add_argument('-l', '--lazy_printing', default=False, action='store_true') 
   parser.add_argument('-f', '--framerate', default=30, type=int, help='Framerate (should match server)')
   parser.add_argument('-H', '--height', default=720, type=int, help='Geometry of frame: height')
   parser.add_argument('-W', '--width', default=1280, type=int, help='Geometry of frame: width')
+  parser.add_argument('-O', '--header_only', default=False, action='store_true', help='Only parse RTP headers (loss, reordering, jitter, frames by marker bit); no depayload or decode.')
+  parser.add_argument('-P', '--ports', default=None, help='Receive many flows in one process (header-only), e.g. 5000-5099,6000.')
+  parser.add_argument('--idle', default=5.0, type=float, help='Seconds without packets before a flow is reported as ended (with -P).')
+  parser.add_argument('--reuseport', default=False, action='store_true', help='Set SO_REUSEPORT so several processes can share the ports (with -P).')
+  parser.add_argument('--batch', default=64, type=int, help='Datagrams per recvmmsg() call, 0 for one recv per datagram (with -P).')
+  parser.add_argument('--stats_format', default='text', choices=FORMATS, help='Stats output: the usual text lines, or csv/ndjson with a fixed schema.')
+  parser.add_argument('--flush_interval', default=1.0, type=float, help='Seconds between stats flushes (-l only flushes when the buffer fills).')
+  parser.add_argument('--profile', default=False, action='store_true', help='Add per-element processing times (avg/max ms) and queue levels to the stats.')
+  parser.add_argument('-L', '--latency', default=False, action='store_true', help='Report one-way latency percentiles for frames the server stamped (RTPServer -L). Header-only clients always do.')
   args = parser.parse_args()
   
   print(args)
   
-  client = RTPClient(port=args.port, timeout=args.timeout, stats_file=args.statsfile,  width=args.width, height=args.height, fr=args.framerate, lazy_printing=args.lazy_printing)
+  if args.ports != None:
+    client = RTPMultiClient(parse_ports(args.ports), timeout=args.timeout, stats_file=args.statsfile, lazy_printing=args.lazy_printing, idle=args.idle, reuseport=args.reuseport, batch=args.batch, stats_format=args.stats_format, flush_interval=args.flush_interval, period=args.period)
+    client.run()
+    return
+
+  if args.header_only:
+    client = RTPHeaderClient(port=args.port, timeout=args.timeout, stats_file=args.statsfile, lazy_printing=args.lazy_printing, stats_format=args.stats_format, flush_interval=args.flush_interval, period=args.period)
+    client.run()
+    return
+
+  client = RTPClient(port=args.port, timeout=args.timeout, stats_file=args.statsfile,  width=args.width, height=args.height, fr=args.framerate, lazy_printing=args.lazy_printing, stats_format=args.stats_format, flush_interval=args.flush_interval, period=args.period, latency=args.latency, profile=args.profile)
 
   # Set up quitting cleanly
   def signal_handler(signal, frame):
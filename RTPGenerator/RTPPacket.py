@@ -0,0 +1,77 @@
+#!/usr/bin/python
+import struct
+
+# Same values RTPServer puts on the wire through rtph264pay
+PAYLOAD_TYPE = 96
+CLOCK_RATE = 90000
+RTP_VERSION = 2
+
+# V/P/X/CC, M/PT, sequence number, timestamp, SSRC
+HEADER = struct.Struct('!BBHII')
+HEADER_SIZE = HEADER.size
+
+def pack_header(seq, ts, ssrc, marker=False, pt=PAYLOAD_TYPE, extension=False):
+  first = RTP_VERSION << 6
+  if extension:
+    first = first | 0x10
+  second = pt & 0x7f
+  if marker:
+    second = second | 0x80
+  return HEADER.pack(first, second, seq & 0xffff, ts & 0xffffffff, ssrc & 0xffffffff)
+
+def parse_header(data):
+  # Returns (marker, pt, seq, ts, ssrc) or None if this is not an RTP packet
+  if len(data) < HEADER_SIZE:
+    return None
+  first, second, seq, ts, ssrc = HEADER.unpack_from(data)
+  if first >> 6 != RTP_VERSION:
+    return None
+  return (second & 0x80 != 0, second & 0x7f, seq, ts, ssrc)
+
+def rewrite_header(packet, seq, ts, ssrc):
+  # Copy of packet with a new sequence number, timestamp and SSRC
+  out = bytearray(packet)
+  struct.pack_into('!HII', out, 2, seq & 0xffff, ts & 0xffffffff, ssrc & 0xffffffff)
+  return out
+
+# ONVIF replay header extension (rtponviftimestamp): 64-bit NTP capture time,
+# then flags, CSeq and padding
+ONVIF_PROFILE = 0xABAC
+ONVIF_EXTENSION = struct.Struct('!HHQBBH')
+ONVIF_EXTENSION_SIZE = ONVIF_EXTENSION.size
+ONVIF_E_BIT = 0x40
+
+# Seconds from the NTP epoch (1900) to the Unix epoch
+NTP_EPOCH = 2208988800
+
+def parse_extension(data):
+  # Returns (profile, extension data) if the X bit is set, otherwise None
+  if len(data) < HEADER_SIZE:
+    return None
+  first = struct.unpack_from('!B', data)[0]
+  if first & 0x10 == 0:
+    return None
+  offset = HEADER_SIZE + 4 * (first & 0x0f)
+  if len(data) < offset + 4:
+    return None
+  profile, length = struct.unpack_from('!HH', data, offset)
+  end = offset + 4 + 4 * length
+  if len(data) < end:
+    return None
+  return (profile, data[offset + 4:end])
+
+def onvif_extension(capture, last=False):
+  # Extension header and data carrying capture (seconds since the epoch)
+  ntp = int((capture + NTP_EPOCH) * 4294967296.0)
+  flags = 0
+  if last:
+    flags = ONVIF_E_BIT
+  return ONVIF_EXTENSION.pack(ONVIF_PROFILE, 3, ntp, flags, 0, 0)
+
+def capture_time(data):
+  # Capture time in seconds since the epoch from an ONVIF extension, or None
+  extension = parse_extension(data)
+  if extension == None or extension[0] != ONVIF_PROFILE or len(extension[1]) < 8:
+    return None
+  ntp = struct.unpack_from('!Q', extension[1])[0]
+  return ntp / 4294967296.0 - NTP_EPOCH
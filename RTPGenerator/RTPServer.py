@@ -3,6 +3,15 @@ import gi
 import time
 import argparse
 import signal
+import os
+import socket
+import errno
+
+import RTPCache
+import RTPSynth
+import FrameCache
+from StatsWriter import StatsWriter, FORMATS
+from PipelineProfiler import PipelineProfiler
 
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst, GObject
@@ -10,59 +19,88 @@ from gi.repository import Gst, GObject
 GObject.threads_init()
 Gst.init(None)
 
+def install_sighandler(handler):
+  for i in [x for x in dir(signal) if x.startswith("SIG")]:
+    try:
+      signum = getattr(signal,i)
+      signal.signal(signum,handler)
+    except (RuntimeError,ValueError),m:
+      print "Not handling signal %s"%i
+      pass
+
 class RTPServer:
   
   pipeline=None
+  loop=None
   
-  def __init__(self, fr=30, width=320, height=240, port=5000, client='localhost', stats_file=None):
+  def __init__(self, fr=30, width=320, height=240, port=5000, client='localhost', stats_file=None, pipeline=None, name=None, encoder_threads=0, handle_signals=True, stats_format='text', flush_interval=1.0, timestamps=False, profile=False, destinations=None, ttl=None, frames=None):
     self.client=client
     self.port = port
+    self.name = name
     use_timeoverlay = False
     
     # Try to exit gracefully
-    for i in [x for x in dir(signal) if x.startswith("SIG")]:
-      try:
-        signum = getattr(signal,i)
-        signal.signal(signum,self.sighandler)
-      except (RuntimeError,ValueError),m:
-        print "Not handling signal %s"%i
-        pass
+    if handle_signals:
+      install_sighandler(self.sighandler)
     
-    if stats_file != None:
-      try:
-        self.stats_file = open(stats_file, 'w')
-      except Exception as e:
-        print("Could not open stats file: %s." % stats_file)
-        self.stats_file = None
-        pass
-    else:
-      self.stats_file = None
+    self.writer = StatsWriter(stats_file, format=stats_format, flush_interval=flush_interval)
 
-    self.src = Gst.ElementFactory.make('videotestsrc')
-    self.src.set_property("is-live", 1)
+    # Pre-rendered frames from a FrameCache, or videotestsrc rendering each one
+    self.feed = None
+    if frames != None:
+      self.src = Gst.ElementFactory.make('appsrc', self.element_name('src'))
+      self.feed = FrameCache.FrameFeed(frames)
+      self.feed.attach(self.src)
+    else:
+      self.src = Gst.ElementFactory.make('videotestsrc', self.element_name('src'))
+      self.src.set_property("is-live", 1)
     print("Using width %d x height %d at framerate %d" % (width,height,fr))
     self.caps = Gst.Caps('video/x-raw,framerate=(fraction)%d/1,width=(int)%d,height=(int)%d'% (fr,width, height))
     #self.caps =  Gst.Caps('video/x-raw,clock-rate=90000,clock-base=(uint)101553131,seqnum-base=(uint)64602,framerate=(fraction)%d/1,width=%d,height=%d '% (fr, width, height))
-    self.filter = Gst.ElementFactory.make("capsfilter", "filter")
+    self.filter = Gst.ElementFactory.make("capsfilter", self.element_name("filter"))
     self.filter.set_property("caps", self.caps)
     if use_timeoverlay:
-      self.timeoverlay = Gst.ElementFactory.make('timeoverlay')
-    self.encode = Gst.ElementFactory.make('x264enc')
+      self.timeoverlay = Gst.ElementFactory.make('timeoverlay', self.element_name('timeoverlay'))
+    self.encode = Gst.ElementFactory.make('x264enc', self.element_name('encode'))
     self.encode.set_property('key-int-max', 50)
+    # 0 lets x264 pick (1.5 threads per core), which adds up fast with many flows
+    self.encode.set_property('threads', encoder_threads)
     #self.encode.set_property('bframes', 4)
     #self.encode.set_property('bitrate', 500)
     self.encode.set_property('tune', 'zerolatency')
     self.encode.set_property('speed-preset', 'superfast')
-    self.pay = Gst.ElementFactory.make('rtph264pay')
-    self.pay.set_property("name", 'pay0')
+    self.pay = Gst.ElementFactory.make('rtph264pay', self.element_name('pay0'))
     self.pay.set_property("pt", 96)
     
-    # UDP Sink
-    self.sink = Gst.ElementFactory.make('udpsink')
-    self.sink.set_property('host', self.client)  
-    self.sink.set_property('port', self.port)   
+    # Capture time in an ONVIF RTP header extension, for client latency
+    if timestamps:
+      self.stamp = Gst.ElementFactory.make('rtponviftimestamp', self.element_name('stamp'))
+      if self.stamp == None:
+        raise Exception("Timestamps need rtponviftimestamp (gst-plugins-bad onvif plugin)")
+    
+    # UDP Sink. With a list of destinations one encode feeds them all
+    # through multiudpsink, and destinations can come and go while playing.
+    self.destinations = None
+    if destinations == None:
+      self.sink = Gst.ElementFactory.make('udpsink', self.element_name('sink'))
+      self.sink.set_property('host', self.client)  
+      self.sink.set_property('port', self.port)   
+    else:
+      self.sink = Gst.ElementFactory.make('multiudpsink', self.element_name('sink'))
+      self.destinations = []
+      for host, port in destinations:
+        self.add_destination(host, port)
+    if ttl != None:
+      self.sink.set_property('ttl-mc', ttl)
+    self.bytes_served = 0
+    self.last_report = None
+    self.control = None
 
-    self.pipeline = Gst.Pipeline()
+    # Flows run by an RTPFlowGroup share a pipeline with other flows
+    if pipeline == None:
+      self.pipeline = Gst.Pipeline()
+    else:
+      self.pipeline = pipeline
     
     self.pipeline.add(self.src)
     self.pipeline.add(self.filter)
@@ -70,6 +108,8 @@ class RTPServer:
       self.pipeline.add(self.timeoverlay)
     self.pipeline.add(self.encode)
     self.pipeline.add(self.pay)
+    if timestamps:
+      self.pipeline.add(self.stamp)
     self.pipeline.add(self.sink)
     
     self.src.link_filtered(self.filter)
@@ -79,12 +119,99 @@ class RTPServer:
     else:
       self.filter.link(self.encode)
     self.encode.link(self.pay)
-    self.pay.link(self.sink)
+    if timestamps:
+      self.pay.link(self.stamp)
+      self.stamp.link(self.sink)
+    else:
+      self.pay.link(self.sink)
     
     self.bus = self.pipeline.get_bus()
+    
+    # Per-element processing times in the stats
+    self.profiler = None
+    if profile:
+      self.profiler = PipelineProfiler(elements=self.elements(), prefix=self.name)
+  
+  def add_destination(self, host, port):
+    if (host, port) in self.destinations:
+      return False
+    self.sink.emit('add', host, port)
+    self.destinations.append((host, port))
+    return True
+  
+  def remove_destination(self, host, port):
+    if (host, port) not in self.destinations:
+      return False
+    self.sink.emit('remove', host, port)
+    self.destinations.remove((host, port))
+    return True
+  
+  def dest(self):
+    if self.destinations == None:
+      return '%s:%d' % (self.client, self.port)
+    return ','.join(['%s:%d' % d for d in self.destinations])
+  
+  def listen_control(self, port):
+    # Destinations are added and removed at runtime with one-line UDP
+    # commands: "add HOST:PORT", "remove HOST:PORT" or "list".
+    self.control = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.control.bind(('', port))
+    self.control.setblocking(False)
+    GObject.io_add_watch(self.control.fileno(), GObject.IO_IN, self.on_control)
+    print("Listening for destination changes on port %d" % port)
+  
+  def on_control(self, fd, condition):
+    while True:
+      try:
+        data, peer = self.control.recvfrom(2048)
+      except socket.error as e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return True
+        raise
+      reply = self.control_command(data.decode('ascii', 'replace').strip())
+      try:
+        self.control.sendto((reply + '\n').encode('ascii'), peer)
+      except socket.error:
+        pass
+  
+  def control_command(self, line):
+    fields = line.split()
+    if len(fields) == 1 and fields[0] == 'list':
+      return self.dest()
+    if len(fields) != 2 or fields[0] not in ('add', 'remove'):
+      return "error: expected add HOST:PORT, remove HOST:PORT or list"
+    try:
+      host, port = parse_destination(fields[1], self.port)
+    except ValueError as e:
+      return "error: %s" % e
+    if fields[0] == 'add':
+      changed = self.add_destination(host, port)
+    else:
+      changed = self.remove_destination(host, port)
+    if changed:
+      self.output("%s %s %s:%d, %d destinations" % (str(time.time()), fields[0], host, port, len(self.destinations)))
+    return "ok %s" % self.dest()
+  
+  def element_name(self, element):
+    if self.name == None:
+      if element == 'filter' or element == 'pay0':
+        return element
+      return None
+    return '%s_%s' % (self.name, element)
+  
+  def elements(self):
+    elements = [self.src, self.filter, self.encode, self.pay, self.sink]
+    if hasattr(self, 'timeoverlay'):
+      elements.append(self.timeoverlay)
+    if hasattr(self, 'stamp'):
+      elements.append(self.stamp)
+    return elements
   
   def sighandler(self, signum, frame):
     print("Caught signal %d" % signum)
+    if self.loop != None:
+      self.loop.quit()
+      return
     self.stop()
     exit()
   
@@ -96,75 +223,416 @@ class RTPServer:
       return False
     return True
   
-  def pop_messages(self):
-    message = self.bus.timed_pop_filtered(1000, Gst.MessageType.ANY)
-    if message != None:
-      if message.type == Gst.MessageType.ERROR:
-        err, debug = message.parse_error()
-        self.output("Error received from element %s: %s" % (message.src.get_name(), err))
-        self.output("Debugging information: %s" % debug)
-      elif message.type == Gst.MessageType.EOS:
-        self.output("End-Of-Stream reached.")
-        return False
-      elif message.type == Gst.MessageType.STATE_CHANGED:
-        if isinstance(message.src, Gst.Pipeline):
-          old_state, new_state, pending_state = message.parse_state_changed()
-          mesg = "Pipeline state changed from %s to %s." % (old_state.value_nick, new_state.value_nick)
-          self.output(mesg)
-      else:
-        self.output("Unexpected message received. %s " % message.src.get_name())
-        return True
+  def run(self, timeout=0, report_interval=1.0):
+    # Sleeps in the main loop until a bus message or the timeout wakes it
+    self.loop = GObject.MainLoop()
+    self.bus.add_signal_watch()
+    watch = self.bus.connect('message', self.on_message)
+    if self.profiler != None or self.destinations != None:
+      GObject.timeout_add(int(report_interval * 1000), self.on_report)
+    if timeout > 0:
+      GObject.timeout_add(int(timeout * 1000), self.on_timeout)
+    try:
+      self.loop.run()
+    finally:
+      self.bus.disconnect(watch)
+      self.bus.remove_signal_watch()
+      self.loop = None
+  
+  def on_timeout(self):
+    print("Hit timeout. Exiting.")
+    self.loop.quit()
+    return False
+  
+  def on_report(self):
+    now = time.time()
+    # bytes-served counts every copy sent, to all destinations
+    served = self.sink.get_property('bytes-served')
+    if self.last_report != None and now > self.last_report:
+      kbps = (served - self.bytes_served) * 8 / (now - self.last_report) / 1000
+    else:
+      kbps = 0
+    self.bytes_served = served
+    self.last_report = now
+    profile, extra = '', dict()
+    if self.profiler != None:
+      profile, extra = self.profiler.report()
+    mesg = "%s Dest:%s Bytes:%d Kbps:%d%s" % (str(now), self.dest(), served, kbps, profile)
+    self.writer.record(mesg, timestamp=now, flow=self.name, kbps=kbps, dest=self.dest(), bytes=served, **extra)
+    return True
+  
+  def on_message(self, bus, message):
+    if not self.handle_message(message):
+      self.loop.quit()
+    return True
+  
+  def handle_message(self, message):
+    # Returns False once the stream has ended
+    if message.type == Gst.MessageType.ERROR:
+      err, debug = message.parse_error()
+      self.output("Error received from element %s: %s" % (message.src.get_name(), err))
+      self.output("Debugging information: %s" % debug)
+    elif message.type == Gst.MessageType.EOS:
+      self.output("End-Of-Stream reached.")
+      return False
+    elif message.type == Gst.MessageType.STATE_CHANGED:
+      if isinstance(message.src, Gst.Pipeline):
+        old_state, new_state, pending_state = message.parse_state_changed()
+        mesg = "Pipeline state changed from %s to %s." % (old_state.value_nick, new_state.value_nick)
+        self.output(mesg)
+    else:
+      self.output("Unexpected message received. %s " % message.src.get_name())
     return True
   
   def stop(self):
     self.pipeline.set_state(Gst.State.NULL)
-    if self.stats_file != None:
-      self.stats_file.close()
+    if self.control != None:
+      self.control.close()
+      self.control = None
+    self.writer.close()
     
   def output(self, mesg):
-    if self.stats_file == None:
-      print(mesg)  
+    self.writer.message(mesg)
+  
+
+class RTPFlowGroup:
+  # Runs many RTP flows in one process. Flows are packed flows_per_pipeline at a
+  # time into shared pipelines, so N flows cost ceil(N/flows_per_pipeline) 
+  # pipelines, clocks and buses instead of N interpreters each with their own.
+  
+  def __init__(self, flows, flows_per_pipeline=16, encoder_threads=1, stats_file=None, stats_format='text', flush_interval=1.0, timestamps=False, profile=False, frames=None):
+    self.flows = []
+    self.pipelines = []
+    self.element_owner = dict()
+    self.last_report = None
+    
+    install_sighandler(self.sighandler)
+    
+    self.writer = StatsWriter(stats_file, format=stats_format, flush_interval=flush_interval)
+    
+    for i, flow in enumerate(flows):
+      if i % flows_per_pipeline == 0:
+        pipeline = Gst.Pipeline.new('group%d' % len(self.pipelines))
+        self.pipelines.append(pipeline)
+      # frames: FrameCache per (width, height, framerate), shared by flows of that geometry
+      cache = None
+      if frames != None:
+        cache = frames[(flow['width'], flow['height'], flow['framerate'])]
+      server = RTPServer(fr=flow['framerate'], width=flow['width'], height=flow['height'], port=flow['port'], client=flow['client'], pipeline=pipeline, name='flow%d' % i, encoder_threads=encoder_threads, handle_signals=False, timestamps=timestamps, profile=profile, frames=cache)
+      server.state = 'starting'
+      server.bytes_served = 0
+      self.flows.append(server)
+      for element in server.elements():
+        self.element_owner[element.get_name()] = server
+    
+    self.buses = [pipeline.get_bus() for pipeline in self.pipelines]
+    self.loop = None
+    print("Running %d flows in %d pipelines" % (len(self.flows), len(self.pipelines)))
+  
+  def sighandler(self, signum, frame):
+    print("Caught signal %d" % signum)
+    if self.loop != None:
+      self.loop.quit()
+      return
+    self.stop()
+    exit()
+  
+  def set_start(self):
+    for pipeline in self.pipelines:
+      ret = pipeline.set_state(Gst.State.PLAYING)
+      if ret == Gst.StateChangeReturn.FAILURE:
+        self.output("Unable to set pipeline %s to the playing state." % pipeline.get_name())
+        return False
+    for server in self.flows:
+      server.state = 'running'
+    return True
+  
+  def flow_of(self, obj):
+    # Bus messages can come from pads or children of a flow's elements
+    while obj != None:
+      server = self.element_owner.get(obj.get_name())
+      if server != None:
+        return server
+      obj = obj.get_parent()
+    return None
+  
+  def run(self, timeout=0, report_interval=1.0):
+    # One main loop watches every pipeline's bus; reports and the timeout
+    # are timers, so nothing runs between them
+    self.loop = GObject.MainLoop()
+    watches = []
+    for bus in self.buses:
+      bus.add_signal_watch()
+      watches.append((bus, bus.connect('message', self.on_message)))
+    GObject.timeout_add(int(report_interval * 1000), self.on_report)
+    if timeout > 0:
+      GObject.timeout_add(int(timeout * 1000), self.on_timeout)
+    try:
+      self.loop.run()
+    finally:
+      for bus, watch in watches:
+        bus.disconnect(watch)
+        bus.remove_signal_watch()
+      self.loop = None
+  
+  def on_report(self):
+    self.report()
+    return True
+  
+  def on_timeout(self):
+    print("Hit timeout. Exiting.")
+    self.loop.quit()
+    return False
+  
+  def on_message(self, bus, message):
+    if not self.handle_message(message):
+      print("No flows left running. Exiting.")
+      self.loop.quit()
+    return True
+  
+  def handle_message(self, message):
+    # Returns False once every flow has finished
+    if message.type == Gst.MessageType.ERROR:
+      server = self.flow_of(message.src)
+      err, debug = message.parse_error()
+      if server != None:
+        server.state = 'failed'
+        self.output("Error received from flow %s (%s:%d): %s" % (server.name, server.client, server.port, err))
+      else:
+        self.output("Error received from element %s: %s" % (message.src.get_name(), err))
+      self.output("Debugging information: %s" % debug)
+    elif message.type == Gst.MessageType.EOS:
+      self.output("End-Of-Stream reached on %s." % message.src.get_name())
+      for server in self.flows:
+        if server.pipeline == message.src:
+          server.state = 'eos'
     else:
-      self.stats_file.write(mesg)
+      return True
+    for server in self.flows:
+      if server.state == 'running':
+        return True
+    return False
   
+  def report(self):
+    now = time.time()
+    ts = str(now)
+    for server in self.flows:
+      served = server.sink.get_property('bytes-served')
+      if self.last_report != None and now > self.last_report:
+        kbps = (served - server.bytes_served) * 8 / (now - self.last_report) / 1000
+      else:
+        kbps = 0
+      server.bytes_served = served
+      profile, extra = '', dict()
+      if server.profiler != None:
+        profile, extra = server.profiler.report()
+      mesg = "%s Flow:%s Dest:%s:%d State:%s Bytes:%d Kbps:%d%s" % (ts, server.name, server.client, server.port, server.state, served, kbps, profile)
+      self.writer.record(mesg, timestamp=now, flow=server.name, kbps=kbps, dest='%s:%d' % (server.client, server.port), state=server.state, bytes=served, **extra)
+    self.last_report = now
+  
+  def stop(self):
+    for pipeline in self.pipelines:
+      pipeline.set_state(Gst.State.NULL)
+    self.writer.close()
+  
+  def output(self, mesg):
+    self.writer.message(mesg)
+
+
+def parse_destination(spec, port):
+  # host[:port], the port defaulting to -p
+  fields = spec.strip().rsplit(':', 1)
+  if fields[0] == '':
+    raise ValueError("Bad destination '%s', expected host[:port]" % spec)
+  if len(fields) == 1 or fields[1] == '':
+    return (fields[0], port)
+  return (fields[0], int(fields[1]))
+
+def parse_destinations(spec, port):
+  return [parse_destination(d, port) for d in spec.split(',') if d.strip() != '']
+
+def parse_flow(spec, width, height, fr):
+  # client:port[:WIDTHxHEIGHT[:framerate]], missing fields take the -W/-H/-f values
+  fields = spec.strip().split(':')
+  if len(fields) < 2 or len(fields) > 4:
+    raise ValueError("Bad flow '%s', expected client:port[:WIDTHxHEIGHT[:framerate]]" % spec)
+  flow = dict(client=fields[0], port=int(fields[1]), width=width, height=height, framerate=fr)
+  if len(fields) > 2 and fields[2] != '':
+    geometry = fields[2].lower().split('x')
+    flow['width'] = int(geometry[0])
+    flow['height'] = int(geometry[1])
+  if len(fields) > 3 and fields[3] != '':
+    flow['framerate'] = int(fields[3])
+  return flow
+
+def read_flows(flows_file, width, height, fr):
+  flows = []
+  with open(flows_file) as f:
+    for line in f:
+      line = line.split('#')[0].strip()
+      if line != '':
+        flows.append(parse_flow(line, width, height, fr))
+  return flows
+
+def open_frames(args, width, height, fr):
+  if not args.frames:
+    return None
+  return FrameCache.open_frames(args.frame_file, width, height, fr, seconds=args.frame_seconds, source=args.frame_source)
+
+def run_group(args, flows):
+  frames = None
+  if args.frames:
+    frames = dict()
+    for flow in flows:
+      geometry = (flow['width'], flow['height'], flow['framerate'])
+      if geometry not in frames:
+        frames[geometry] = open_frames(args, *geometry)
+  group = RTPFlowGroup(flows, flows_per_pipeline=args.flows_per_pipeline, encoder_threads=args.encoder_threads, stats_file=args.statfile, stats_format=args.stats_format, flush_interval=args.flush_interval, timestamps=args.timestamps, profile=args.profile, frames=frames)
+  if not group.set_start():
+    print("Failed to start.")
+    group.stop()
+    exit(-1)
+
+  print("Started %d flows:" % len(flows))
+  print(args)
+  try:
+    group.run(args.timeout, args.report_interval)
+  except Exception as e:
+    print("Breaking: %s" % e)
+  group.report()
+  group.stop()
+
+def open_cache(path, width, height, fr, gop, seconds):
+  # The PacketCache for a geometry, building it first if need be
+  if path == None:
+    path = RTPCache.cache_name(width, height, fr, gop, seconds)
+  if not os.path.exists(path):
+    RTPCache.build_cache(path, width=width, height=height, fr=fr, gop=gop, seconds=seconds)
+  cache = RTPCache.PacketCache(path)
+  if (cache.width, cache.height, cache.framerate) != (width, height, fr):
+    raise Exception("%s holds %dx%d@%d packets, not %dx%d@%d" % (path, cache.width, cache.height, cache.framerate, width, height, fr))
+  return cache
+
+def run_cache(args, flows):
+  # One packet cache per flow geometry
+  geometries = sorted(set([(flow['width'], flow['height'], flow['framerate']) for flow in flows]))
+  if args.cache != None and len(geometries) > 1:
+    print("--cache names one cache file, but the flows have %d geometries; leave it out to get one cache per geometry." % len(geometries))
+    exit(-1)
+  caches = dict()
+  for geometry in geometries:
+    caches[geometry] = open_cache(args.cache, geometry[0], geometry[1], geometry[2], args.gop, args.cache_seconds)
+  replay = RTPCache.CacheReplay(caches, flows, stats_file=args.statfile, stats_format=args.stats_format, flush_interval=args.flush_interval, report_interval=args.report_interval, batch=args.batch)
+
+  def sighandler(signum, frame):
+    print("Caught signal %d" % signum)
+    replay.stop()
+  install_sighandler(sighandler)
+
+  print("Started server:")
+  print(args)
+  replay.run(args.timeout)
+  for cache in caches.values():
+    cache.close()
+
+def run_synth(args, flows):
+  engine = RTPSynth.SynthEngine(flows, bitrate=args.bitrate, gop=args.gop, keyframe_ratio=args.keyframe_ratio, mtu=args.mtu, timestamps=args.timestamps, stats_file=args.statfile, stats_format=args.stats_format, flush_interval=args.flush_interval, report_interval=args.report_interval, batch=args.batch, trace=args.trace, trace_columns=args.trace_columns, trace_time_unit=args.trace_time_unit, trace_loop=not args.trace_once)
+
+  def sighandler(signum, frame):
+    print("Caught signal %d" % signum)
+    engine.stop()
+  install_sighandler(sighandler)
+
+  print("Started server:")
+  print(args)
+  engine.run(args.timeout)
 
 def main():
   parser = argparse.ArgumentParser(description='Test video source served via RTP')
-  parser.add_argument('-t', '--timeout', type=int, default=0, help="Time till server is automatically killed (if none given, server runs till killed)")
-  parser.add_argument('-c', '--client', default='localhost', help="Client (RTP is 1:1, use RTSP for 1:many)")
+  parser.add_argument('-t', '--timeout', type=float, default=0, help="Time till server is automatically killed (if none given, server runs till killed)")
+  parser.add_argument('-c', '--client', default='localhost', help="Client, or comma-separated host[:port] destinations (unicast or multicast) all fed from one encode")
   parser.add_argument('-p', '--port', type=int, default=5000, help="Server port")
   parser.add_argument('-f', '--framerate', type=int, default=30, help='Desired framerate for video served.')  
   parser.add_argument('-s', '--statfile', default=None, help='Name of file to log stats in.')
   parser.add_argument('-W', '--width', type=int, default=1280, help='Width of video frame.')
   parser.add_argument('-H', '--height', type=int, default=720, help='Height of video frame.')
+  parser.add_argument('--stats_format', default='text', choices=FORMATS, help='Stats output: the usual text lines, or csv/ndjson with a fixed schema.')
+  parser.add_argument('--flush_interval', default=1.0, type=float, help='Seconds between stats flushes.')
+  parser.add_argument('-F', '--flow', action='append', default=[], help='Run a flow client:port[:WIDTHxHEIGHT[:framerate]] in this process (repeatable). Replaces -c/-p.')
+  parser.add_argument('--flows', default=None, help='File with one client:port[:WIDTHxHEIGHT[:framerate]] flow per line.')
+  parser.add_argument('--flows_per_pipeline', type=int, default=16, help='Flows packed into each pipeline in multi-flow mode.')
+  parser.add_argument('--encoder_threads', type=int, default=1, help='x264 threads per flow in multi-flow mode (0 for auto).')
+  parser.add_argument('--report_interval', type=float, default=1.0, help='Seconds between per-flow status lines (multi-flow mode, --profile).')
+  parser.add_argument('-e', '--engine', choices=['gst', 'cache', 'synth'], default='gst', help='gst: live x264enc per flow. cache: replay pre-encoded packets. synth: model-driven RTP packets, no encoding.')
+  parser.add_argument('--cache', default=None, help='Packet cache file for the cache engine (built if missing).')
+  parser.add_argument('--gop', type=int, default=50, help='Keyframe interval when building a packet cache.')
+  parser.add_argument('--cache_seconds', type=int, default=10, help='Seconds of video to encode when building a packet cache.')
+  parser.add_argument('--bitrate', type=int, default=0, help='Synth engine bitrate per flow in kbps (0 picks one from the frame geometry).')
+  parser.add_argument('--keyframe_ratio', type=float, default=8.0, help='Synth engine keyframe size relative to a P frame.')
+  parser.add_argument('--batch', type=int, default=0, help='Packets per sendmmsg() call for the cache/synth engines (0 sends one packet per syscall). See SendBenchmark.py.')
+  parser.add_argument('--mtu', type=int, default=RTPSynth.DEFAULT_MTU, help='Synth engine maximum RTP packet size.')
+  parser.add_argument('-L', '--timestamps', default=False, action='store_true', help='Stamp each frame\'s capture time in an RTP header extension so clients can measure one-way latency (gst and synth engines).')
+  parser.add_argument('--profile', default=False, action='store_true', help='Add per-element processing times (avg/max ms) to the stats every --report_interval (gst engine).')
+  parser.add_argument('--control', type=int, default=0, help='UDP port taking "add HOST:PORT", "remove HOST:PORT" and "list" commands to change destinations while running.')
+  parser.add_argument('--ttl', type=int, default=None, help='Multicast TTL.')
+  parser.add_argument('--trace', default=None, help='Synth engine: take frame sizes, types and times from this trace file instead of the model (see FrameTrace.py).')
+  parser.add_argument('--trace_columns', default='time,size,type', help='What each trace column holds: time, size, type or skip, comma-separated.')
+  parser.add_argument('--trace_time_unit', default='s', choices=['s', 'ms', 'us', 'frame'], help='Unit of the trace time column (frame: frame numbers at -f).')
+  parser.add_argument('--trace_once', default=False, action='store_true', help='End each flow at the end of the trace instead of looping it.')
+  parser.add_argument('--frames', default=False, action='store_true', help='Loop a pre-rendered clip at -W/-H/-f into the encoder instead of running videotestsrc (gst engine).')
+  parser.add_argument('--frame_file', default=None, help='Frame cache file for --frames (rendered if missing; default in /dev/shm, named by geometry).')
+  parser.add_argument('--frame_seconds', type=int, default=2, help='Seconds of video to render into the frame cache.')
+  parser.add_argument('--frame_source', default=None, help='Video file to decode into the frame cache instead of videotestsrc.')
   args = parser.parse_args()
+  if args.engine == 'synth' and args.mtu < RTPSynth.min_mtu(args.timestamps):
+    parser.error("--mtu %d is too small, the synth engine needs at least %d%s" % (args.mtu, RTPSynth.min_mtu(args.timestamps), args.timestamps and ' with -L' or ''))
   GObject.threads_init()
   Gst.init(None)
-  server = RTPServer(fr=args.framerate, width=args.width, height=args.height, port=args.port, client=args.client, stats_file=args.statfile)
+
+  flows = [parse_flow(spec, args.width, args.height, args.framerate) for spec in args.flow]
+  if args.flows != None:
+    flows.extend(read_flows(args.flows, args.width, args.height, args.framerate))
+  destinations = parse_destinations(args.client, args.port)
+  # Shared destinations, --ttl and --control belong to the single-flow gst
+  # server; the multi-flow paths would silently drop them
+  if len(flows) > 0 and len(destinations) > 1:
+    parser.error("-c with several destinations cannot be combined with -F/--flows")
+  if len(flows) > 0 or args.engine != 'gst':
+    for name, value in [('--ttl', args.ttl), ('--control', args.control)]:
+      if value:
+        parser.error("%s needs the gst engine without -F/--flows" % name)
+  if args.engine != 'gst' and len(flows) == 0:
+    # Nothing is shared without an encoder, every destination is a flow
+    for host, port in destinations:
+      flows.append(dict(client=host, port=port, width=args.width, height=args.height, framerate=args.framerate))
+  if args.engine == 'cache':
+    run_cache(args, flows)
+    return
+  if args.engine == 'synth':
+    run_synth(args, flows)
+    return
+  if len(flows) > 0:
+    run_group(args, flows)
+    return
+
+  client, port = destinations[0]
+  if len(destinations) == 1 and args.control == 0:
+    destinations = None
+  server = RTPServer(fr=args.framerate, width=args.width, height=args.height, port=port, client=client, stats_file=args.statfile, stats_format=args.stats_format, flush_interval=args.flush_interval, timestamps=args.timestamps, profile=args.profile, destinations=destinations, ttl=args.ttl, frames=open_frames(args, args.width, args.height, args.framerate))
+  if args.control > 0:
+    server.listen_control(args.control)
 
   if not server.set_start():
     print("Failed to start.")
     exit(-1)
 
-  start = time.time()
   print("Started server:")
   print(args)
-  while True:
-    try:
-      ret = server.pop_messages()
-      if not ret:
-        server.stop()
-        break
-      if args.timeout > 0: 
-        now = time.time()
-        if now > start + args.timeout:
-          print("Hit timeout. Exiting.")
-          server.stop()
-          break
-    except Exception as e:
-      server.stop()
-      print("Breaking: %s" % e)
-      break
+  try:
+    server.run(args.timeout, args.report_interval)
+  except Exception as e:
+    print("Breaking: %s" % e)
+  server.stop()
   
 
 if __name__ == "__main__":
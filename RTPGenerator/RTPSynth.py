@@ -0,0 +1,170 @@
+#!/usr/bin/python
+import random
+import socket
+import time
+
+import RTPPacket
+from FrameTrace import FrameTrace
+from FlowScheduler import PacketFlow, FlowRunner
+
+# Packet-level RTP generator. Nothing is encoded: frame sizes come from a
+# model and the payloads are shaped like rtph264pay output (single NAL units
+# or FU-A fragments, SPS/PPS ahead of keyframes), which is what the network
+# sees. Cheap enough to run thousands of flows from one process.
+
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_FU_A = 28
+SPS_SIZE = 24
+PPS_SIZE = 4
+
+# rtph264pay's default MTU, which includes the RTP header
+DEFAULT_MTU = 1400
+
+# RTP header, FU-A indicator and header, and one byte of NAL unit
+MIN_MTU = RTPPacket.HEADER_SIZE + 3
+
+# Bits per pixel used to pick a bitrate when none is given
+DEFAULT_BPP = 0.1
+
+FILLER = b'\xa5' * 65536
+
+def default_bitrate(width, height, fr):
+  return int(width * height * fr * DEFAULT_BPP / 1000)
+
+def min_mtu(timestamps=False):
+  # Smallest --mtu that can carry a frame, with the ONVIF extension if used
+  if timestamps:
+    return MIN_MTU + RTPPacket.ONVIF_EXTENSION_SIZE
+  return MIN_MTU
+
+def nal_payloads(nal_type, nri, size, mtu):
+  # RTP payloads for one NAL unit of size bytes (header byte included)
+  if mtu < MIN_MTU:
+    raise ValueError("MTU %d leaves no room for payload, at least %d is needed" % (mtu, MIN_MTU))
+  max_payload = mtu - RTPPacket.HEADER_SIZE
+  header = (nri << 5) | nal_type
+  if size <= max_payload:
+    return [bytearray([header]) + FILLER[:size - 1]]
+  payloads = []
+  remaining = size - 1
+  chunk = max_payload - 2
+  first = True
+  while remaining > 0:
+    n = min(chunk, remaining)
+    remaining = remaining - n
+    fu_header = nal_type
+    if first:
+      fu_header = fu_header | 0x80
+    if remaining == 0:
+      fu_header = fu_header | 0x40
+    payloads.append(bytearray([(nri << 5) | NAL_FU_A, fu_header]) + FILLER[:n])
+    first = False
+  return payloads
+
+def frame_payloads(size, keyframe, mtu=DEFAULT_MTU):
+  if keyframe:
+    return nal_payloads(NAL_SPS, 3, SPS_SIZE, mtu) + nal_payloads(NAL_PPS, 3, PPS_SIZE, mtu) + nal_payloads(NAL_IDR, 3, size, mtu)
+  return nal_payloads(NAL_SLICE, 2, size, mtu)
+
+class FrameModel:
+  # Synthetic H.264 frame sizes: a keyframe every gop frames (x264enc
+  # key-int-max in RTPServer) that is keyframe_ratio times the size of a
+  # P frame, with gaussian variation, averaging out at bitrate kbps.
+  #
+  # next_frame() returns (pts in seconds, size in bytes, keyframe).
+
+  def __init__(self, bitrate, fr=30, gop=50, keyframe_ratio=8.0, variation=0.2):
+    self.fr = fr
+    self.gop = gop
+    self.variation = variation
+    gop_bytes = bitrate * 1000 / 8.0 * gop / fr
+    self.p_size = gop_bytes / (gop - 1 + keyframe_ratio)
+    self.i_size = self.p_size * keyframe_ratio
+    self.frame = 0
+
+  def next_frame(self):
+    keyframe = self.frame % self.gop == 0
+    if keyframe:
+      mean = self.i_size
+    else:
+      mean = self.p_size
+    size = max(1, int(random.gauss(mean, mean * self.variation)))
+    pts = float(self.frame) / self.fr
+    self.frame = self.frame + 1
+    return (pts, size, keyframe)
+
+class SynthFlow(PacketFlow):
+  # One RTP flow sending the frames of a frame model on schedule
+
+  def __init__(self, name, model, sender, dest, start, mtu=DEFAULT_MTU, timestamps=False):
+    PacketFlow.__init__(self, name, sender, dest)
+    if mtu < min_mtu(timestamps):
+      raise ValueError("MTU %d is too small, at least %d is needed" % (mtu, min_mtu(timestamps)))
+    self.model = model
+    self.start = start
+    self.mtu = mtu
+    self.timestamps = timestamps
+    if timestamps:
+      # Keep packets within the MTU with the extension added
+      self.mtu = mtu - RTPPacket.ONVIF_EXTENSION_SIZE
+    self.seq = random.getrandbits(16)
+    self.ts_base = random.getrandbits(32)
+    self.frames = 0
+    self.next = model.next_frame()
+
+  def next_time(self):
+    return self.start + self.next[0]
+
+  def send(self, now):
+    while self.next != None:
+      pts, size, keyframe = self.next
+      when = self.start + pts
+      if when > now:
+        return when
+      ts = self.ts_base + int(pts * RTPPacket.CLOCK_RATE)
+      payloads = frame_payloads(size, keyframe, self.mtu)
+      last = len(payloads) - 1
+      for i, payload in enumerate(payloads):
+        if self.timestamps:
+          # The scheduled send time stands in for the capture time
+          header = RTPPacket.pack_header(self.seq, ts, self.ssrc, marker=(i == last), extension=True) + RTPPacket.onvif_extension(when, last=(i == last))
+        else:
+          header = RTPPacket.pack_header(self.seq, ts, self.ssrc, marker=(i == last))
+        self.sendto(header + payload, when, now)
+        self.seq = (self.seq + 1) & 0xffff
+      self.frames = self.frames + 1
+      self.next = self.model.next_frame()
+    return None
+
+class SynthEngine(FlowRunner):
+  # Many SynthFlows sharing one socket and one scheduler thread
+
+  def __init__(self, flows, bitrate=0, gop=50, keyframe_ratio=8.0, mtu=DEFAULT_MTU, timestamps=False, stats_file=None, stats_format='text', flush_interval=1.0, report_interval=1.0, batch=0, trace=None, trace_columns='time,size,type', trace_time_unit='s', trace_loop=True):
+    FlowRunner.__init__(self, stats_file=stats_file, stats_format=stats_format, flush_interval=flush_interval, report_interval=report_interval, batch=batch)
+
+    # One mapped trace, each flow with its own cursor in it
+    if trace != None:
+      trace = FrameTrace(trace, columns=trace_columns, time_unit=trace_time_unit)
+
+    # Spread flow start times over one frame so flows do not burst in lockstep
+    start = time.time()
+    for i, flow in enumerate(flows):
+      rate = bitrate
+      if rate <= 0:
+        rate = default_bitrate(flow['width'], flow['height'], flow['framerate'])
+      # Frame sizes from the trace or the model
+      if trace != None:
+        model = trace.cursor(fr=flow['framerate'], loop=trace_loop)
+      else:
+        model = FrameModel(rate, fr=flow['framerate'], gop=gop, keyframe_ratio=keyframe_ratio)
+      dest = (socket.gethostbyname(flow['client']), flow['port'])
+      offset = (float(i) / len(flows)) / flow['framerate']
+      synth = SynthFlow('flow%d' % i, model, self.sender, dest, start + offset, mtu=mtu, timestamps=timestamps)
+      self.add_flow(synth, synth.next_time())
+    if trace != None:
+      print("Replaying trace %s to %d flows" % (trace.path, len(self.flows)))
+    else:
+      print("Generating %d synthetic flows" % len(self.flows))
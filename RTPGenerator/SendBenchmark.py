@@ -0,0 +1,76 @@
+#!/usr/bin/python
+import os
+import time
+import socket
+import argparse
+
+import BatchIO
+import RTPPacket
+import RTPSynth
+
+# Packets per second per core for one-sendto-per-packet against sendmmsg
+# batches. Packets are built the way RTPSynth builds them (a 720p keyframe is
+# dozens of MTU-sized FU-A packets) so the numbers include packet building.
+# Each path runs --repeat times, the paths taking turns, and the median run
+# is reported, so a noisy host does not favour whichever path ran first.
+
+def cpu_time():
+  t = os.times()
+  return t[0] + t[1]
+
+def frame_packets(frame_size, mtu):
+  packets = []
+  payloads = RTPSynth.frame_payloads(frame_size, True, mtu)
+  for i, payload in enumerate(payloads):
+    packets.append(RTPPacket.pack_header(i, 0, 0x1234, marker=(i == len(payloads) - 1)) + payload)
+  return packets
+
+def run(sender, packets, dest, count):
+  sent = 0
+  start = time.time()
+  cpu = cpu_time()
+  while sent < count:
+    for packet in packets:
+      sender.send(packet, dest)
+    sender.flush()
+    sent = sent + len(packets)
+  wall = time.time() - start
+  cpu = cpu_time() - cpu
+  return sent, wall, cpu
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark batched against unbatched UDP sends')
+  parser.add_argument('-c', '--client', default='127.0.0.1', help='Destination address (nothing needs to be listening).')
+  parser.add_argument('-p', '--port', type=int, default=5000, help='Destination port.')
+  parser.add_argument('-n', '--packets', type=int, default=200000, help='Packets to send per run.')
+  parser.add_argument('--frame_size', type=int, default=60000, help='Bytes per frame; all packets of a frame are flushed together.')
+  parser.add_argument('--mtu', type=int, default=RTPSynth.DEFAULT_MTU, help='Maximum RTP packet size.')
+  parser.add_argument('-r', '--repeat', type=int, default=5, help='Runs per path; the median is reported.')
+  parser.add_argument('-b', '--batch', type=int, action='append', default=[], help='sendmmsg batch size to try (repeatable, default 8, 32 and 64).')
+  args = parser.parse_args()
+
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  dest = (socket.gethostbyname(args.client), args.port)
+  packets = frame_packets(args.frame_size, args.mtu)
+  print("%d packets per frame, %d bytes average" % (len(packets), sum([len(p) for p in packets]) // len(packets)))
+
+  runs = [('sendto', BatchIO.DirectSender(sock))]
+  if BatchIO.have_sendmmsg():
+    for batch in (args.batch or [8, 32, 64]):
+      runs.append(('sendmmsg/%d' % batch, BatchIO.BatchSender(sock, max_batch=batch)))
+  else:
+    print("sendmmsg not available, only running the unbatched path.")
+
+  results = dict([(name, []) for name, sender in runs])
+  for i in range(max(1, args.repeat)):
+    for name, sender in runs:
+      syscalls = sender.syscalls
+      sent, wall, cpu = run(sender, packets, dest, args.packets)
+      results[name].append((sent / max(cpu, 0.001), sent, sender.syscalls - syscalls, wall, cpu))
+  for name, sender in runs:
+    ordered = sorted(results[name])
+    per_core, sent, syscalls, wall, cpu = ordered[len(ordered) // 2]
+    print("%s Packets:%d Syscalls:%d Wall:%.2fs CPU:%.2fs PPS:%d PPS/core:%d (median of %d, %d-%d)" % (name, sent, syscalls, wall, cpu, sent / wall, per_core, len(ordered), ordered[0][0], ordered[-1][0]))
+
+if __name__ == "__main__":
+  main()
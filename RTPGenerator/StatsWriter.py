@@ -0,0 +1,95 @@
+#!/usr/bin/python
+import sys
+import json
+import time
+
+# Stats sink shared by the RTP clients and servers.
+#
+# record() takes a free-text line and the same numbers as fields. In 'text'
+# format the line is written as before; 'csv' and 'ndjson' write the fields
+# with a fixed schema instead. Lines are buffered and written in batches,
+# when flush_lines are waiting or flush_interval seconds have passed, and on
+# close(). flush_interval=None only flushes on a full buffer or close.
+
+FORMATS = ['text', 'csv', 'ndjson']
+
+# timestamp is seconds since the epoch, jitter is in ms, buffer in percent
+FIELDS = ['timestamp', 'flow', 'fps', 'drops', 'rtx', 'buffer', 'loss', 'jitter', 'kbps']
+
+class StatsWriter:
+
+  def __init__(self, path=None, format='text', flush_interval=1.0, flush_lines=256):
+    if format not in FORMATS:
+      raise ValueError("Unknown stats format %s" % format)
+    self.format = format
+    self.flush_interval = flush_interval
+    self.flush_lines = flush_lines
+    self.pending = []
+    self.last_flush = time.time()
+    self.file = None
+    if path != None:
+      try:
+        self.file = open(path, 'w')
+      except Exception as e:
+        print("Could not open stats file: %s." % path)
+        self.file = None
+    if self.format == 'csv':
+      self.pending.append(','.join(FIELDS + ['extra']))
+
+  def stream(self):
+    if self.file != None:
+      return self.file
+    return sys.stdout
+
+  def record(self, text, timestamp=None, flow=None, fps=None, drops=None, rtx=None, buffer=None, loss=None, jitter=None, kbps=None, **extra):
+    if timestamp == None:
+      timestamp = time.time()
+    if self.format == 'text':
+      self.pending.append(text)
+    else:
+      values = [timestamp, flow, fps, drops, rtx, buffer, loss, jitter, kbps]
+      if self.format == 'ndjson':
+        row = dict(zip(FIELDS, values))
+        row.update(extra)
+        self.pending.append(json.dumps(row, sort_keys=True))
+      else:
+        cells = ['' if v == None else str(v) for v in values]
+        cells.append(';'.join(['%s=%s' % (k, extra[k]) for k in sorted(extra.keys())]))
+        self.pending.append(','.join(cells))
+    self.maybe_flush()
+
+  def message(self, text):
+    # Status and error messages. They share the stream in text format but
+    # go to stderr otherwise, so structured output only holds records.
+    if self.format == 'text':
+      self.pending.append(text)
+      self.maybe_flush()
+    else:
+      sys.stderr.write(text + '\n')
+
+  def maybe_flush(self):
+    if len(self.pending) >= self.flush_lines:
+      self.flush()
+    elif self.flush_interval != None and time.time() - self.last_flush >= self.flush_interval:
+      self.flush()
+
+  def flush(self):
+    self.last_flush = time.time()
+    if len(self.pending) == 0:
+      return
+    out = self.stream()
+    out.write('\n'.join(self.pending) + '\n')
+    out.flush()
+    self.pending = []
+
+  def close(self):
+    try:
+      self.flush()
+    except Exception as e:
+      print("Failed to flush stats: %s" % e)
+    if self.file != None:
+      try:
+        self.file.close()
+      except Exception as e:
+        print("Failed to close stats file: %s" % e)
+      self.file = None
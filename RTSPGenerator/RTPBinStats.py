@@ -0,0 +1,125 @@
+#!/usr/bin/python
+import gi
+import time
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+# Receive statistics for every RTP session of an rtpbin (as created by
+# rtspsrc), read by polling at the caller's cadence rather than waiting for
+# on-ssrc-active. Each poll walks the internal sessions' source-stats and the
+# jitter buffers rtpbin made, and returns per-stream deltas since the
+# previous poll. Decoded geometry is kept from caps notifications so it is
+# only worked out when the caps actually change.
+
+# Jitter buffer counters reported as deltas
+JITTERBUFFER_COUNTERS = [('num-pushed', 'pushed'), ('num-lost', 'lost'), ('num-late', 'late'), ('num-duplicates', 'duplicates'), ('rtx-count', 'rtx')]
+
+class StreamStats:
+  # Running totals for one (session, ssrc)
+  def __init__(self, session, ssrc):
+    self.session = session
+    self.ssrc = ssrc
+    self.jitterbuffer = None
+    self.last = dict()
+
+class RTPBinStats:
+
+  def __init__(self, rtpbin):
+    self.rtpbin = rtpbin
+    self.streams = dict()
+    self.width = None
+    self.height = None
+    self.last_poll = time.time()
+    rtpbin.connect('new-jitterbuffer', self.new_jitterbuffer)
+    rtpbin.connect('on-new-ssrc', self.new_ssrc)
+
+  def stream(self, session, ssrc):
+    key = (session, ssrc)
+    stream = self.streams.get(key)
+    if stream == None:
+      stream = StreamStats(session, ssrc)
+      self.streams[key] = stream
+    return stream
+
+  def new_ssrc(self, rtpbin, session, ssrc):
+    self.stream(session, ssrc)
+
+  def new_jitterbuffer(self, rtpbin, jitterbuffer, session, ssrc):
+    self.stream(session, ssrc).jitterbuffer = jitterbuffer
+
+  def watch_geometry(self, pad):
+    # Follow the negotiated frame size on pad (a decoder's output)
+    pad.connect('notify::caps', self.caps_changed)
+    self.caps_changed(pad, None)
+
+  def caps_changed(self, pad, pspec):
+    caps = pad.get_current_caps()
+    if caps == None or caps.get_size() == 0:
+      return
+    structure = caps.get_structure(0)
+    ok, width = structure.get_int('width')
+    ok2, height = structure.get_int('height')
+    if ok and ok2:
+      self.width = width
+      self.height = height
+
+  def geometry(self):
+    if self.width == None:
+      return None
+    return '%dx%d' % (self.width, self.height)
+
+  def source_stats(self, session):
+    # Structures for the remote sources of an internal session, by SSRC
+    internal = self.rtpbin.emit('get-internal-session', session)
+    if internal == None:
+      return dict()
+    sources = dict()
+    for source in internal.get_property('stats').get_value('source-stats'):
+      ok, is_internal = source.get_boolean('internal')
+      if ok and is_internal:
+        continue
+      ok, ssrc = source.get_uint('ssrc')
+      if ok:
+        sources[ssrc] = source
+    return sources
+
+  def poll(self):
+    # [dict per stream] with counter deltas since the previous poll, jitter
+    # in ms, bitrate in kbps and jitter buffer fill in percent
+    now = time.time()
+    elapsed = now - self.last_poll
+    self.last_poll = now
+    results = []
+    sessions = dict()
+    for key in sorted(self.streams.keys()):
+      stream = self.streams[key]
+      if stream.session not in sessions:
+        sessions[stream.session] = self.source_stats(stream.session)
+      source = sessions[stream.session].get(stream.ssrc)
+      if source == None and stream.jitterbuffer == None:
+        continue
+      counters = dict()
+      result = dict(session=stream.session, ssrc=stream.ssrc)
+      if source != None:
+        counters['received'] = source.get_uint64('packets-received')[1]
+        counters['bytes'] = source.get_uint64('octets-received')[1]
+        counters['source_lost'] = source.get_int('packets-lost')[1]
+        clock_rate = source.get_int('clock-rate')[1]
+        if clock_rate > 0:
+          result['jitter'] = 1000.0 * source.get_uint('jitter')[1] / clock_rate
+      if stream.jitterbuffer != None:
+        stats = stream.jitterbuffer.get_property('stats')
+        for field, name in JITTERBUFFER_COUNTERS:
+          counters[name] = stats.get_uint64(field)[1]
+        result['buffer'] = stream.jitterbuffer.get_property('percent')
+      for name in counters:
+        result[name] = counters[name] - stream.last.get(name, 0)
+      stream.last = counters
+      if 'bytes' in result and elapsed > 0:
+        result['kbps'] = result['bytes'] * 8 / elapsed / 1000
+      # Loss as the jitter buffer saw it, else from the RTCP-style count
+      if 'lost' not in result and 'source_lost' in result:
+        result['lost'] = max(0, result['source_lost'])
+      results.append(result)
+    return results
@@ -1,6 +1,8 @@
 #!/usr/bin/python 
 
 import gi
+import os
+import sys
 import time
 import signal
 import argparse
@@ -15,31 +17,35 @@ logging.basicConfig(level=logging.DEBUG)
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst, GObject, GstRtspServer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RTPGenerator'))
+from PipelineProfiler import PipelineProfiler
+from RTPBinStats import RTPBinStats
+from StatsWriter import StatsWriter, FORMATS
+
 class RTSPClient:
   #gst-launch-1.0 -v rtspsrc location="rtsp://localhost:5000/video" ! rtph264depay ! avdec_h264 ! fpsdisplaysink sync=true text-overlay=false fps-update-interval=600 video-sink=fakesink
-  def __init__(self, server='localhost', port=5000, timeout=60):
-    self.rtpbin_last_rtpstats = {}
-    self.prev_packets_lost = 0
-    self.packets_lost = 0
-    self.metric_period = 1.0
+  def __init__(self, server='localhost', port=5000, timeout=60, period=5.0, profile=False, stats_file=None, stats_format='text', flush_interval=1.0):
+    self.metric_period = period
     self._logger = logging.getLogger(__name__)
     self.timeout = timeout
+    self.writer = StatsWriter(stats_file, format=stats_format, flush_interval=flush_interval)
     
     # Stats
     self.rend = 0
     self.drop = 0
-    self.last_jitterbuffer_stats = dict()
-    self.session_stats = dict()
+    self.rtpstats = None
     
     self.location = "rtsp://%s:%d/video" % (server, port)
     self.pipeline = Gst.parse_launch('rtspsrc drop-on-latency=true location="%s" name="src" ! rtph264depay ! avdec_h264 ! fpsdisplaysink name=sink sync=true text-overlay=false fps-update-interval=600 video-sink=fakesink' % self.location)
     self.sink = self.pipeline.get_by_name('sink')
     self.pad = self.sink.get_static_pad('sink')
-    self.caps = self.pad.get_current_caps()
     self.source = self.pipeline.get_by_name('src')
     self.source.connect("new-manager", self.new_src_manager)
-    self.last_jitterbuffer = None
     
+    # Per-element processing times, including what rtspsrc adds later
+    self.profiler = None
+    if profile:
+      self.profiler = PipelineProfiler(self.pipeline)
     
     # Gstreamer bus messages
     self.bus = self.pipeline.get_bus()
@@ -48,87 +54,80 @@ class RTSPClient:
 
     # Main loop
     self.mainloop = GObject.MainLoop()
-    GObject.timeout_add(1000 * 5, self.update_stats)
+    GObject.timeout_add(int(self.metric_period * 1000), self.update_stats)
   
   def new_src_manager(self, rtspsrc, manager):
+    # Every session and jitter buffer of the rtpbin is polled from update_stats
     self.rtpbin = manager
-    self.rtpbin.connect("on-ssrc-active", self.ssrc_active)
+    self.rtpstats = RTPBinStats(manager)
+    self.rtpstats.watch_geometry(self.pad)
   
-  def ssrc_active(self, rtpbin, session_id, ssrc):
-    assert rtpbin == self.rtpbin
-    session = rtpbin.emit("get-internal-session", session_id)
-    if session is not None:
-      source = session.emit("get-source-by-ssrc", ssrc)
-      stats = source.get_property('stats')
-      if stats is not None:
-        for tag in ['jitter']:
-          self.session_stats[tag] = stats.get_uint(tag)[1]
-        for tag in ['bitrate', 'packets-received', 'packets-lost']:
-          if tag != 'packets-lost':
-            value = stats.get_uint64(tag)[1]
-          else:
-            value = stats.get_int(tag)[1]
-          if tag == 'bitrate':
-            value = "%s" % (str(float(value)/1000) + 'kbps')
-          if tag in self.session_stats and self.session_stats[tag] != value:
-            self.session_stats[tag+'last'] = self.session_stats[tag]
-            self.session_stats[tag] = value
-          elif tag not in self.session_stats:
-            self.session_stats[tag+'last'] = 0
-            self.session_stats[tag] = value
-          else:
-            self.session_stats[tag] = value
-        caps = "%s" % self.pad.get_current_caps()
-        if caps != None:
-          if 'width' in caps:
-            width = caps.split('width=')[1].split(',')[0]
-            if 'height' in caps:
-              height = caps.split('height=')[1].split(',')[0]
-              self.session_stats['geometry'] = '%sx%s' %(width, height)
-
-    
   def update_stats(self):
+    now = time.time()
+    elapsed = now - self.last_report
+    self.last_report = now
     drop = self.sink.get_property('frames-dropped')
     rend = self.sink.get_property('frames-rendered')
-    if self.last_jitterbuffer != None:
-      buffer_stats = self.last_jitterbuffer.get_property('stats')
-      old_jstats = self.last_jitterbuffer_stats
-      new_stats = dict(num_lost=buffer_stats.get_uint64('num-lost')[1], num_late=buffer_stats.get_uint64('num-late')[1], num_dup=buffer_stats.get_uint64('num-duplicates')[1] , rtx_count=buffer_stats.get_uint64('rtx-count')[1], rtx_success_count=buffer_stats.get_uint64('rtx-success-count')[1])
-      self.last_jitterbuffer_stats = new_stats    
-      diff_stats = { name: val - old_jstats.get(name, 0) for name, val in new_stats.items() }
-      diff_stats['buffer'] = self.last_jitterbuffer.get_property('percent')
-    else:
-      diff_stats = {}
-    
     
-    output_msg = "ts:%d," % int(time.time())
-    #for tag in ['num_late', 'num_lost', 'num_dup', 'rtx_count', 'rtx_success_count', 'buffer']:
-    #  if tag in diff_stats:
-    #    output_msg = output_msg + tag + ":%d," % (diff_stats[tag])
-    for tag in self.session_stats:
-      if 'last' not in tag:
-        if tag in ['packets-received', 'packets-lost']:
-          output_msg = output_msg + tag + ":%d," % (self.session_stats[tag] - self.session_stats[tag+'last'])
-        elif tag in ['geometry', 'bitrate']:
-          output_msg = output_msg + tag + ":%s," % (self.session_stats[tag])
-        else:
-          output_msg = output_msg + tag + ":%d," % (self.session_stats[tag])
-    output_msg = output_msg + "FPS:%d" %((rend-self.rend)/5)
-    print(output_msg)
+    output_msg = "ts:%d," % int(now)
+    # The same numbers as record fields; totals go in the 'all' flow
+    fields = dict()
+    extra = dict()
+    streams = []
+    if self.rtpstats != None:
+      geometry = self.rtpstats.geometry()
+      if geometry != None:
+        output_msg = output_msg + "geometry:%s," % geometry
+        extra['geometry'] = geometry
+      streams = self.rtpstats.poll()
+      # Totals over every stream, then each stream if there is more than one
+      total = dict(received=0, lost=0, late=0, duplicates=0, kbps=0.0)
+      jitter = 0.0
+      for stream in streams:
+        for name in total:
+          total[name] = total[name] + stream.get(name, 0)
+        jitter = max(jitter, stream.get('jitter', 0.0))
+      if len(streams) > 0:
+        output_msg = output_msg + "packets-received:%d,packets-lost:%d,late:%d,duplicates:%d,jitter-ms:%.2f,bitrate:%.1fkbps," % (total['received'], total['lost'], total['late'], total['duplicates'], jitter, total['kbps'])
+        fields = dict(loss=total['lost'], jitter=jitter, kbps=total['kbps'])
+        extra.update(received=total['received'], late=total['late'], duplicates=total['duplicates'])
+      if len(streams) > 1:
+        for stream in streams:
+          output_msg = output_msg + "session%d-%08x:%d/%d/%.2fms/%.1fkbps," % (stream['session'], stream['ssrc'], stream.get('received', 0), stream.get('lost', 0), stream.get('jitter', 0.0), stream.get('kbps', 0.0))
+    # Normalise by the time that actually passed, not the nominal period
+    if elapsed > 0:
+      fps = (rend - self.rend) / elapsed
+      drops = (drop - self.drop) / elapsed
+    else:
+      fps = 0
+      drops = 0
+    output_msg = output_msg + "FPS:%d" % round(fps)
+    if self.profiler != None:
+      elements, levels = self.profiler.sample()
+      for name, avg, peak, count in elements:
+        output_msg = output_msg + ",proc-%s:%.2f/%.2fms" % (name, avg, peak)
+        extra['proc_%s_avg' % name] = avg
+        extra['proc_%s_max' % name] = peak
+      for name, level in levels:
+        output_msg = output_msg + ",queue-%s:%d" % (name, level)
+        extra['queue_%s' % name] = level
+    fields.update(extra)
+    self.writer.record(output_msg, timestamp=now, flow='all', fps=fps, drops=drops, **fields)
+    # Each stream as its own record when there is more than one; the text
+    # line already carries them
+    if len(streams) > 1 and self.writer.format != 'text':
+      for stream in streams:
+        self.writer.record(None, timestamp=now, flow='%d/%08x' % (stream['session'], stream['ssrc']), loss=stream.get('lost', 0), jitter=stream.get('jitter', 0.0), kbps=stream.get('kbps', 0.0), received=stream.get('received', 0), late=stream.get('late', 0), duplicates=stream.get('duplicates', 0))
     self.drop = drop
     self.rend = rend
-    self.timeout = self.timeout - 1;
-    if self.timeout < 0:
+    if now >= self.started + self.timeout:
       self.stop()
     return True
   
   def handle_message(self, bus, msg):
-    if msg.type == Gst.MessageType.STREAM_STATUS:
-      status, owner = msg.parse_stream_status()
-      if owner.get_name() == 'rtpjitterbuffer0':
-        self.last_jitterbuffer = owner
-        self.last_jitterbuffer_stats = dict()
-        #self.last_jitterbuffer.set_property('do-retransmission', 1)
+    if msg.type == Gst.MessageType.ERROR:
+      err, debug = msg.parse_error()
+      self.writer.message("Error received from element %s: %s" % (msg.src.get_name(), err))
 
   def run(self):
     print("Setting pipeline to play.")
@@ -137,11 +136,14 @@ class RTSPClient:
     if ret == Gst.StateChangeReturn.FAILURE:
       print("Unalbe to set the pipeline to playing.")
       exit(-1)
+    self.started = time.time()
+    self.last_report = self.started
     self.mainloop.run()
 
   def stop(self):
-    print("Exiting")
+    self.writer.message("Exiting")
     self.pipeline.set_state(Gst.State.NULL)
+    self.writer.close()
     self.exit = True
     exit(1)
 
@@ -151,9 +153,14 @@ if __name__ == "__main__":
   parser = argparse.ArgumentParser(description='RTSP/RTP Client')
   parser.add_argument('-s', '--server', default='localhost', help='RTSP server name or address')
   parser.add_argument('-p', '--port', type=int, default=5000, help='RTSP server port number')
-  parser.add_argument('-t', '--timeout', type=int, default=60, help='Time to live.')
+  parser.add_argument('-t', '--timeout', type=float, default=60, help='Time to live in seconds.')
+  parser.add_argument('-m', '--period', type=float, default=5.0, help='Seconds between stats samples; FPS is per second.')
+  parser.add_argument('--profile', default=False, action='store_true', help='Add per-element processing times (avg/max ms) and queue levels to the stats.')
+  parser.add_argument('--statsfile', default=None, help='File to log stats to.')
+  parser.add_argument('--stats_format', default='text', choices=FORMATS, help='Stats output: the usual text lines, or csv/ndjson with a fixed schema.')
+  parser.add_argument('--flush_interval', default=1.0, type=float, help='Seconds between stats flushes.')
   args = parser.parse_args()
              
-  client = RTSPClient(server=args.server, port=args.port, timeout=args.timeout)
+  client = RTSPClient(server=args.server, port=args.port, timeout=args.timeout, period=args.period, profile=args.profile, stats_file=args.statsfile, stats_format=args.stats_format, flush_interval=args.flush_interval)
   client.run()
     
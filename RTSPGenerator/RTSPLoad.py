@@ -0,0 +1,282 @@
+#!/usr/bin/python
+import gi
+import os
+import sys
+import time
+import signal
+import struct
+import argparse
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GObject
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RTPGenerator'))
+from FlowStats import percentiles
+from StatsWriter import StatsWriter, FORMATS
+
+# RTSP load generator: N viewer sessions in one process, each its own
+# rtspsrc pipeline on one shared main loop. Sessions are started on a ramp,
+# can skip decoding altogether (RTP straight into a fakesink), and every
+# session records how long DESCRIBE, SETUP and PLAY took and when its first
+# packet and first frame arrived.
+
+# Connect phases, in order, as milliseconds since the session started
+PHASES = ['describe', 'setup', 'play', 'first_packet', 'first_frame']
+
+class RTSPSession:
+
+  def __init__(self, index, location, decode=True, latency=200, tcp=False):
+    self.index = index
+    self.location = location
+    self.decode = decode
+    self.state = 'pending'
+    self.started = None
+    self.times = dict()
+    self.jitterbuffer = None
+    self.frames = 0
+    self.last = dict(frames=0, packets=0, lost=0, late=0, duplicates=0)
+
+    src = 'rtspsrc location="%s" latency=%d name=src' % (location, latency)
+    if tcp:
+      src = src + ' protocols=tcp'
+    if decode:
+      self.pipeline = Gst.parse_launch('%s ! rtph264depay ! avdec_h264 ! fpsdisplaysink name=sink sync=false text-overlay=false signal-fps-measurements=false video-sink=fakesink' % src)
+    else:
+      self.pipeline = Gst.parse_launch('%s ! fakesink name=sink sync=false' % src)
+    self.source = self.pipeline.get_by_name('src')
+    self.sink = self.pipeline.get_by_name('sink')
+    self.source.connect('on-sdp', self.on_sdp)
+    self.source.connect('pad-added', self.pad_added)
+    self.source.connect('new-manager', self.new_manager)
+    self.sink.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, self.sink_buffer)
+
+    self.bus = self.pipeline.get_bus()
+    self.bus.add_signal_watch()
+    self.bus.connect('message', self.on_message)
+
+  def mark(self, phase):
+    if phase not in self.times and self.started != None:
+      self.times[phase] = 1000.0 * (time.time() - self.started)
+
+  def start(self):
+    self.started = time.time()
+    self.state = 'connecting'
+    if self.pipeline.set_state(Gst.State.PLAYING) == Gst.StateChangeReturn.FAILURE:
+      self.state = 'failed'
+
+  def stop(self):
+    self.pipeline.set_state(Gst.State.NULL)
+    self.bus.remove_signal_watch()
+
+  def on_sdp(self, rtspsrc, sdp):
+    self.mark('describe')
+
+  def new_manager(self, rtspsrc, manager):
+    manager.connect('new-jitterbuffer', self.new_jitterbuffer)
+
+  def new_jitterbuffer(self, rtpbin, jitterbuffer, session, ssrc):
+    self.jitterbuffer = jitterbuffer
+
+  def pad_added(self, rtspsrc, pad):
+    pad.add_probe(Gst.PadProbeType.BUFFER, self.first_packet)
+
+  def first_packet(self, pad, info):
+    self.mark('first_packet')
+    return Gst.PadProbeReturn.REMOVE
+
+  def sink_buffer(self, pad, info):
+    if self.decode:
+      # Decoded frames are counted by fpsdisplaysink, only the first matters
+      self.first_frame()
+      return Gst.PadProbeReturn.REMOVE
+    # Undecoded RTP: a frame has arrived with its last packet (marker bit),
+    # so the probe stays and counts frames for the FPS figures
+    second = struct.unpack('!B', info.get_buffer().extract_dup(1, 1))[0]
+    if second & 0x80:
+      self.frames = self.frames + 1
+      if self.frames == 1:
+        self.first_frame()
+    return Gst.PadProbeReturn.OK
+
+  def first_frame(self):
+    self.mark('first_frame')
+    self.state = 'playing'
+
+  def on_message(self, bus, message):
+    if message.type == Gst.MessageType.PROGRESS:
+      # rtspsrc reports each request as it completes
+      progress, code, text = message.parse_progress()
+      if progress == Gst.ProgressType.COMPLETE:
+        if code == 'open':
+          self.mark('setup')
+        elif code == 'request' and 'PLAY' in text:
+          self.mark('play')
+    elif message.type == Gst.MessageType.ERROR:
+      err, debug = message.parse_error()
+      self.state = 'failed'
+      self.error = str(err)
+    elif message.type == Gst.MessageType.EOS:
+      self.state = 'eos'
+    return True
+
+  def counters(self):
+    now = dict(frames=0, packets=0, lost=0, late=0, duplicates=0)
+    if self.decode:
+      now['frames'] = self.sink.get_property('frames-rendered')
+    else:
+      now['frames'] = self.frames
+    if self.jitterbuffer != None:
+      stats = self.jitterbuffer.get_property('stats')
+      now['packets'] = stats.get_uint64('num-pushed')[1]
+      now['lost'] = stats.get_uint64('num-lost')[1]
+      now['late'] = stats.get_uint64('num-late')[1]
+      now['duplicates'] = stats.get_uint64('num-duplicates')[1]
+    return now
+
+  def interval(self):
+    # Counter deltas since the previous call
+    now = self.counters()
+    delta = dict([(name, now[name] - self.last[name]) for name in now])
+    self.last = now
+    return delta
+
+class RTSPLoad:
+
+  def __init__(self, location, sessions=10, ramp=1.0, timeout=60, period=1.0, decode=True, latency=200, tcp=False, per_session=True, stats_file=None, stats_format='text', flush_interval=1.0):
+    self.ramp = ramp
+    self.timeout = timeout
+    self.period = period
+    self.per_session = per_session
+    self.writer = StatsWriter(stats_file, format=stats_format, flush_interval=flush_interval)
+    self.sessions = [RTSPSession(i, location, decode=decode, latency=latency, tcp=tcp) for i in range(sessions)]
+    self.next_session = 0
+    self.reported = set()
+    self.mainloop = GObject.MainLoop()
+
+    for i in [x for x in dir(signal) if x.startswith("SIG")]:
+      try:
+        signum = getattr(signal,i)
+        signal.signal(signum,self.sighandler)
+      except (RuntimeError,ValueError),m:
+        print "Not handling signal %s"%i
+        pass
+
+  def sighandler(self, signum, frame):
+    print("Caught signal %d" % signum)
+    self.mainloop.quit()
+
+  def start_next(self):
+    # Starts the sessions due by now on the ramp
+    due = len(self.sessions)
+    if self.ramp > 0:
+      due = min(due, int((time.time() - self.started) * self.ramp) + 1)
+    while self.next_session < due:
+      self.sessions[self.next_session].start()
+      self.next_session = self.next_session + 1
+    return self.next_session < len(self.sessions)
+
+  def update_stats(self):
+    now = time.time()
+    ts = str(now)
+    elapsed = now - self.last_report
+    self.last_report = now
+    states = dict()
+    total = dict(frames=0, packets=0, lost=0, late=0, duplicates=0)
+    for session in self.sessions:
+      states[session.state] = states.get(session.state, 0) + 1
+      if session.state == 'pending':
+        continue
+      if session.state == 'playing' and session.index not in self.reported:
+        self.report_connect(session, ts, now)
+      delta = session.interval()
+      for name in total:
+        total[name] = total[name] + delta[name]
+      if self.per_session:
+        fps = delta['frames'] / elapsed
+        pps = delta['packets'] / elapsed
+        mesg = "%s Session:%d State:%s FPS:%d PPS:%d Lost:%d Late:%d Duplicates:%d" % (ts, session.index, session.state, round(fps), round(pps), delta['lost'], delta['late'], delta['duplicates'])
+        self.writer.record(mesg, timestamp=now, flow=session.index, fps=fps, loss=delta['lost'], state=session.state, pps=pps, late=delta['late'], duplicates=delta['duplicates'])
+
+    # Aggregate over every session, with connect times so far
+    playing = states.get('playing', 0)
+    fps = total['frames'] / elapsed
+    pps = total['packets'] / elapsed
+    mean_fps = 0
+    if playing > 0:
+      mean_fps = fps / playing
+    extra = dict(sessions=len(self.sessions), pps=pps, late=total['late'], duplicates=total['duplicates'], mean_fps=mean_fps)
+    for state in ['pending', 'connecting', 'playing', 'failed', 'eos']:
+      extra[state] = states.get(state, 0)
+    connect = ''
+    for phase in ['setup', 'first_frame']:
+      p50, p95 = percentiles([s.times[phase] for s in self.sessions if phase in s.times], (50, 95))
+      if p50 != None:
+        extra['%s_p50_ms' % phase] = p50
+        extra['%s_p95_ms' % phase] = p95
+        connect = connect + " %s:%d/%dms" % (phase, p50, p95)
+    mesg = "%s All Playing:%d/%d Connecting:%d Failed:%d FPS:%d MeanFPS:%.1f PPS:%d Lost:%d Late:%d%s" % (ts, playing, len(self.sessions), states.get('connecting', 0), states.get('failed', 0), round(fps), mean_fps, round(pps), total['lost'], total['late'], connect)
+    self.writer.record(mesg, timestamp=now, flow='all', fps=fps, loss=total['lost'], **extra)
+
+    if now >= self.started + self.timeout:
+      self.mainloop.quit()
+      return False
+    return True
+
+  def report_connect(self, session, ts, now):
+    self.reported.add(session.index)
+    times = dict([('%s_ms' % phase, session.times.get(phase)) for phase in PHASES])
+    mesg = "%s Session:%d Connected" % (ts, session.index)
+    for phase in PHASES:
+      if phase in session.times:
+        mesg = mesg + " %s:%.1fms" % (phase, session.times[phase])
+    self.writer.record(mesg, timestamp=now, flow=session.index, state='connected', **times)
+
+  def run(self):
+    print("Opening %d sessions to %s" % (len(self.sessions), self.sessions[0].location))
+    self.started = time.time()
+    self.last_report = self.started
+    if self.start_next():
+      GObject.timeout_add(max(1, int(1000 / self.ramp)), self.start_next)
+    GObject.timeout_add(int(self.period * 1000), self.update_stats)
+    try:
+      self.mainloop.run()
+    except KeyboardInterrupt:
+      print("Killed by ^C")
+    self.stop()
+
+  def stop(self):
+    print("Exiting")
+    for session in self.sessions:
+      session.stop()
+    # Sessions that never got going, and why
+    for session in self.sessions:
+      if session.state == 'failed':
+        self.writer.message("Session:%d failed: %s" % (session.index, getattr(session, 'error', 'could not start')))
+    self.writer.close()
+
+def main():
+  GObject.threads_init()
+  Gst.init(None)
+  parser = argparse.ArgumentParser(description='Many RTSP viewers in one process')
+  parser.add_argument('-s', '--server', default='localhost', help='RTSP server name or address')
+  parser.add_argument('-p', '--port', type=int, default=5000, help='RTSP server port number')
+  parser.add_argument('-u', '--mount', default='/video', help='Mount point to play.')
+  parser.add_argument('-n', '--sessions', type=int, default=10, help='Concurrent sessions to open.')
+  parser.add_argument('-r', '--ramp', type=float, default=1.0, help='Sessions started per second (0 starts them all at once).')
+  parser.add_argument('-t', '--timeout', type=float, default=60, help='Time to live in seconds.')
+  parser.add_argument('-m', '--period', type=float, default=1.0, help='Seconds between stats samples; rates are per second.')
+  parser.add_argument('-N', '--no_decode', default=False, action='store_true', help='Receive RTP without depayloading or decoding.')
+  parser.add_argument('-l', '--latency', type=int, default=200, help='rtspsrc jitter buffer latency in ms.')
+  parser.add_argument('-T', '--tcp', default=False, action='store_true', help='Interleave RTP over the RTSP TCP connection.')
+  parser.add_argument('-A', '--aggregate_only', default=False, action='store_true', help='Only write the all-sessions line each period (connect times are still per session).')
+  parser.add_argument('--statsfile', default=None, help='File to log stats to.')
+  parser.add_argument('--stats_format', default='text', choices=FORMATS, help='Stats output: the usual text lines, or csv/ndjson with a fixed schema.')
+  parser.add_argument('--flush_interval', default=1.0, type=float, help='Seconds between stats flushes.')
+  args = parser.parse_args()
+
+  location = "rtsp://%s:%d%s" % (args.server, args.port, args.mount)
+  load = RTSPLoad(location, sessions=args.sessions, ramp=args.ramp, timeout=args.timeout, period=args.period, decode=not args.no_decode, latency=args.latency, tcp=args.tcp, per_session=not args.aggregate_only, stats_file=args.statsfile, stats_format=args.stats_format, flush_interval=args.flush_interval)
+  load.run()
+
+if __name__ == "__main__":
+  main()
@@ -1,6 +1,8 @@
-#!/usr/bin/python 
+#!/usr/bin/python
 import gi
+import time
 import argparse
+import threading
 
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst, GObject, GstRtspServer, GstRtsp
@@ -8,49 +10,213 @@ from gi.repository import Gst, GObject, GstRtspServer, GstRtsp
 GObject.threads_init()
 Gst.init(None)
 
+class Mount:
+  # One entry in the catalogue: a mount path and the stream served there
+  def __init__(self, path, width=1280, height=720, fr=30, bitrate=0, max_sessions=0):
+    if not path.startswith('/'):
+      path = '/' + path
+    self.path = path
+    self.width = width
+    self.height = height
+    self.fr = fr
+    self.bitrate = bitrate
+    self.max_sessions = max_sessions
+    self.sessions = set()
+    self.factory = None
+    self.media = None
+
+  def launch_description(self):
+    encode = 'x264enc  tune=zerolatency'
+    if self.bitrate > 0:
+      encode = encode + ' bitrate=%d' % self.bitrate
+    return '( videotestsrc is-live=1 ! queue ! video/x-raw, framerate=%d/1, width=%d, height=%d  ! timeoverlay ! %s ! queue ! rtph264pay pt=96 config-interval=1 name=pay0 )' % (self.fr, self.width, self.height, encode)
+
+  def describe(self):
+    limit = 'unlimited'
+    if self.max_sessions > 0:
+      limit = 'max %d sessions' % self.max_sessions
+    return "%s %dx%d@%d %s, %s" % (self.path, self.width, self.height, self.fr, self.bitrate > 0 and '%dkbps' % self.bitrate or 'default bitrate', limit)
+
 class RTSP_Server:
-  def __init__(self, fr=30, width=1280, height=720, port=5000, use_tcp=False):
+  def __init__(self, fr=30, width=1280, height=720, port=5000, use_tcp=False, mounts=None, threads=0, max_sessions=0, session_timeout=0, cleanup_interval=10, preroll=False):
     self.server = GstRtspServer.RTSPServer.new()
     self.address = '0.0.0.0'
     self.port = str(port)
-    
-    self.launch_description = '( videotestsrc is-live=1 ! queue ! video/x-raw, framerate=%d/1, width=%d, height=%d  ! timeoverlay ! x264enc  tune=zerolatency ! queue ! rtph264pay pt=96 config-interval=1 name=pay0 )' % (fr, width, height)
-    
+    self.session_timeout = session_timeout
+    self.preroll = preroll
+
+    if mounts == None:
+      mounts = [Mount('/video', width=width, height=height, fr=fr)]
+    self.mounts = mounts
+
     self.server.set_address(self.address)
     self.server.set_service(self.port)
-    
-    self.server.connect("client-connected",self.client_connected) 
-    self.factory = GstRtspServer.RTSPMediaFactory.new()
-    self.factory.set_launch(self.launch_description)
-    self.factory.set_shared(True)
-  
-    # Force TCP?
-    if use_tcp:
-      self.factory.set_protocols(GstRtsp.RTSPLowerTrans.TCP)
-  
-    self.factory.set_transport_mode(GstRtspServer.RTSPTransportMode.PLAY)
+
+    # Clients are served from a bounded pool of threads rather than one per
+    # connection; 0 keeps the GstRtspServer default
+    if threads > 0:
+      pool = GstRtspServer.RTSPThreadPool.new()
+      pool.set_max_threads(threads)
+      self.server.set_thread_pool(pool)
+
+    self.session_pool = self.server.get_session_pool()
+    if max_sessions > 0:
+      self.session_pool.set_max_sessions(max_sessions)
+    self.session_pool.connect("session-removed", self.session_removed)
+
+    self.server.connect("client-connected",self.client_connected)
     self.mount_points = self.server.get_mount_points()
-    self.mount_points.add_factory('/video', self.factory)
-    
+    for mount in self.mounts:
+      mount.factory = GstRtspServer.RTSPMediaFactory.new()
+      mount.factory.set_launch(mount.launch_description())
+      mount.factory.set_shared(True)
+
+      # Force TCP?
+      if use_tcp:
+        mount.factory.set_protocols(GstRtsp.RTSPLowerTrans.TCP)
+
+      mount.factory.set_transport_mode(GstRtspServer.RTSPTransportMode.PLAY)
+      self.mount_points.add_factory(mount.path, mount.factory)
+      print("Mount %s" % mount.describe())
+
     self.server.attach(None)
+
+    # Expired sessions are only dropped when someone asks
+    if cleanup_interval > 0:
+      GObject.timeout_add_seconds(cleanup_interval, self.cleanup)
+
+    if self.preroll:
+      for mount in self.mounts:
+        self.preroll_later(mount)
     print("Stream Ready")
     GObject.MainLoop().run()
-  
+
   def client_connected(self, arg1, arg2):
     print("Client Connected")
-                                                                    
- 
+    arg2.connect("pre-setup-request", self.pre_setup_request)
+    arg2.connect("new-session", self.new_session)
+
+  def mount_of(self, path):
+    # Longest mount path the request path falls under
+    best = None
+    for mount in self.mounts:
+      if path == mount.path or path.startswith(mount.path + '/'):
+        if best == None or len(mount.path) > len(best.path):
+          best = mount
+    return best
+
+  def pre_setup_request(self, client, ctx):
+    # A SETUP without a session header starts a new session; refuse it
+    # once the mount has all the sessions it may have
+    mount = self.mount_of(ctx.uri.abspath)
+    client.setup_mount = mount
+    if mount == None or mount.max_sessions <= 0:
+      return GstRtsp.RTSPStatusCode.OK
+    res, session = ctx.request.get_header(GstRtsp.RTSPHeaderField.SESSION, 0)
+    if res == GstRtsp.RTSPResult.OK:
+      return GstRtsp.RTSPStatusCode.OK
+    if len(mount.sessions) >= mount.max_sessions:
+      print("Refusing session on %s, %d of %d in use" % (mount.path, len(mount.sessions), mount.max_sessions))
+      return GstRtsp.RTSPStatusCode.SERVICE_UNAVAILABLE
+    return GstRtsp.RTSPStatusCode.OK
+
+  def new_session(self, client, session):
+    # Created while handling the SETUP that pre_setup_request just passed
+    if self.session_timeout > 0:
+      session.set_timeout(self.session_timeout)
+    mount = getattr(client, 'setup_mount', None)
+    if mount != None:
+      mount.sessions.add(session.get_sessionid())
+
+  def session_removed(self, pool, session):
+    sessionid = session.get_sessionid()
+    for mount in self.mounts:
+      mount.sessions.discard(sessionid)
+
+  def cleanup(self):
+    removed = self.session_pool.cleanup()
+    if removed > 0:
+      print("%s Removed %d expired sessions, %d left" % (str(time.time()), removed, self.session_pool.get_n_sessions()))
+    return True
+
+  def preroll_later(self, mount):
+    # prepare() blocks until the media has prerolled, and the media's bus
+    # watch runs on the main loop; waiting in the main loop would stall both
+    # it and the server, so the wait happens on a thread of its own
+    thread = threading.Thread(target=self.preroll_media, args=(mount,))
+    thread.daemon = True
+    thread.start()
+
+  def preroll_media(self, mount):
+    # Build and prepare the shared media now so the first client does not
+    # wait for the encoder. The factory caches shared media by port and
+    # path, so the first SETUP on this mount finds this one.
+    res, url = GstRtsp.RTSPUrl.parse('rtsp://127.0.0.1:%s%s' % (self.port, mount.path))
+    if res != GstRtsp.RTSPResult.OK:
+      print("Could not preroll %s" % mount.path)
+      return
+    media = mount.factory.construct(url)
+    if media == None or not media.prepare(None):
+      print("Could not preroll %s" % mount.path)
+      return
+    # Shared media is torn down after its last client; get the next one ready
+    media.connect("unprepared", self.media_unprepared, mount)
+    mount.media = media
+    print("Prerolled %s" % mount.path)
+
+  def media_unprepared(self, media, mount):
+    if media == mount.media:
+      mount.media = None
+      self.preroll_later(mount)
+
+def parse_mount(spec, width, height, fr):
+  # path[:WIDTHxHEIGHT[:framerate[:bitrate[:max_sessions]]]], missing fields take the -W/-H/-f values
+  fields = spec.strip().split(':')
+  if fields[0] == '' or len(fields) > 5:
+    raise ValueError("Bad mount '%s', expected path[:WIDTHxHEIGHT[:framerate[:bitrate[:max_sessions]]]]" % spec)
+  mount = Mount(fields[0], width=width, height=height, fr=fr)
+  if len(fields) > 1 and fields[1] != '':
+    geometry = fields[1].lower().split('x')
+    mount.width = int(geometry[0])
+    mount.height = int(geometry[1])
+  if len(fields) > 2 and fields[2] != '':
+    mount.fr = int(fields[2])
+  if len(fields) > 3 and fields[3] != '':
+    mount.bitrate = int(fields[3])
+  if len(fields) > 4 and fields[4] != '':
+    mount.max_sessions = int(fields[4])
+  return mount
+
+def read_mounts(mounts_file, width, height, fr):
+  mounts = []
+  with open(mounts_file) as f:
+    for line in f:
+      line = line.split('#')[0].strip()
+      if line != '':
+        mounts.append(parse_mount(line, width, height, fr))
+  return mounts
+
 def main():
   parser = argparse.ArgumentParser(description='Test video source served via RTSP/RTP')
   parser.add_argument('-p', '--port', type=int, default=5000, help="Server port")
-  parser.add_argument('-f', '--framerate', type=int, default=30, help='Desired framerate for video served.')  
+  parser.add_argument('-f', '--framerate', type=int, default=30, help='Desired framerate for video served.')
   parser.add_argument('-W', '--width', type=int, default=1280, help='Width of video frame.')
   parser.add_argument('-H', '--height', type=int, default=720, help='Height of video frame.')
   parser.add_argument('-T', '--tcp', action='store_true', default=False, help='Force all communication over TCP')
+  parser.add_argument('-M', '--mount', action='append', default=[], help='Serve path[:WIDTHxHEIGHT[:framerate[:bitrate[:max_sessions]]]] (repeatable). Replaces the single /video mount.')
+  parser.add_argument('--mounts', default=None, help='File with one mount per line, as for -M.')
+  parser.add_argument('--threads', type=int, default=0, help='Maximum threads serving clients (0 for the GstRtspServer default).')
+  parser.add_argument('--max_sessions', type=int, default=0, help='Maximum sessions over all mounts (0 for no limit).')
+  parser.add_argument('--session_timeout', type=int, default=0, help='Seconds before an idle session expires (0 for the default, 60).')
+  parser.add_argument('--cleanup_interval', type=int, default=10, help='Seconds between sweeps for expired sessions (0 to never sweep).')
+  parser.add_argument('--preroll', action='store_true', default=False, help='Start every mount\'s encoder before the first client asks for it.')
   args = parser.parse_args()
-  server = RTSP_Server(fr=args.framerate, width=args.width, height=args.height, port=args.port, use_tcp=args.tcp)
+  mounts = [parse_mount(spec, args.width, args.height, args.framerate) for spec in args.mount]
+  if args.mounts != None:
+    mounts.extend(read_mounts(args.mounts, args.width, args.height, args.framerate))
+  if len(mounts) == 0:
+    mounts = None
+  server = RTSP_Server(fr=args.framerate, width=args.width, height=args.height, port=args.port, use_tcp=args.tcp, mounts=mounts, threads=args.threads, max_sessions=args.max_sessions, session_timeout=args.session_timeout, cleanup_interval=args.cleanup_interval, preroll=args.preroll)
 
 if __name__ == "__main__":
   main()
-
-